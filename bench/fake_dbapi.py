@@ -0,0 +1,378 @@
+########################################################################
+# fake_dbapi - In-process stand-ins for pymssql and pymysql
+#
+# install() registers fake `pymssql` and `pymysql` modules in sys.modules
+# so the check scripts run end to end without a database. The fakes serve
+# canned sysperfinfo, SHOW STATUS and SHOW SLAVE STATUS rows, sleep for a
+# configurable latency on every connect and query, and count what the
+# checks ask for in STATS. Every read of a growing counter advances a
+# fake clock by READ_INTERVAL seconds, and install() makes time.time()
+# follow it, so the delta modes see a plausible rate from their second run
+# on instead of a whole snapshot's growth over a few milliseconds.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+########################################################################
+
+import re
+import sys
+import time
+import types
+
+#~ cntr_type values SQL Server reports for the canned counters
+RAW = 65792
+RATE = 272696576
+FRACTION = 537003264
+AVERAGE = 1073874176
+BASE = 1073939712
+
+#~ Seconds the fake clock advances on every read of growing counters
+READ_INTERVAL = 60
+
+#~ (object_name, counter_name, instance_name, cntr_value, cntr_type, growth per read)
+SYSPERFINFO = [
+    ('SQLServer:Buffer Manager',    'Buffer cache hit ratio',       '',         970,        FRACTION,   95),
+    ('SQLServer:Buffer Manager',    'Buffer cache hit ratio base',  '',         1000,       BASE,       100),
+    ('SQLServer:Buffer Manager',    'Page lookups/sec',             '',         9000000,    RATE,       25000),
+    ('SQLServer:Buffer Manager',    'Free pages',                   '',         20480,      RAW,        0),
+    ('SQLServer:Buffer Manager',    'Total pages',                  '',         524288,     RAW,        0),
+    ('SQLServer:Buffer Manager',    'Target pages',                 '',         524288,     RAW,        0),
+    ('SQLServer:Buffer Manager',    'Database pages',               '',         401000,     RAW,        0),
+    ('SQLServer:Buffer Manager',    'Stolen pages',                 '',         61000,      RAW,        0),
+    ('SQLServer:Buffer Manager',    'Lazy writes/sec',              '',         1200,       RATE,       3),
+    ('SQLServer:Buffer Manager',    'Readahead pages/sec',          '',         450000,     RATE,       800),
+    ('SQLServer:Buffer Manager',    'Page reads/sec',               '',         880000,     RATE,       1500),
+    ('SQLServer:Buffer Manager',    'Checkpoint pages/sec',         '',         310000,     RATE,       400),
+    ('SQLServer:Buffer Manager',    'Page writes/sec',              '',         520000,     RATE,       900),
+    ('SQLServer:Buffer Manager',    'Page life expectancy',         '',         5400,       RAW,        0),
+    ('SQLServer:Locks',             'Lock requests/sec',            '_Total',   7200000,    RATE,       12000),
+    ('SQLServer:Locks',             'Lock timeouts/sec',            '_Total',   40,         RATE,       0),
+    ('SQLServer:Locks',             'Number of Deadlocks/sec',      '_Total',   2,          RATE,       0),
+    ('SQLServer:Locks',             'Lock Waits/sec',               '_Total',   3100,       RATE,       4),
+    ('SQLServer:Locks',             'Lock Wait Time (ms)',          '_Total',   91000,      RAW,        0),
+    ('SQLServer:Locks',             'Average Wait Time (ms)',       '_Total',   91000,      AVERAGE,    120),
+    ('SQLServer:Locks',             'Average Wait Time Base',       '_Total',   3100,       BASE,       4),
+    ('SQLServer:Access Methods',    'Page Splits/sec',              '',         64000,      RATE,       90),
+    ('SQLServer:Access Methods',    'Full Scans/sec',               '',         23000,      RATE,       30),
+    ('SQLServer:Plan Cache',        'Cache Hit Ratio',              '_Total',   880,        FRACTION,   70),
+    ('SQLServer:Plan Cache',        'Cache Hit Ratio Base',         '_Total',   1000,       BASE,       100),
+    ('SQLServer:Catalog Metadata',  'Cache Hit Ratio',              '_Total',   990,        FRACTION,   0),
+    ('SQLServer:Catalog Metadata',  'Cache Hit Ratio Base',         '_Total',   1000,       BASE,       0),
+    ('SQLServer:SQL Statistics',    'Batch Requests/sec',           '',         4100000,    RATE,       6000),
+    ('SQLServer:SQL Statistics',    'SQL Compilations/sec',         '',         380000,     RATE,       500),
+    ('SQLServer:Databases',         'Log Cache Hit Ratio',          'master',   92,         FRACTION,   8),
+    ('SQLServer:Databases',         'Log Cache Hit Ratio Base',     'master',   100,        BASE,       10),
+    ('SQLServer:Databases',         'Active Transactions',          'master',   3,          RAW,        0),
+    ('SQLServer:Databases',         'Log Flushes/sec',              'master',   150000,     RATE,       200),
+    ('SQLServer:Databases',         'Percent Log Used',             'master',   37,         RAW,        0),
+    ('SQLServer:Databases',         'Transactions/sec',             'master',   2900000,    RATE,       4000),
+    ('SQLServer:Databases',         'Log Growths',                  'master',   4,          RAW,        0),
+    ('SQLServer:Databases',         'Log Shrinks',                  'master',   0,          RAW,        0),
+    ('SQLServer:Databases',         'Log Truncations',              'master',   880,        RAW,        0),
+    ('SQLServer:Databases',         'Log Flush Wait Time',          'master',   12,         RAW,        0),
+    ('SQLServer:Databases',         'Data File(s) Size (KB)',       'master',   5120,       RAW,        0),
+]
+
+#~ Instances the SQLServer:Databases rows above are repeated for, with values scaled by position
+DATABASES = ['master', 'model', 'msdb', 'tempdb', 'app_orders', 'app_users', 'reporting', '_Total']
+
+SQLSERVER_START_TIME = 1700000000
+
+#~ Percentage of physical memory in use that sys.dm_os_sys_memory reports
+MEMORY_USED = 63.5
+
+#~ (SQL Server process, idle) percentages of the scheduler monitor records, newest first
+RING_BUFFER = [(12, 81), (18, 74), (9, 88), (31, 60), (14, 80), (11, 85)]
+
+#~ (Variable_name, Value, growth per read)
+MYSQL_STATUS = [
+    ('Aborted_connects',                    120,            0),
+    ('Bytes_received',                      91000000000,    2400000),
+    ('Bytes_sent',                          730000000000,   19000000),
+    ('Com_commit',                          2100000,        300),
+    ('Com_delete',                          800000,         90),
+    ('Com_insert',                          5200000,        700),
+    ('Com_rollback',                        3100,           1),
+    ('Com_select',                          31000000,       4200),
+    ('Com_update',                          4400000,        600),
+    ('Created_tmp_disk_tables',             52000,          12),
+    ('Created_tmp_tables',                  910000,         150),
+    ('Innodb_buffer_pool_read_requests',    9800000000,     1200000),
+    ('Innodb_buffer_pool_reads',            4100000,        300),
+    ('Questions',                           48000000,       6500),
+    ('Threads_connected',                   17,             0),
+    ('Threads_running',                     3,              0),
+    ('Uptime',                              864000,         60),
+]
+
+MYSQL_VARIABLES = [
+    ('innodb_buffer_pool_size',     8589934592),
+    ('max_connections',             151),
+]
+
+#~ One row per replication channel, with the SHOW REPLICA STATUS column names
+MYSQL_REPLICA_STATUS = [
+    {   'Channel_Name'          : '',
+        'Replica_IO_Running'    : 'Yes',
+        'Replica_SQL_Running'   : 'Yes',
+        'Relay_Source_Log_File' : 'mysql-bin.000042',
+        'Read_Source_Log_Pos'   : 981234,
+        'Exec_Source_Log_Pos'   : 981234,
+        'Seconds_Behind_Source' : 2,
+        'Retrieved_Gtid_Set'    : '3e11fa47-71ca-11e1-9e33-c80aa9429562:1-5120',
+        'Executed_Gtid_Set'     : '3e11fa47-71ca-11e1-9e33-c80aa9429562:1-5117,\n'
+                                  '8a94f357-aab4-11df-86ab-c80aa9429563:1-880',
+        'Last_IO_Error'         : '',
+        'Last_SQL_Error'        : '' },
+    {   'Channel_Name'          : 'analytics',
+        'Replica_IO_Running'    : 'Yes',
+        'Replica_SQL_Running'   : 'Yes',
+        'Relay_Source_Log_File' : 'analytics-bin.000007',
+        'Read_Source_Log_Pos'   : 44120,
+        'Exec_Source_Log_Pos'   : 43980,
+        'Seconds_Behind_Source' : 11,
+        'Retrieved_Gtid_Set'    : '8a94f357-aab4-11df-86ab-c80aa9429563:1-884',
+        'Executed_Gtid_Set'     : '3e11fa47-71ca-11e1-9e33-c80aa9429562:1-5117,\n'
+                                  '8a94f357-aab4-11df-86ab-c80aa9429563:1-880',
+        'Last_IO_Error'         : '',
+        'Last_SQL_Error'        : '' },
+]
+
+def legacy_replica_row(row):
+    """The same channel with the SHOW SLAVE STATUS column names."""
+    return dict((name.replace('Replica', 'Slave').replace('Source', 'Master'), value) for name, value in row.items())
+
+#~ sys.dm_os_wait_stats: wait type, wait_time_ms, signal_wait_time_ms and how much both grow per read
+WAIT_STATS = [
+    ('PAGEIOLATCH_SH',      8400000,    120000,     9000,   300),
+    ('WRITELOG',            3100000,    80000,      2500,   200),
+    ('CXPACKET',            2200000,    400000,     1200,   400),
+    ('LCK_M_X',             900000,     1000,       600,    5),
+    ('SOS_SCHEDULER_YIELD', 700000,     690000,     900,    880),
+    ('ASYNC_NETWORK_IO',    400000,     20000,      100,    10),
+    ('LAZYWRITER_SLEEP',    99000000,   10000,      60000,  10),
+    ('SLEEP_TASK',          88000000,   50000,      60000,  30),
+]
+
+#~ sys.dm_io_virtual_file_stats: database_id, file_id, database, physical_name, volume mount point, then
+#~ reads, bytes read, read stall ms, writes, bytes written, write stall ms and how much each grows per read
+VIRTUAL_FILE_STATS = [
+    (1, 1, 'master',     'D:\\Data\\master.mdf',        'D:\\', (90000, 737280000, 180000, 4000, 32768000, 8000),          (10, 81920, 20, 1, 8192, 2)),
+    (1, 2, 'master',     'L:\\Logs\\mastlog.ldf',       'L:\\', (2000, 16384000, 1000, 30000, 245760000, 15000),         (0, 0, 0, 4, 32768, 2)),
+    (2, 1, 'tempdb',     'T:\\TempDB\\tempdb.mdf',      'T:\\', (400000, 3276800000, 1200000, 380000, 3112960000, 1900000), (300, 2457600, 900, 280, 2293760, 4200)),
+    (2, 2, 'tempdb',     'T:\\TempDB\\templog.ldf',     'T:\\', (1000, 8192000, 500, 900000, 7372800000, 900000),        (0, 0, 0, 600, 4915200, 600)),
+    (5, 1, 'app_orders', 'D:\\Data\\app_orders.mdf',    'D:\\', (2500000, 20480000000, 25000000, 600000, 4915200000, 3000000), (2000, 16384000, 16000, 400, 3276800, 2000)),
+    (5, 2, 'app_orders', 'L:\\Logs\\app_orders.ldf',    'L:\\', (5000, 40960000, 2500, 4000000, 32768000000, 2000000),   (0, 0, 0, 3000, 24576000, 1500)),
+]
+
+#~ events_statements_summary_by_digest: digest, schema, text, calls, SUM_TIMER_WAIT (ps), SUM_ROWS_EXAMINED
+#~ and how much the last three grow per read. The orders query gets slower and scans more on every read.
+MYSQL_DIGESTS = [
+    ('5f1c0e6b2a7d43c8a1e9f0b3d6c2e8a47b1d9c3f2e6a0b8d4c7f1e5a9b3d2c6e', 'shop', 'SELECT * FROM `orders` WHERE `customer_id` = ?',
+     182000, 91000000000000, 182000, 200, 400000000000, 1000),
+    ('a3d9e1f4b7c2086e5d1a9f3c7b2e4d8a6c0f9e1b5d3a7c2e8f4b6d0a1c9e3f5b', 'shop', 'UPDATE `stock` SET `quantity` = `quantity` - ? WHERE `sku` = ?',
+     540000, 27000000000000, 540000, 600, 30000000000, 600),
+    ('0b7e2c9d4f1a6385e2d7c0b9a4f3e1d8c6b5a2f9e0d7c4b1a8f5e2d9c6b3a0f7', None, 'COMMIT',
+     720000, 3600000000000, 0, 800, 4000000000, 0),
+]
+
+STATS = { 'connects' : 0, 'queries' : 0, 'rows' : 0 }
+
+#~ time.time before install() replaced it
+REAL_TIME = time.time
+
+SETTINGS = { 'connect_latency' : 0.0, 'query_latency' : 0.0 }
+
+class Error(Exception):
+    pass
+
+class InterfaceError(Error):
+    pass
+
+class DatabaseError(Error):
+    pass
+
+class OperationalError(DatabaseError):
+    pass
+
+class ProgrammingError(DatabaseError):
+    pass
+
+class FakeServer(object):
+    """Canned answers for the queries the checks send, one instance per driver."""
+
+    def __init__(self):
+        self.reads = 0
+
+    def tick(self):
+        """Count one read of growing counters, which moves the fake clock on by READ_INTERVAL."""
+        self.reads += 1
+        return self.reads
+
+    def time(self):
+        """The fake clock: real time plus READ_INTERVAL seconds for every read so far."""
+        return REAL_TIME() + READ_INTERVAL * self.reads
+
+    def sysperfinfo(self, query, params):
+        reads = self.tick()
+        wanted = set(str(param).lower() for param in params or ())
+        by_instance = 'instance_name in' in query.lower()
+        with_type = 'cntr_type' in query.lower()
+        rows = []
+        for object_name, counter_name, instance_name, value, cntr_type, growth in database_rows():
+            if wanted and counter_name.lower() not in wanted:
+                continue
+            if by_instance and instance_name.lower() not in wanted:
+                continue
+            row = (object_name, counter_name, instance_name, value + growth * reads)
+            rows.append(row + (cntr_type,) if with_type else row)
+        if 'sqlserver_start_time' in query:
+            row = ('SQLServer:Server', 'sqlserver_start_time', '', SQLSERVER_START_TIME)
+            rows.append(row + (RAW,) if with_type else row)
+        return rows
+
+    def mssql(self, query, params):
+        lowered = query.lower()
+        if 'sysperfinfo' in lowered:
+            return self.sysperfinfo(query, params)
+        if 'sysprocesses' in lowered:
+            return [(42,)]
+        if 'dm_os_sys_memory' in lowered:
+            return [(MEMORY_USED,)]
+        if 'dm_os_wait_stats' in lowered:
+            reads = self.tick()
+            excluded = set(params or ())
+            rows = [(wait_type, wait_ms + wait_growth * reads, signal_ms + signal_growth * reads)
+                    for wait_type, wait_ms, signal_ms, wait_growth, signal_growth in WAIT_STATS if wait_type not in excluded]
+            return rows + [('sqlserver_start_time', SQLSERVER_START_TIME, 0)]
+        if 'dm_io_virtual_file_stats' in lowered:
+            reads = self.tick()
+            by_volume = 'dm_os_volume_stats' in lowered
+            rows = [(database_id, file_id, database, path, volume if by_volume else None) +
+                    tuple(value + growth * reads for value, growth in zip(values, growths))
+                    for database_id, file_id, database, path, volume, values, growths in VIRTUAL_FILE_STATS]
+            return rows + [(0, 0, 'sqlserver_start_time', None, None, SQLSERVER_START_TIME, 0, 0, 0, 0, 0)]
+        if 'dm_os_ring_buffers' in lowered:
+            top = re.search(r'top \((\d+)\)', lowered)
+            count = int(top.group(1)) if top else 256
+            return [RING_BUFFER[i % len(RING_BUFFER)] for i in range(count)]
+        if lowered.startswith('exec dbo.'):
+            return [('OK: {} completed'.format(query.split()[1]),)]
+        if lowered.strip().rstrip(';') == 'select 1':
+            return [(1,)]
+        raise ProgrammingError('fake pymssql has no canned rows for: {}'.format(query))
+
+    def mysql(self, query, params):
+        lowered = query.lower()
+        if lowered.startswith('show replica status'):
+            return [dict(row) for row in MYSQL_REPLICA_STATUS]
+        if lowered.startswith('show slave status'):
+            return [legacy_replica_row(row) for row in MYSQL_REPLICA_STATUS]
+        if lowered.startswith('show') and 'status' in lowered:
+            reads = self.tick()
+            like = re.search(r"like '([^']*)'", query, re.I)
+            return [{ 'Variable_name' : name, 'Value' : str(value + growth * reads) }
+                    for name, value, growth in MYSQL_STATUS if not like or name.lower() == like.group(1).lower()]
+        if lowered.startswith('show') and 'variables' in lowered:
+            return [{ 'Variable_name' : name, 'Value' : str(value) } for name, value in MYSQL_VARIABLES]
+        if 'events_statements_summary_by_digest' in lowered:
+            reads = self.tick()
+            return [{ 'DIGEST' : digest, 'SCHEMA_NAME' : schema, 'LEFT(DIGEST_TEXT, 80)' : text, 'COUNT_STAR' : calls + calls_growth * reads,
+                      'SUM_TIMER_WAIT' : latency + latency_growth * reads, 'SUM_ROWS_EXAMINED' : examined + examined_growth * reads }
+                    for digest, schema, text, calls, latency, examined, calls_growth, latency_growth, examined_growth in MYSQL_DIGESTS][:params[0]]
+        #~ The memory and cpu modes send the SQL Server queries and read the Value column like the other single value modes
+        if 'dm_os_sys_memory' in lowered:
+            return [{ 'Value' : MEMORY_USED }]
+        if 'dm_os_ring_buffers' in lowered:
+            return [{ 'Value' : process } for process, idle in RING_BUFFER]
+        if lowered.strip().rstrip(';') == 'select 1':
+            return [{ '1' : 1 }]
+        raise ProgrammingError('fake pymysql has no canned rows for: {}'.format(query))
+
+def database_rows():
+    """SYSPERFINFO with the per-database rows repeated for every name in DATABASES."""
+    for row in SYSPERFINFO:
+        if row[2] != 'master':
+            yield row
+            continue
+        for position, database in enumerate(DATABASES):
+            value = row[3] * (position + 2) // 2
+            yield row[:2] + (database, value) + row[4:]
+
+class Cursor(object):
+
+    def __init__(self, answer, as_dict=False):
+        self.answer = answer
+        self.as_dict = as_dict
+        self.rows = []
+
+    def execute(self, query, params=None):
+        STATS['queries'] += 1
+        if SETTINGS['query_latency']:
+            time.sleep(SETTINGS['query_latency'])
+        rows = self.answer(query, params)
+        if not self.as_dict:
+            rows = [tuple(row.values()) if isinstance(row, dict) else row for row in rows]
+        STATS['rows'] += len(rows)
+        self.rows = list(rows)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+class Connection(object):
+
+    def __init__(self, answer):
+        STATS['connects'] += 1
+        if SETTINGS['connect_latency']:
+            time.sleep(SETTINGS['connect_latency'])
+        self.answer = answer
+
+    def cursor(self, cursor_class=None):
+        return Cursor(self.answer, cursor_class is not None)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+def driver_module(name, answer):
+    module = types.ModuleType(name)
+    module.__file__ = __file__
+    for error in (Error, InterfaceError, DatabaseError, OperationalError, ProgrammingError):
+        setattr(module, error.__name__, error)
+    module.connect = lambda *args, **kwargs: Connection(answer)
+    return module
+
+def install(connect_latency=0.0, query_latency=0.0):
+    """Register the fake drivers, replacing any real pymssql/pymysql already imported, and start the fake clock."""
+    SETTINGS['connect_latency'] = connect_latency
+    SETTINGS['query_latency'] = query_latency
+    server = FakeServer()
+    pymssql = driver_module('pymssql', server.mssql)
+    pymysql = driver_module('pymysql', server.mysql)
+    cursors = types.ModuleType('pymysql.cursors')
+    cursors.DictCursor = type('DictCursor', (object,), {})
+    pymysql.cursors = cursors
+    sys.modules.update({ 'pymssql' : pymssql, 'pymysql' : pymysql, 'pymysql.cursors' : cursors })
+    time.time = server.time
+    return server
+
+def uninstall():
+    """Undo install(): drop the fake drivers and give time.time back."""
+    time.time = REAL_TIME
+    for name in ('pymssql', 'pymysql', 'pymysql.cursors'):
+        sys.modules.pop(name, None)
+
+def reset_stats():
+    for key in STATS:
+        STATS[key] = 0
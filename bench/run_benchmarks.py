@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+########################################################################
+# run_benchmarks - Per-check latency, query count and memory
+#
+# Runs every MODES entry of the check scripts end to end (argument
+# parsing, connect, query, calculation and output) against the fake
+# drivers from fake_dbapi.py, so no database is needed. Each run executes
+# the script as __main__ with fresh globals, like one Nagios check. The
+# bytecode is compiled once beforehand, so runs are not dominated by
+# compile time. Results go to a JSON file, and --compare prints the change
+# against an earlier one. A check that does not exit with OK, WARNING or
+# CRITICAL, or whose exit code changes between runs, fails the benchmark.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+########################################################################
+
+import io
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import tracemalloc
+import contextlib
+from optparse import OptionParser
+
+import fake_dbapi
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOGIN = ['-H', 'bench', '-U', 'nagios', '-P', 'secret']
+
+#~ Modes that do not run a single check
+SKIPPED_MODES = ('test',)
+
+#~ Exit codes of a check that ran: OK, WARNING and CRITICAL
+VALID_EXIT_CODES = (0, 1, 2)
+
+def server_checks(modes):
+    checks = [(mode, LOGIN + ['-m', mode]) for mode in modes]
+    batch = [mode for mode in modes if mode != 'time2connect']
+    checks.append(('--modes (all {})'.format(len(batch)), LOGIN + ['--modes', ','.join(batch)]))
+    return checks
+
+def database_checks(modes):
+    checks = [(mode, LOGIN + ['-T', 'master', '-w', '80', '-c', '90', '--' + mode]) for mode in modes]
+    checks.append(('--all-databases logfileusage', LOGIN + ['--all-databases', '-w', '80', '-c', '90', '--logfileusage']))
+    return checks
+
+def proc_checks(modes):
+    checks = []
+    for mode in modes:
+        if 'logship' in mode:
+            checks.append((mode, LOGIN + ['-s', mode, '-t', 'logship', '-2', 'bench', '-1', 'primary', '-3', 'db', '-4', 'db']))
+        else:
+            checks.append((mode, LOGIN + ['-s', mode, '-w', '80', '-c', '90']))
+    return checks
+
+def mysql_checks(modes):
+    return [(mode, LOGIN + ['-m', mode, '-w', '30', '-c', '300']) for mode in modes]
+
+SCRIPTS = [
+    ('check_mssql_server',      'mssql/check_mssql_server.py',      server_checks),
+    ('check_mssql_database',    'mssql/check_mssql_database.py',    database_checks),
+    ('check_mssql_proc',        'mssql/check_mssql_proc.py',        proc_checks),
+    ('check_mysql_health',      'mysql/check_mysql_health.py',      mysql_checks),
+]
+
+def parse_args():
+    parser = OptionParser(usage='%prog [--runs N] [--latency MS] [--json FILE] [--compare FILE] [--script NAME]')
+    parser.add_option('--runs', type='int', default=20, help='Timed runs per check after one warm-up run (default 20).')
+    parser.add_option('--latency', type='float', default=0.0, help='Milliseconds the fake server takes per query (default 0).')
+    parser.add_option('--connect-latency', type='float', default=0.0, help='Milliseconds the fake server takes per login (default 0).')
+    parser.add_option('--json', default='bench_results.json', help='Write the results to this file (default bench_results.json).')
+    parser.add_option('--compare', help='Print the change against results written by an earlier run.')
+    parser.add_option('--script', action='append', default=[], help='Only benchmark this script (repeatable), e.g. check_mssql_server.')
+    options, args = parser.parse_args()
+    if options.runs < 1:
+        parser.error('--runs must be at least 1')
+    return options
+
+def fresh_process(path):
+    """Set up sys.path and sys.modules like a new interpreter running the script at path."""
+    sys.path[0] = os.path.dirname(path)
+    #~ The shared runtime keeps its caches in module globals, a new check must not see the last one's
+    sys.modules.pop('plugin_common', None)
+
+def load(path):
+    """Compile a script once and return its code and MODES."""
+    fresh_process(os.path.join(ROOT, path))
+    with open(os.path.join(ROOT, path)) as script:
+        code = compile(script.read(), os.path.join(ROOT, path), 'exec')
+    namespace = { '__name__' : 'bench', '__file__' : os.path.join(ROOT, path) }
+    #~ Only the definitions up to MODES matter here, so a failing tail does not stop the listing
+    try:
+        exec(code, namespace)
+    except Exception:
+        pass
+    return code, [mode for mode in namespace['MODES'] if mode not in SKIPPED_MODES]
+
+def run_check(code, path, args):
+    """Run a compiled script once as __main__, returning (exit code, first output line)."""
+    output = io.StringIO()
+    sys.argv = [path] + args
+    fresh_process(path)
+    exit_code = None
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            exec(code, { '__name__' : '__main__', '__file__' : path })
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    lines = output.getvalue().strip().splitlines()
+    return exit_code, lines[0] if lines else ''
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def benchmark(code, path, args, runs):
+    run_check(code, path, args)
+    timings = []
+    exit_codes = set()
+    for i in range(runs):
+        fake_dbapi.reset_stats()
+        start = time.perf_counter()
+        exit_code, output = run_check(code, path, args)
+        timings.append(time.perf_counter() - start)
+        exit_codes.add(exit_code)
+    counted = dict(fake_dbapi.STATS)
+
+    #~ tracemalloc slows everything down, so memory gets its own untimed run
+    tracemalloc.start()
+    try:
+        run_check(code, path, args)
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {    'median_ms'     : round(percentile(timings, 0.5) * 1000, 3),
+                'p95_ms'        : round(percentile(timings, 0.95) * 1000, 3),
+                'min_ms'        : round(min(timings) * 1000, 3),
+                'connects'      : counted['connects'],
+                'queries'       : counted['queries'],
+                'rows'          : counted['rows'],
+                'peak_kb'       : round(peak / 1024.0, 1),
+                'exit_code'     : exit_code,
+                'exit_codes'    : sorted(exit_codes, key=str),
+                'output'        : output[:200] }
+
+def failure(result):
+    """Why a benchmarked check did not run properly, or None."""
+    if len(result['exit_codes']) > 1:
+        return 'exit code changed between runs: {}'.format(result['exit_codes'])
+    if result['exit_code'] not in VALID_EXIT_CODES:
+        return 'exit {}: {}'.format(result['exit_code'], result['output'])
+    return None
+
+def compare(results, path):
+    with open(path) as previous_file:
+        previous = json.load(previous_file)
+    print('\nChange against {} ({}):'.format(path, previous.get('created', 'unknown date')))
+    for script, checks in sorted(results['scripts'].items()):
+        for check, result in sorted(checks.items()):
+            before = previous.get('scripts', {}).get(script, {}).get(check)
+            if not before:
+                print('  {:<22} {:<28} new'.format(script, check))
+                continue
+            change = (result['median_ms'] - before['median_ms']) / before['median_ms'] * 100 if before['median_ms'] else 0.0
+            print('  {:<22} {:<28} {:+6.1f}% median  queries {} -> {}  peak {} -> {} KB'.format(
+                    script, check, change, before['queries'], result['queries'], before['peak_kb'], result['peak_kb']))
+
+def main():
+    options = parse_args()
+    fake_dbapi.install(options.connect_latency / 1000.0, options.latency / 1000.0)
+    state_dir = tempfile.mkdtemp(prefix='check-bench-')
+    #~ Keep the delta modes' state databases away from the real ones
+    tempfile.tempdir = state_dir
+    argv = sys.argv
+    failures = []
+    results = { 'created'       : time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python'        : sys.version.split()[0],
+                'runs'          : options.runs,
+                'latency_ms'    : options.latency,
+                'scripts'       : {} }
+    try:
+        for name, path, checks in SCRIPTS:
+            if options.script and name not in options.script:
+                continue
+            code, modes = load(path)
+            results['scripts'][name] = {}
+            for check, args in checks(modes):
+                result = benchmark(code, os.path.join(ROOT, path), args, options.runs)
+                results['scripts'][name][check] = result
+                print('{:<22} {:<28} {:8.3f} ms median {:8.3f} ms p95  {:3d} queries  {:8.1f} KB peak  exit {}'.format(
+                        name, check, result['median_ms'], result['p95_ms'], result['queries'], result['peak_kb'], result['exit_code']))
+                if failure(result):
+                    failures.append('{} {}: {}'.format(name, check, failure(result)))
+    finally:
+        sys.argv = argv
+        tempfile.tempdir = None
+        shutil.rmtree(state_dir, ignore_errors=True)
+        fake_dbapi.uninstall()
+
+    with open(options.json, 'w') as json_file:
+        json.dump(results, json_file, indent=2, sort_keys=True)
+    print('Results written to {}'.format(options.json))
+    if options.compare:
+        compare(results, options.compare)
+    if failures:
+        print('\n{} checks failed:'.format(len(failures)))
+        for line in failures:
+            print('  ' + line)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
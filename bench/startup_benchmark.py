@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+########################################################################
+# startup_benchmark - Startup cost of the check scripts
+#
+# Runs each check on paths that never reach a database (usage errors,
+# --help, collector and broker clients pointed at a missing socket) and
+# measures the wall-clock time to the first byte of output, minus the
+# cost of starting a bare interpreter, plus the -X importtime profile.
+# Exits 1 when a scenario goes over the budget or imports a driver.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+########################################################################
+
+import os
+import sys
+import time
+import json
+import subprocess
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MISSING_SOCKET = '/nonexistent/check_startup_benchmark.sock'
+LOGIN = ['-H', 'localhost', '-U', 'nagios', '-P', 'secret']
+
+#~ Modules that must only be imported once a check really talks to a server
+DRIVERS = ('pymssql', '_mssql', 'pymysql')
+
+SCENARIOS = [
+    ('server usage error',          'mssql/check_mssql_server.py',      []),
+    ('server --help',               'mssql/check_mssql_server.py',      ['--help']),
+    ('server collector client',     'mssql/check_mssql_server.py',      LOGIN + ['--socket', MISSING_SOCKET, '-m', 'pagelife']),
+    ('server broker client',        'mssql/check_mssql_server.py',      LOGIN + ['--broker', MISSING_SOCKET, '-m', 'pagelife']),
+    ('database usage error',        'mssql/check_mssql_database.py',    []),
+    ('database broker client',      'mssql/check_mssql_database.py',    LOGIN + ['-T', 'master', '-w', '1', '-c', '2', '--broker', MISSING_SOCKET, '--logfileusage']),
+    ('proc usage error',            'mssql/check_mssql_proc.py',        []),
+    ('mysql usage error',           'mysql/check_mysql_health.py',      []),
+    ('mysql collector client',      'mysql/check_mysql_health.py',      LOGIN + ['--socket', MISSING_SOCKET, '-m', 'connections']),
+    ('mysql broker client',         'mysql/check_mysql_health.py',      LOGIN + ['--broker', MISSING_SOCKET, '-m', 'connections']),
+]
+
+def parse_args():
+    parser = OptionParser(usage='%prog [--runs N] [--budget MS] [--json FILE]')
+    parser.add_option('--runs', type='int', default=20, help='Runs per scenario, the median is reported (default 20).')
+    parser.add_option('--budget', type='float', default=50.0,
+                      help='Milliseconds a check may add to a bare interpreter start before the scenario fails (default 50).')
+    parser.add_option('--python', default=sys.executable, help='Interpreter to benchmark (default: this one).')
+    parser.add_option('--json', help='Also write the results to this file as JSON.')
+    options, args = parser.parse_args()
+    if options.runs < 1:
+        parser.error('--runs must be at least 1')
+    return options
+
+def time_to_first_byte(command):
+    """Seconds from spawning command until it writes its first byte to stdout or stderr."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    os.read(process.stdout.fileno(), 1)
+    elapsed = time.perf_counter() - start
+    process.communicate()
+    return elapsed
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def import_profile(python, script, args):
+    """Return (total microseconds, {top-level module: cumulative microseconds}, drivers) from -X importtime."""
+    process = subprocess.Popen([python, '-X', 'importtime', script] + args, cwd=ROOT, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.communicate()[1].decode('utf-8', 'replace')
+    modules = {}
+    drivers = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        if name.strip().split('.')[0] in DRIVERS:
+            drivers.add(name.strip())
+        #~ Nested imports are indented below the module that pulled them in
+        if not name[1:].startswith(' '):
+            modules[name.strip()] = int(cumulative_us)
+    return sum(modules.values()), modules, sorted(drivers)
+
+def main():
+    options = parse_args()
+    baseline = median([time_to_first_byte([options.python, '-c', 'print()']) for i in range(options.runs)])
+    print('bare interpreter: {:.1f} ms to first byte, budget {:.1f} ms on top'.format(baseline * 1000, options.budget))
+
+    results = []
+    failed = 0
+    for name, script, args in SCENARIOS:
+        first_byte = median([time_to_first_byte([options.python, script] + args) for i in range(options.runs)])
+        overhead_ms = (first_byte - baseline) * 1000
+        import_us, modules, drivers = import_profile(options.python, script, args)
+        heaviest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:3]
+        passed = overhead_ms <= options.budget and not drivers
+        if not passed:
+            failed += 1
+        results.append({    'scenario'          : name,
+                            'script'            : script,
+                            'first_byte_ms'     : round(first_byte * 1000, 2),
+                            'overhead_ms'       : round(overhead_ms, 2),
+                            'import_ms'         : round(import_us / 1000.0, 2),
+                            'heaviest_imports'  : dict((module, round(us / 1000.0, 2)) for module, us in heaviest),
+                            'drivers_imported'  : drivers,
+                            'passed'            : passed })
+        print('{:<4} {:<28} {:7.1f} ms first byte {:+7.1f} ms  imports {:6.1f} ms  ({}){}'.format(
+                'ok' if passed else 'FAIL', name, first_byte * 1000, overhead_ms, import_us / 1000.0,
+                ', '.join('{} {:.1f}'.format(module, us / 1000.0) for module, us in heaviest),
+                '  drivers: {}'.format(', '.join(drivers)) if drivers else ''))
+
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump({ 'python' : options.python, 'runs' : options.runs, 'budget_ms' : options.budget,
+                        'baseline_ms' : round(baseline * 1000, 2), 'scenarios' : results }, json_file, indent=2)
+    print('{}/{} scenarios over budget.'.format(failed, len(results)))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -25,18 +25,21 @@
 # License    : GPLv2 (LICENSE.md / https://www.gnu.org/licenses/old-licenses/gpl-2.0.html)
 ########################################################################
 
-import pymssql
 import time
 import sys
-import tempfile
-try:
-    import cPickle as pickle
-except:
-    import pickle
 from optparse import OptionParser, OptionGroup
+from plugin_common import (STATUS_PREFIXES, SEVERITY, TIMER, NagiosReturn, threshold, is_within_range,
+                           driver_errors, BrokerConnection, LazyConnection, pack_values, unpack_values,
+                           state_store, snapshot_cache, query_rows, HISTORY_SLOTS, record_history,
+                           report_history, render_metrics, serve_exporter, CollectorHost)
 
-BASE_QUERY = "SELECT cntr_value FROM sys.sysperfinfo WHERE counter_name='%s' AND instance_name='%%s';"
-DIVI_QUERY = "SELECT cntr_value FROM sys.sysperfinfo WHERE counter_name LIKE '%s%%%%' AND instance_name='%%s';"
+#~ Driver module, imported by name only once the check talks to a server
+DRIVER = 'pymssql'
+
+SNAPSHOT_QUERY = "SELECT RTRIM(object_name), RTRIM(counter_name), RTRIM(instance_name), cntr_value FROM sys.sysperfinfo WHERE counter_name IN (%s) AND instance_name IN (%s)"
+ALL_DATABASES_QUERY = "SELECT RTRIM(object_name), RTRIM(counter_name), RTRIM(instance_name), cntr_value FROM sys.sysperfinfo WHERE counter_name IN (%s) AND RIGHT(RTRIM(object_name), 10) = ':Databases'"
+START_TIME_COUNTER = 'sqlserver_start_time'
+START_TIME_QUERY = " UNION ALL SELECT 'SQLServer:Server', '%s', '', DATEDIFF(s, '19700101', sqlserver_start_time) FROM sys.dm_os_sys_info" % START_TIME_COUNTER
 
 MODES = {
     
@@ -44,7 +47,7 @@ MODES = {
                             'stdout'    : 'Log Cache Hit Ratio is %s%%',
                             'label'     : 'log_cache_hit_ratio',
                             'unit'      : '%',
-                            'query'     : DIVI_QUERY % 'Log Cache Hit Ratio',
+                            'counter'   : 'Log Cache Hit Ratio',
                             'type'      : 'divide',
                             'modifier'  : 100,
                             },
@@ -53,14 +56,14 @@ MODES = {
                             'stdout'    : 'Active Transactions is %s',
                             'label'     : 'log_file_usage',
                             'unit'      : '',
-                            'query'     : BASE_QUERY % 'Active Transactions',
+                            'counter'   : 'Active Transactions',
                             'type'      : 'standard',
                             },
     
     'logflushes'         : { 'help'     : 'Log Flushes Per Second',
                             'stdout'    : 'Log Flushes Per Second is %s/sec',
                             'label'     : 'log_flushes_per_sec',
-                            'query'     : BASE_QUERY % 'Log Flushes/sec',
+                            'counter'   : 'Log Flushes/sec',
                             'type'      : 'delta'
                             },
     
@@ -68,35 +71,35 @@ MODES = {
                             'stdout'    : 'Log File Usage is %s%%',
                             'label'     : 'log_file_usage',
                             'unit'      : '%',
-                            'query'     : BASE_QUERY % 'Percent Log Used',
+                            'counter'   : 'Percent Log Used',
                             'type'      : 'standard',
                             },
     
     'transpsec'         : { 'help'      : 'Transactions Per Second',
                             'stdout'    : 'Transactions Per Second is %s/sec',
                             'label'     : 'transactions_per_sec',
-                            'query'     : BASE_QUERY % 'Transactions/sec',
+                            'counter'   : 'Transactions/sec',
                             'type'      : 'delta'
                             },
     
     'loggrowths'        : { 'help'      : 'Log Growths',
                             'stdout'    : 'Log Growths is %s',
                             'label'     : 'log_growths',
-                            'query'     : BASE_QUERY % 'Log Growths',
+                            'counter'   : 'Log Growths',
                             'type'      : 'standard'
                             },
     
     'logshrinks'        : { 'help'      : 'Log Shrinks',
                             'stdout'    : 'Log Shrinks is %s',
                             'label'     : 'log_shrinks',
-                            'query'     : BASE_QUERY % 'Log Shrinks',
+                            'counter'   : 'Log Shrinks',
                             'type'      : 'standard'
                             },
     
     'logtruncs'         : { 'help'      : 'Log Truncations',
                             'stdout'    : 'Log Truncations is %s',
                             'label'     : 'log_truncations',
-                            'query'     : BASE_QUERY % 'Log Truncations',
+                            'counter'   : 'Log Truncations',
                             'type'      : 'standard'
                             },
     
@@ -104,14 +107,14 @@ MODES = {
                             'stdout'    : 'Log Flush Wait Time is %sms',
                             'label'     : 'log_wait_time',
                             'unit'      : 'ms',
-                            'query'     : BASE_QUERY % 'Log Flush Wait Time',
+                            'counter'   : 'Log Flush Wait Time',
                             'type'      : 'standard'
                             },
     
     'datasize'          : { 'help'      : 'Database Size',
                             'stdout'    : 'Database size is %sKB',
                             'label'     : 'KB',
-                            'query'     : BASE_QUERY % 'Data File(s) Size (KB)',
+                            'counter'   : 'Data File(s) Size (KB)',
                             'type'      : 'standard'
                             },
     
@@ -120,145 +123,228 @@ MODES = {
     'test'              : { 'help'      : 'Run tests of all queries against the database.' },
 }
 
-def return_nagios(options, stdout='', result='', unit='', label=''):
-    invert = False
-    w = options.warning
-    c = options.critical
+SYSTEM_DATABASES = ('master', 'model', 'msdb', 'tempdb', 'mssqlsystemresource')
+
+def format_nagios(options, stdout='', result='', unit='', label='', note=None):
+    if result is None:
+        # Delta modes reseeding after their first run, a restart or a counter wrap, or an idle interval
+        stdout = stdout % 'unknown' + ' (%s)' % (note or 'new baseline sample')
+        return 0, stdout, '{}=U;{};{};;'.format(label, options.warning or '', options.critical or '')
 
-    # Check for ranges
-    if ':' in options.critical and ':' in options.warning:
-        c = options.critical.split(':')[1]
-        w = options.warning.split(':')[1]
+    critical = threshold(options.critical)
+    warning = threshold(options.warning)
 
     # Check if we should invert the warning/critical (this should change someday)
-    if int(c) < int(w):
-        invert = True
+    invert = critical is not None and warning is not None and critical.end < warning.end
 
     if is_within_range(options.critical, result, invert):
-        prefix = 'CRITICAL: '
         code = 2
     elif is_within_range(options.warning, result, invert):
-        prefix = 'WARNING: '
         code = 1
     else:
-        prefix = 'OK: '
         code = 0
 
     strresult = str(result)
     stdout = stdout % (strresult)
-    stdout = '{}{}|{}={}{};{};{};;'.format(prefix, stdout, label, strresult, unit, options.warning or '', options.critical or '')
-    raise NagiosReturn(stdout, code)
+    perfdata = '{}={}{};{};{};;'.format(label, strresult, unit, options.warning or '', options.critical or '')
+    return code, stdout, perfdata
 
-class NagiosReturn(Exception):
-    
-    def __init__(self, message, code):
-        self.message = message
-        self.code = code
+def return_nagios(options, stdout='', result='', unit='', label='', note=None):
+    code, stdout, perfdata = format_nagios(options, stdout, result, unit, label, note)
+    raise NagiosReturn('{}{}|{}'.format(STATUS_PREFIXES[code], stdout, TIMER.perfdata(perfdata)), code)
+
+def perf_label(database, label):
+    """Perfdata label of one database's value, quoted when the database name needs it."""
+    name = '%s_%s' % (database, label)
+    if any(c in name for c in " '="):
+        return "'%s'" % name.replace("'", "''")
+    return name
+
+def return_databases(options, results, total):
+    code = 0
+    counts = {}
+    problems = []
+    perfdata = []
+    for database, db_code, stdout, db_perfdata in results:
+        if SEVERITY[db_code] > SEVERITY[code]:
+            code = db_code
+        if db_code:
+            counts[db_code] = counts.get(db_code, 0) + 1
+            problems.append('%s: %s (%s)' % (database, stdout, STATUS_PREFIXES[db_code][:-2]))
+        if db_perfdata:
+            perfdata.append(db_perfdata)
+    name = MODES[options.mode]['help']
+    if code:
+        summary = ', '.join('%d %s' % (counts[c], STATUS_PREFIXES[c][:-2]) for c in (2, 3, 1) if c in counts)
+        stdout = '%s: %s of %d databases: %s' % (name, summary, total, ', '.join(problems))
+    else:
+        stdout = '%s of %d databases within thresholds' % (name, total)
+    raise NagiosReturn('{}{}|{}'.format(STATUS_PREFIXES[code], stdout, TIMER.perfdata(' '.join(perfdata))), code)
+
+class SysperfinfoSnapshot(object):
+    
+    def __init__(self, rows, fetched=None):
+        self.time = fetched
+        self.counters = {}
+        self.instances = {}
+        for object_name, counter_name, instance_name, value in rows:
+            key = (counter_name.strip().lower(), instance_name.strip().lower())
+            self.counters.setdefault(key, []).append(value)
+            if counter_name != START_TIME_COUNTER:
+                self.instances[key[1]] = instance_name.strip()
+    
+    @classmethod
+    def fetch(cls, connection, counters, instances, cache=None):
+        """Fetch counters of the given instances, or of every database when instances is None."""
+        names = sorted(set(counter.lower() for counter in counters if counter != START_TIME_COUNTER))
+        if instances is None:
+            instances = []
+            query = ALL_DATABASES_QUERY % ', '.join(['%s'] * len(names))
+        else:
+            instances = sorted(set(instances))
+            query = SNAPSHOT_QUERY % (', '.join(['%s'] * len(names)), ', '.join(['%s'] * len(instances)))
+        if START_TIME_COUNTER in counters:
+            query += START_TIME_QUERY
+        rows, fetched = query_rows(connection, query + ';', tuple(names + instances), cache)
+        return cls(rows, fetched)
+    
+    def databases(self):
+        return sorted(self.instances.values(), key=str.lower)
+    
+    def get(self, counter, instance):
+        values = self.counters.get((counter.lower(), instance.lower()))
+        if not values:
+            raise Exception('Counter %s (%s) not found in sysperfinfo.' % (counter, instance))
+        return values[0]
 
 class MSSQLQuery(object):
     
-    def __init__(self, query, options, label='', unit='', stdout='', host='', modifier=1, *args, **kwargs):
-        self.query = query % options.table
+    def __init__(self, counter, options, label='', unit='', stdout='', host='', modifier=1, instance=None, *args, **kwargs):
+        self.counter = counter
+        self.instance = options.table if instance is None else instance
         self.label = label
         self.unit = unit
         self.stdout = stdout
         self.options = options
         self.host = host
         self.modifier = modifier
+        self.sample_time = None
+        self.note = None
+    
+    def counters(self):
+        return [self.counter]
     
     def run_on_connection(self, connection):
-        cur = connection.cursor()
-        cur.execute(self.query)
-        self.query_result = cur.fetchone()[0]
+        cache = snapshot_cache(DRIVER, self.options, self.host)
+        #~ A cached snapshot holds every counter, so one entry answers all of the database's services
+        counters = all_counters(self.options) if cache else self.counters()
+        self.run_on_snapshot(SysperfinfoSnapshot.fetch(connection, counters, [self.instance], cache))
+    
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.time
+        self.query_result = snapshot.get(self.counter, self.instance)
+    
+    def state_key(self):
+        return '%s|%s' % (self.counter, self.instance)
+    
+    def evaluate(self, label=None):
+        return format_nagios(   self.options,
+                                self.stdout,
+                                self.result,
+                                self.unit,
+                                label or self.label,
+                                self.note )
     
     def finish(self):
         return_nagios(  self.options,
                         self.stdout,
                         self.result,
                         self.unit,
-                        self.label )
+                        self.label,
+                        self.note )
     
     def calculate_result(self):
         self.result = float(self.query_result) * self.modifier
     
+    def history_key(self):
+        return self.state_key()
+    
+    def record(self):
+        """Append the result to the host's --history ring of this counter and database."""
+        record_history(DRIVER, self.options, self.host, self.history_key(), self.label, self.sample_time, self.result)
+    
     def do(self, connection):
-        self.run_on_connection(connection)
+        with TIMER.phase('query', self.label):
+            self.run_on_connection(connection)
         self.calculate_result()
+        self.record()
         self.finish()
 
 class MSSQLDivideQuery(MSSQLQuery):
     
+    def __init__(self, base=None, *args, **kwargs):
+        super(MSSQLDivideQuery, self).__init__(*args, **kwargs)
+        self.base = base or '%s Base' % self.counter
+    
     def calculate_result(self):
-        if self.query_result[1] == 0:
+        value, base = float(self.query_result[0]), float(self.query_result[1])
+        if not self.options.since_startup:
+            self.result = self.interval_ratio(value, base)
+            if self.result is not None or self.note:
+                return
+            self.stdout += ' (since startup)'
+        if base == 0:
             self.result = 0
         else:
-            self.result = (float(self.query_result[0]) / self.query_result[1]) * self.modifier
+            self.result = (value / base) * self.modifier
     
-    def run_on_connection(self, connection):
-        cur = connection.cursor()
-        cur.execute(self.query)
-        self.query_result = [x[0] for x in cur.fetchall()]
+    def interval_ratio(self, value, base):
+        """The ratio of what value and base gained since the previous run, or None without one.
+        
+        None with a note means the interval had no lookups; None without one means there is no
+        usable previous sample and the caller falls back to the ratio since startup.
+        """
+        now, last_run = state_store(DRIVER, self.host).exchange(self.state_key(), pack_values([value, base, self.start_time]), self.sample_time)
+        if not last_run:
+            return None
+        old_time, last_values = last_run[0], unpack_values(last_run[1])
+        #~ The server restarted or the counters went backwards, so this run starts a new series
+        if len(last_values) != 3 or last_values[2] != self.start_time or last_values[1] > base or last_values[0] > value:
+            return None
+        if old_time >= now or last_values[1] == base:
+            #~ No lookups since the previous run (or the same cached sample twice): there is no ratio to report
+            self.note = 'no activity since the previous run'
+            return None
+        return ((value - last_values[0]) / (base - last_values[1])) * self.modifier
+    
+    def counters(self):
+        return [self.counter, self.base, START_TIME_COUNTER]
+    
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.time
+        self.query_result = [   snapshot.get(self.counter, self.instance),
+                                snapshot.get(self.base, self.instance) ]
+        self.start_time = snapshot.get(START_TIME_COUNTER, '')
 
 class MSSQLDeltaQuery(MSSQLQuery):
     
-    def make_pickle_name(self):
-        tmpdir = tempfile.gettempdir()
-        tmpname = hash(self.host + self.options.table + self.query)
-        self.picklename = '{}/mssql-{}.tmp'.format(tmpdir, tmpname)
+    def counters(self):
+        return [self.counter, START_TIME_COUNTER]
+    
+    def run_on_snapshot(self, snapshot):
+        super(MSSQLDeltaQuery, self).run_on_snapshot(snapshot)
+        self.start_time = snapshot.get(START_TIME_COUNTER, '')
     
     def calculate_result(self):
-        self.make_pickle_name()
+        new_val = float(self.query_result)
+        now, last_run = state_store(DRIVER, self.host).exchange(self.state_key(), pack_values([new_val, self.start_time]), self.sample_time)
+        self.result = None
         
-        try:
-            tmpfile = open(self.picklename)
-        except IOError:
-            tmpfile = open(self.picklename, 'w')
-            tmpfile.close()
-            tmpfile = open(self.picklename)
-        try:
-            try:
-                last_run = pickle.load(tmpfile)
-            except EOFError as ValueError:
-                last_run = { 'time' : None, 'value' : None }
-        finally:
-            tmpfile.close()
-        
-        if last_run['time']:
-            old_time = last_run['time']
-            new_time = time.time()
-            old_val  = last_run['query_result']
-            new_val  = self.query_result
-            self.result = ((new_val - old_val) / (new_time - old_time)) * self.modifier
-        else:
-            self.result = 0
-        
-        new_run = { 'time' : time.time(), 'query_result' : self.query_result }
-        
-        #~ Will throw IOError, leaving it to acquiesce
-        tmpfile = open(self.picklename, 'w')
-        pickle.dump(new_run, tmpfile)
-        tmpfile.close()
-
-def is_within_range(nagstring, value, invert = False):
-    if not nagstring:
-        return False
-    import re
-    import operator
-    first_float = r'(?P<first>(-?[0-9]+(\.[0-9]+)?))'
-    second_float= r'(?P<second>(-?[0-9]+(\.[0-9]+)?))'
-    actions = [ (r'^{}$'.format(first_float),lambda y: (value > float(y.group('first'))) or (value < 0)),
-                (r'^{}:$'.format(first_float),lambda y: value < float(y.group('first'))),
-                (r'^~:{}$'.format(first_float),lambda y: value > float(y.group('first'))),
-                (r'^{}:{}$'.format(first_float,second_float), lambda y: (value < float(y.group('first'))) or (value > float(y.group('second')))),
-                (r'^@{}:{}$'.format(first_float,second_float), lambda y: not((value < float(y.group('first'))) or (value > float(y.group('second')))))]
-    for regstr,func in actions:
-        res = re.match(regstr,nagstring)
-        if res: 
-            if invert:
-                return not func(res)
-            else:
-                return func(res)
-    raise Exception('Improper warning/critical format.')
+        if last_run:
+            old_time, last_values = last_run[0], unpack_values(last_run[1])
+            #~ Reseed silently after a server restart or when the counter went backwards
+            if len(last_values) == 2 and last_values[1] == self.start_time and last_values[0] <= new_val and old_time < now:
+                self.result = ((new_val - last_values[0]) / (now - old_time)) * self.modifier
 
 def parse_args():
     usage = "usage: %prog -H hostname -U user -P password -T table --mode"
@@ -271,16 +357,41 @@ def parse_args():
     required.add_option('-T', '--table', help='Specify the table to check', default=None) 
     parser.add_option_group(required)
     
+    databases = OptionGroup(parser, "Database Selection")
+    databases.add_option('--all-databases', action='store_true', help='Check every database in one query instead of -T.', default=False)
+    databases.add_option('--database-pattern', help='Check every database whose name matches this shell pattern, e.g. "app_*".', default=None)
+    databases.add_option('--exclude', action='append', help='Skip databases matching this shell pattern (repeatable).', default=[])
+    databases.add_option('--exclude-system', action='store_true', help='Skip %s.' % ', '.join(SYSTEM_DATABASES), default=False)
+    parser.add_option_group(databases)
+    
     connection = OptionGroup(parser, "Optional Connection Information")
     connection.add_option('-I', '--instance', help='Specify instance', default=None)
     connection.add_option('-p', '--port', help='Specify port.', default=None)
+    connection.add_option('--broker', help='Borrow a pooled connection from check_mssql_server.py --collector listening on this Unix socket.', default=None)
     parser.add_option_group(connection)
     
     nagios = OptionGroup(parser, "Nagios Plugin Information")
     nagios.add_option('-w', '--warning', help='Specify warning range.', default=None)
     nagios.add_option('-c', '--critical', help='Specify critical range.', default=None)
+    nagios.add_option('--since-startup', action='store_true', help='Report hit ratios averaged since the server started instead of over the last interval.', default=False)
+    nagios.add_option('--timing', action='store_true', help='Append per-phase durations (import_ms, connect_ms, query_ms, state_ms) to the perfdata.', default=False)
     parser.add_option_group(nagios)
     
+    cache = OptionGroup(parser, "Cache Options")
+    cache.add_option('--cache-ttl', type='int', help='Share query results with the other checks of this host for this many seconds (default: 0, off).', default=0)
+    parser.add_option_group(cache)
+    
+    history = OptionGroup(parser, "History Options")
+    history.add_option('--history', action='store_true', help='Append every result to a fixed-size ring of this host, counter and database in the temporary directory.', default=False)
+    history.add_option('--history-size', type='int', help='Samples kept by a new --history ring (default: %s, a week of one-minute checks).' % HISTORY_SLOTS, default=HISTORY_SLOTS)
+    history.add_option('--history-dump', action='store_true', help='Print the --history samples of the mode for -T instead of checking it.', default=False)
+    parser.add_option_group(history)
+    
+    exporter = OptionGroup(parser, "Exporter Options")
+    exporter.add_option('--exporter', help='Serve the counters of every selected database (or only the chosen mode) as Prometheus metrics on this host:port.', default=None)
+    exporter.add_option('--exporter-interval', type='int', help='Seconds between the polls of --exporter (default: 60).', default=60)
+    parser.add_option_group(exporter)
+    
     mode = OptionGroup(parser, "Mode Options")
     global MODES
     for k, v in zip(list(MODES.keys()), list(MODES.values())):
@@ -294,7 +405,10 @@ def parse_args():
         parser.error('User is a required option.')
     if not options.password:
         parser.error('Password is a required option.')
-    if not options.table:
+    options.all_databases = options.all_databases or bool(options.database_pattern)
+    if options.exporter and options.exporter_interval < 1:
+        parser.error('Exporter interval must be at least 1.')
+    if not options.table and not options.all_databases and not options.exporter:
         parser.error('Table is a required option.')
     
     if options.instance and options.port:
@@ -307,23 +421,63 @@ def parse_args():
         elif getattr(options, arg.dest):
             options.mode = arg.dest
     
+    if options.history_dump and (options.mode in (None, 'time2connect', 'test') or options.all_databases or options.exporter):
+        parser.error('--history-dump needs a counter mode and -T.')
+    if options.history and options.history_size < 1:
+        parser.error('History size must be at least 1.')
+    
+    if options.exporter:
+        if options.mode in ('time2connect', 'test'):
+            parser.error('--exporter needs a counter mode or none for all of them.')
+        options.table = options.table or 'master'
+    elif options.all_databases:
+        if options.mode in (None, 'time2connect', 'test'):
+            parser.error('--all-databases needs a counter mode.')
+        #~ Only used to log in, the counters of every database are visible from any of them
+        options.table = options.table or 'master'
+    
     return options
 
-def connect_db(options):
+def server_address(options):
     host = options.hostname
     if options.instance:
         host += "\\" + options.instance
     elif options.port:
         host += ":" + options.port
+    return host
+
+def connect_db(options):
+    host = server_address(options)
+    if options.broker:
+        start = time.time()
+        connect = { 'host' : host, 'user' : options.user, 'password' : options.password, 'database' : options.table }
+        with TIMER.phase('connect', 'broker'):
+            mssql = BrokerConnection(DRIVER, options.broker, connect)
+        return mssql, time.time() - start, host
+    # Imported before the clock starts so time2connect does not include loading the driver
+    with TIMER.phase('import'):
+        import pymssql
     start = time.time()
-    mssql = pymssql.connect(host = host, user = options.user, password = options.password, database=options.table)
+    with TIMER.phase('connect', host):
+        mssql = pymssql.connect(host = host, user = options.user, password = options.password, database=options.table)
     total = time.time() - start
     return mssql, total, host
 
 def main():
     options = parse_args()
+    TIMER.report = options.timing
     
-    mssql, total, host = connect_db(options)
+    if options.exporter:
+        run_exporter(options)
+        return
+    
+    if options.history_dump:
+        dump_history(options)
+    
+    if options.cache_ttl and options.mode not in (None, 'time2connect', 'test'):
+        mssql, total, host = LazyConnection(options, connect_db), None, server_address(options)
+    else:
+        mssql, total, host = connect_db(options)
     
     if options.mode =='test':
         run_tests(mssql, options, host)
@@ -335,21 +489,110 @@ def main():
                         unit='s',
                         result=total )
                         
+    elif options.all_databases:
+        execute_databases(mssql, options, host)
+                        
     else:
         execute_query(mssql, options, host)
 
-def execute_query(mssql, options, host=''):
-    sql_query = MODES[options.mode]
-    sql_query['options'] = options
-    sql_query['host'] = host
+def make_query(options, mode, host='', instance=None):
+    sql_query = dict(MODES[mode], options=options, host=host, instance=instance)
     query_type = sql_query.get('type')
     if query_type == 'delta':
-        mssql_query = MSSQLDeltaQuery(**sql_query)
+        return MSSQLDeltaQuery(**sql_query)
     elif query_type == 'divide':
-        mssql_query = MSSQLDivideQuery(**sql_query)
+        return MSSQLDivideQuery(**sql_query)
     else:
-        mssql_query = MSSQLQuery(**sql_query)
-    mssql_query.do(mssql)
+        return MSSQLQuery(**sql_query)
+
+def all_counters(options):
+    return [counter for mode in MODES if MODES[mode].get('counter') for counter in make_query(options, mode).counters()]
+
+def dump_history(options):
+    """Print the --history samples of the mode for the database, oldest first, without connecting."""
+    host = server_address(options)
+    key = make_query(options, options.mode, host).history_key()
+    report_history(DRIVER, host, key, '%s for %s on %s' % (options.mode, options.table, host))
+
+def execute_query(mssql, options, host=''):
+    make_query(options, options.mode, host).do(mssql)
+
+def database_selected(options, database):
+    import fnmatch
+    name = database.lower()
+    if name == '_total':
+        return False
+    if options.exclude_system and name in SYSTEM_DATABASES:
+        return False
+    if any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in options.exclude):
+        return False
+    return not options.database_pattern or fnmatch.fnmatchcase(name, options.database_pattern.lower())
+
+def execute_databases(mssql, options, host=''):
+    """Evaluate the mode for every selected database from one sysperfinfo snapshot."""
+    cache = snapshot_cache(DRIVER, options, host)
+    counters = all_counters(options) if cache else make_query(options, options.mode, host).counters()
+    with TIMER.phase('query', 'sysperfinfo'):
+        snapshot = SysperfinfoSnapshot.fetch(mssql, counters, None, cache)
+    databases = [database for database in snapshot.databases() if database_selected(options, database)]
+    if not databases:
+        raise NagiosReturn('UNKNOWN: No database matches the selection.', 3)
+    results = []
+    for database in databases:
+        mssql_query = make_query(options, options.mode, host, database)
+        try:
+            mssql_query.run_on_snapshot(snapshot)
+            mssql_query.calculate_result()
+            mssql_query.record()
+            results.append((database,) + mssql_query.evaluate(perf_label(database, mssql_query.label)))
+        except Exception as e:
+            results.append((database, 3, str(e), ''))
+    return_databases(options, results, len(databases))
+
+class DatabaseResults(object):
+    """The results of one mode for every selected database, kept by the exporter's CollectorHost as that mode's result."""
+    def __init__(self):
+        self.result = {}
+
+def collect_databases(mssql, options, modes, host=''):
+    """Evaluate the modes for every selected database from one sysperfinfo snapshot, as (mode, results, error) tuples."""
+    counters = [counter for mode in modes for counter in make_query(options, mode, host).counters()]
+    snapshot = SysperfinfoSnapshot.fetch(mssql, counters, None)
+    collected = [(mode, DatabaseResults(), None) for mode in modes]
+    for database in snapshot.databases():
+        if not database_selected(options, database):
+            continue
+        for mode, results, error in collected:
+            mssql_query = make_query(options, mode, host, database)
+            try:
+                mssql_query.run_on_snapshot(snapshot)
+                mssql_query.calculate_result()
+                mssql_query.record()
+            except Exception:
+                continue
+            if mssql_query.result is not None:
+                results.result[database] = mssql_query.result
+    return collected
+
+def exporter_connect(options):
+    return connect_db(options)[0]
+
+class DatabaseExporter(CollectorHost):
+    """Polls the counter modes of every selected database for --exporter, from one sysperfinfo snapshot per interval."""
+    
+    def __init__(self, options, modes):
+        super(DatabaseExporter, self).__init__(options, modes, options.exporter_interval, server_address(options),
+                                               exporter_connect, collect_databases)
+    
+    def samples(self, mode, collected):
+        #~ Named after the mode, some modes share a perfdata label
+        for database, value in sorted((collected['result'] or {}).items()):
+            yield mode, { 'database' : database }, value
+
+def run_exporter(options):
+    modes = [options.mode] if options.mode else [mode for mode in MODES if MODES[mode].get('counter')]
+    exporter = DatabaseExporter(options, modes)
+    serve_exporter(options.exporter, lambda: render_metrics('mssql_database', [exporter], MODES), exporter)
 
 def run_tests(mssql, options, host):
     failed = 0
@@ -369,9 +612,10 @@ def run_tests(mssql, options, host):
     print('{}/{} tests failed.'.format(failed, total))
     
 if __name__ == '__main__':
+    TIMER.install_hooks()
     try:
         main()
-    except pymssql.OperationalError as e:
+    except driver_errors(DRIVER) as e:
         print(e)
         sys.exit(3)
     except IOError as e:
@@ -25,30 +25,86 @@
 # License    : GPLv2 (LICENSE.md / https://www.gnu.org/licenses/old-licenses/gpl-2.0.html)
 ########################################################################
 
-import pymssql
 import time
 import sys
-import tempfile
-try:
-    import cPickle as pickle
-except:
-    import pickle
+import struct
 from optparse import OptionParser, OptionGroup
+from plugin_common import (STATUS_PREFIXES, SEVERITY, nagios_output, return_batch, TIMER, NagiosReturn,
+                           is_within_range, spool_results, driver_errors, BrokerConnection, LazyConnection,
+                           pack_values, unpack_values, state_store, snapshot_cache, query_rows, HISTORY_SLOTS,
+                           record_history, report_history, render_metrics, serve_exporter, CollectorHost,
+                           run_collector, collector_request)
 
-BASE_QUERY = "SELECT cntr_value FROM sysperfinfo WHERE counter_name='{}' AND instance_name='';"
-INST_QUERY = "SELECT cntr_value FROM sysperfinfo WHERE counter_name='{}' AND instance_name='{}';"
-OBJE_QUERY = "SELECT cntr_value FROM sysperfinfo WHERE counter_name='{}';"
-DIVI_QUERY = "SELECT cntr_value FROM sysperfinfo WHERE counter_name LIKE '{}%' AND instance_name='{}';"
+#~ Driver module, imported by name only once the check talks to a server
+DRIVER = 'pymssql'
+
+SNAPSHOT_QUERY = "SELECT RTRIM(object_name), RTRIM(counter_name), RTRIM(instance_name), cntr_value, cntr_type FROM sysperfinfo WHERE counter_name IN ({})"
+START_TIME_COUNTER = 'sqlserver_start_time'
+START_TIME_QUERY = " UNION ALL SELECT 'SQLServer:Server', '{}', '', DATEDIFF(s, '19700101', sqlserver_start_time), 65792 FROM sys.dm_os_sys_info".format(START_TIME_COUNTER)
+
+#~ How each cntr_type is evaluated, as (query type, unit, modifier)
+COUNTER_TYPES = {
+    65536       : ('standard',  '',     1),     #~ PERF_COUNTER_RAWCOUNT
+    65792       : ('standard',  '',     1),     #~ PERF_COUNTER_LARGE_RAWCOUNT
+    272696320   : ('delta',     '/sec', 1),     #~ PERF_COUNTER_COUNTER
+    272696576   : ('delta',     '/sec', 1),     #~ PERF_COUNTER_BULK_COUNT
+    537003264   : ('divide',    '%',    100),   #~ PERF_LARGE_RAW_FRACTION
+    1073874176  : ('divide',    '',     1),     #~ PERF_AVERAGE_BULK
+}
+BASE_COUNTER_TYPE = 1073939712
 CON_QUERY = "SELECT count(*) FROM master..sysprocesses WHERE spid >= 51"
 MEM_QUERY = "SELECT 100*(1.0-(available_physical_memory_kb/(total_physical_memory_kb*1.0))) FROM sys.dm_os_sys_memory;" 
+#~ Only the newest records are converted to XML, the ring buffer keeps one per minute for about four hours
 CPU_QUERY = "SELECT "\
-    "record.value('(./Record/SchedulerMonitorEvent/SystemHealth/ProcessUtilization)[1]', 'int') AS [CPU] "\
+    "record.value('(./Record/SchedulerMonitorEvent/SystemHealth/ProcessUtilization)[1]', 'int') AS [CPU], "\
+    "record.value('(./Record/SchedulerMonitorEvent/SystemHealth/SystemIdle)[1]', 'int') AS [Idle] "\
     "FROM ( "\
-        "SELECT[timestamp], CONVERT(XML, record) AS [record] "\
+        "SELECT TOP ({}) [timestamp], CONVERT(XML, record) AS [record] "\
             "FROM sys.dm_os_ring_buffers WITH ( NOLOCK ) "\
             "WHERE ring_buffer_type=N'RING_BUFFER_SCHEDULER_MONITOR' "\
-            "AND record LIKE N'%<SystemHealth>%'"\
-    ") as x;"
+            "AND record LIKE N'%<SystemHealth>%' "\
+            "ORDER BY [timestamp] DESC"\
+    ") as x ORDER BY [timestamp] DESC;"
+CPU_RECORDS = 256
+#~ Idle, queue and background waits that say nothing about the workload
+BENIGN_WAITS = (
+    'BROKER_EVENTHANDLER', 'BROKER_RECEIVE_WAITFOR', 'BROKER_TASK_STOP', 'BROKER_TO_FLUSH', 'BROKER_TRANSMITTER',
+    'CHECKPOINT_QUEUE', 'CHKPT', 'CLR_AUTO_EVENT', 'CLR_MANUAL_EVENT', 'CLR_SEMAPHORE',
+    'DBMIRROR_DBM_EVENT', 'DBMIRROR_EVENTS_QUEUE', 'DBMIRROR_WORKER_QUEUE', 'DBMIRRORING_CMD',
+    'DIRTY_PAGE_POLL', 'DISPATCHER_QUEUE_SEMAPHORE', 'EXECSYNC', 'FSAGENT',
+    'FT_IFTS_SCHEDULER_IDLE_WAIT', 'FT_IFTSHC_MUTEX',
+    'HADR_CLUSAPI_CALL', 'HADR_FILESTREAM_IOMGR_IOCOMPLETION', 'HADR_LOGCAPTURE_WAIT',
+    'HADR_NOTIFICATION_DEQUEUE', 'HADR_TIMER_TASK', 'HADR_WORK_QUEUE',
+    'KSOURCE_WAKEUP', 'LAZYWRITER_SLEEP', 'LOGMGR_QUEUE', 'MEMORY_ALLOCATION_EXT',
+    'ONDEMAND_TASK_QUEUE', 'PARALLEL_REDO_DRAIN_WORKER', 'PARALLEL_REDO_LOG_CACHE', 'PARALLEL_REDO_TRAN_LIST',
+    'PARALLEL_REDO_WORKER_SYNC', 'PARALLEL_REDO_WORKER_WAIT_WORK', 'PREEMPTIVE_OS_FLUSHFILEBUFFERS',
+    'PREEMPTIVE_XE_GETTARGETSTATE', 'PVS_PREALLOCATE', 'PWAIT_ALL_COMPONENTS_INITIALIZED',
+    'PWAIT_DIRECTLOGCONSUMER_GETNEXT', 'PWAIT_EXTENSIBILITY_CLEANUP_TASK',
+    'QDS_ASYNC_QUEUE', 'QDS_CLEANUP_STALE_QUERIES_TASK_MAIN_LOOP_SLEEP', 'QDS_PERSIST_TASK_MAIN_LOOP_SLEEP',
+    'QDS_SHUTDOWN_QUEUE', 'REDO_THREAD_PENDING_WORK', 'REQUEST_FOR_DEADLOCK_SEARCH', 'RESOURCE_QUEUE',
+    'SERVER_IDLE_CHECK', 'SLEEP_BPOOL_FLUSH', 'SLEEP_DBSTARTUP', 'SLEEP_DCOMSTARTUP',
+    'SLEEP_MASTERDBREADY', 'SLEEP_MASTERMDREADY', 'SLEEP_MASTERUPGRADED', 'SLEEP_MSDBSTARTUP',
+    'SLEEP_SYSTEMTASK', 'SLEEP_TASK', 'SLEEP_TEMPDBSTARTUP', 'SNI_HTTP_ACCEPT', 'SOS_WORK_DISPATCHER',
+    'SP_SERVER_DIAGNOSTICS_SLEEP', 'SQLTRACE_BUFFER_FLUSH', 'SQLTRACE_INCREMENTAL_FLUSH_SLEEP',
+    'SQLTRACE_WAIT_ENTRIES', 'UCS_SESSION_REGISTRATION', 'VDI_CLIENT_OTHER', 'WAIT_FOR_RESULTS',
+    'WAIT_XTP_CKPT_CLOSE', 'WAIT_XTP_HOST_WAIT', 'WAIT_XTP_OFFLINE_CKPT_NEW_LOG', 'WAIT_XTP_RECOVERY',
+    'WAITFOR', 'WAITFOR_TASKSHUTDOWN', 'XE_BUFFERMGR_ALLPROCESSED_EVENT', 'XE_DISPATCHER_JOIN',
+    'XE_DISPATCHER_WAIT', 'XE_LIVE_TARGET_TVF', 'XE_TIMER_EVENT',
+)
+#~ The benign waits are passed as parameters, the server start time tells a restart from a cleared DMV
+WAITSTATS_QUERY = "SELECT wait_type, wait_time_ms, signal_wait_time_ms FROM sys.dm_os_wait_stats "\
+    "WHERE wait_time_ms > 0 AND wait_type NOT IN ({}) "\
+    "UNION ALL SELECT '{}', DATEDIFF(s, '19700101', sqlserver_start_time), 0 FROM sys.dm_os_sys_info;".format(
+        ', '.join(['%s'] * len(BENIGN_WAITS)), START_TIME_COUNTER)
+WAIT_TOP = 5
+#~ {} is the volume column, the mount point from sys.dm_os_volume_stats with --by-volume
+FILESTATS_QUERY = "SELECT s.database_id, s.file_id, DB_NAME(s.database_id), f.physical_name, {}, "\
+    "s.num_of_reads, s.num_of_bytes_read, s.io_stall_read_ms, s.num_of_writes, s.num_of_bytes_written, s.io_stall_write_ms "\
+    "FROM sys.dm_io_virtual_file_stats(NULL, NULL) AS s "\
+    "JOIN sys.master_files AS f ON f.database_id = s.database_id AND f.file_id = s.file_id{} "\
+    "UNION ALL SELECT 0, 0, '{}', NULL, NULL, DATEDIFF(s, '19700101', sqlserver_start_time), 0, 0, 0, 0, 0 FROM sys.dm_os_sys_info;"
+VOLUME_APPLY = " CROSS APPLY sys.dm_os_volume_stats(s.database_id, s.file_id) AS v"
+FILE_MIN_IOS = 10
     
 MODES = {
 
@@ -65,9 +121,11 @@ MODES = {
                             'query'     : MEM_QUERY
                             },
 
-    'cpu'               : { 'help'      : 'Server CPU utilization',
+    'cpu'               : { 'help'      : 'Server CPU utilization (newest sample, or see --window)',
                             'stdout'    : 'Current CPU utilization is {}%',
-                            'label'    : 'cpu',
+                            'label'     : 'cpu',
+                            'unit'      : '%',
+                            'type'      : 'cpu',
                             'query'     : CPU_QUERY
                             },
 
@@ -75,7 +133,8 @@ MODES = {
                             'stdout'    : 'Buffer Cache Hit Ratio is {}%',
                             'label'     : 'buffer_cache_hit_ratio',
                             'unit'      : '%',
-                            'query'     : DIVI_QUERY.format('Buffer cache hit ratio', ''),
+                            'counter'   : 'Buffer cache hit ratio',
+                            'instance'  : '',
                             'type'      : 'divide',
                             'modifier'  : 100,
                             },
@@ -83,7 +142,8 @@ MODES = {
     'pagelooks'         : { 'help'      : 'Page Lookups Per Second',
                             'stdout'    : 'Page Lookups Per Second is {}',
                             'label'     : 'page_lookups',
-                            'query'     : BASE_QUERY.format('Page lookups/sec'),
+                            'counter'   : 'Page lookups/sec',
+                            'instance'  : '',
                             'type'      : 'delta'
                             },
     
@@ -91,48 +151,55 @@ MODES = {
                             'stdout'    : 'Free pages is {}',
                             'label'     : 'free_pages',
                             'type'      : 'standard',
-                            'query'     : BASE_QUERY.format('Free pages')
+                            'counter'   : 'Free pages',
+                            'instance'  : ''
                             },
                             
     'totalpages'        : { 'help'      : 'Total Pages (Cumulative)',
                             'stdout'    : 'Total pages is {}',
                             'label'     : 'totalpages',
                             'type'      : 'standard',
-                            'query'     : BASE_QUERY.format('Total pages'),
+                            'counter'   : 'Total pages',
+                            'instance'  : '',
                             },
                             
     'targetpages'       : { 'help'      : 'Target Pages',
                             'stdout'    : 'Target pages are {}',
                             'label'     : 'target_pages',
                             'type'      : 'standard',
-                            'query'     : BASE_QUERY.format('Target pages'),
+                            'counter'   : 'Target pages',
+                            'instance'  : '',
                             },
                             
     'databasepages'     : { 'help'      : 'Database Pages',
                             'stdout'    : 'Database pages are {}',
                             'label'     : 'database_pages',
                             'type'      : 'standard',
-                            'query'     : BASE_QUERY.format('Database pages'),
+                            'counter'   : 'Database pages',
+                            'instance'  : '',
                             },
     
     'stolenpages'       : { 'help'      : 'Stolen Pages',
                             'stdout'    : 'Stolen pages are {}',
                             'label'     : 'stolen_pages',
                             'type'      : 'standard',
-                            'query'     : BASE_QUERY.format('Stolen pages'),
+                            'counter'   : 'Stolen pages',
+                            'instance'  : '',
                             },
     
     'lazywrites'        : { 'help'      : 'Lazy Writes / Sec',
                             'stdout'    : 'Lazy Writes / Sec is {}/sec',
                             'label'     : 'lazy_writes',
-                            'query'     : BASE_QUERY.format('Lazy writes/sec'),
+                            'counter'   : 'Lazy writes/sec',
+                            'instance'  : '',
                             'type'      : 'delta'
                             },
     
     'readahead'         : { 'help'      : 'Readahead Pages / Sec',
                             'stdout'    : 'Readahead Pages / Sec is {}/sec',
                             'label'     : 'readaheads',
-                            'query'     : BASE_QUERY.format('Readahead pages/sec'),
+                            'counter'   : 'Readahead pages/sec',
+                            'instance'  : '',
                             'type'      : 'delta',
                             },
                             
@@ -140,14 +207,16 @@ MODES = {
     'pagereads'         : { 'help'      : 'Page Reads / Sec',
                             'stdout'    : 'Page Reads / Sec is {}/sec',
                             'label'     : 'page_reads',
-                            'query'     : BASE_QUERY.format('Page reads/sec'),
+                            'counter'   : 'Page reads/sec',
+                            'instance'  : '',
                             'type'      : 'delta'
                             },
     
     'checkpoints'       : { 'help'      : 'Checkpoint Pages / Sec',
                             'stdout'    : 'Checkpoint Pages / Sec is {}/sec',
                             'label'     : 'checkpoint_pages',
-                            'query'     : BASE_QUERY.format('Checkpoint pages/Sec'),
+                            'counter'   : 'Checkpoint pages/Sec',
+                            'instance'  : '',
                             'type'      : 'delta'
                             },
                             
@@ -155,35 +224,40 @@ MODES = {
     'pagewrites'        : { 'help'      : 'Page Writes / Sec',
                             'stdout'    : 'Page Writes / Sec is {}/sec',
                             'label'     : 'page_writes',
-                            'query'     : BASE_QUERY.format('Page writes/sec'),
+                            'counter'   : 'Page writes/sec',
+                            'instance'  : '',
                             'type'      : 'delta',
                             },
     
     'lockrequests'      : { 'help'      : 'Lock Requests / Sec',
                             'stdout'    : 'Lock Requests / Sec is {}/sec',
                             'label'     : 'lock_requests',
-                            'query'     : INST_QUERY.format('Lock requests/sec', '_Total'),
+                            'counter'   : 'Lock requests/sec',
+                            'instance'  : '_Total',
                             'type'      : 'delta',
                             },
     
     'locktimeouts'      : { 'help'      : 'Lock Timeouts / Sec',
                             'stdout'    : 'Lock Timeouts / Sec is {}/sec',
                             'label'     : 'lock_timeouts',
-                            'query'     : INST_QUERY.format('Lock timeouts/sec', '_Total'),
+                            'counter'   : 'Lock timeouts/sec',
+                            'instance'  : '_Total',
                             'type'      : 'delta',
                             },
     
     'deadlocks'         : { 'help'      : 'Deadlocks / Sec',
                             'stdout'    : 'Deadlocks / Sec is {}/sec',
                             'label'     : 'deadlocks',
-                            'query'     : INST_QUERY.format('Number of Deadlocks/sec', '_Total'),
+                            'counter'   : 'Number of Deadlocks/sec',
+                            'instance'  : '_Total',
                             'type'      : 'delta',
                             },
     
     'lockwaits'         : { 'help'      : 'Lockwaits / Sec',
                             'stdout'    : 'Lockwaits / Sec is {}/sec',
                             'label'     : 'lockwaits',
-                            'query'     : INST_QUERY.format('Lock Waits/sec', '_Total'),
+                            'counter'   : 'Lock Waits/sec',
+                            'instance'  : '_Total',
                             'type'      : 'delta',
                             },
     
@@ -191,7 +265,8 @@ MODES = {
                             'stdout'    : 'Lock Wait Time (ms) is {}ms',
                             'label'     : 'lockwait',
                             'unit'      : 'ms',
-                            'query'     : INST_QUERY.format('Lock Wait Time (ms)', '_Total'),
+                            'counter'   : 'Lock Wait Time (ms)',
+                            'instance'  : '_Total',
                             'type'      : 'standard',
                             },
     
@@ -199,21 +274,40 @@ MODES = {
                             'stdout'    : 'Average Wait Time (ms) is {}ms',
                             'label'     : 'averagewait',
                             'unit'      : 'ms',
-                            'query'     : DIVI_QUERY.format('Average Wait Time', '_Total'),
+                            'counter'   : 'Average Wait Time (ms)',
+                            'base'      : 'Average Wait Time Base',
+                            'instance'  : '_Total',
                             'type'      : 'divide',
                             },
     
+    'waitstats'         : { 'help'      : 'Resource and signal wait ms/sec of sys.dm_os_wait_stats over the last interval, with the top wait types',
+                            'stdout'    : 'Resource waits are {}ms/sec',
+                            'label'     : 'resource_wait',
+                            'query'     : WAITSTATS_QUERY,
+                            'type'      : 'waits',
+                            },
+    
+    'filestats'         : { 'help'      : 'Worst read or write latency of the database files over the last interval (see --by-volume)',
+                            'stdout'    : 'Worst file I/O latency is {}ms',
+                            'label'     : 'io_latency',
+                            'unit'      : 'ms',
+                            'query'     : FILESTATS_QUERY,
+                            'type'      : 'files',
+                            },
+    
     'pagesplits'        : { 'help'      : 'Page Splits / Sec',
                             'stdout'    : 'Page Splits / Sec is {}/sec',
                             'label'     : 'page_splits',
-                            'query'     : OBJE_QUERY.format('Page Splits/sec'),
+                            'counter'   : 'Page Splits/sec',
                             'type'      : 'delta',
                             },
     
     'cachehit'          : { 'help'      : 'Cache Hit Ratio',
                             'stdout'    : 'Cache Hit Ratio is {}%',
                             'label'     : 'cache_hit_ratio',
-                            'query'     : DIVI_QUERY.format('Cache Hit Ratio', '_Total'),
+                            'counter'   : 'Cache Hit Ratio',
+                            'object_name' : 'Plan Cache',
+                            'instance'  : '_Total',
                             'type'      : 'divide',
                             'unit'      : '%',
                             'modifier'  : 100,
@@ -222,35 +316,35 @@ MODES = {
     'batchreq'          : { 'help'      : 'Batch Requests / Sec',
                             'stdout'    : 'Batch Requests / Sec is {}/sec',
                             'label'     : 'batch_requests',
-                            'query'     : OBJE_QUERY.format('Batch Requests/sec'),
+                            'counter'   : 'Batch Requests/sec',
                             'type'      : 'delta',
                             },
     
     'sqlcompilations'   : { 'help'      : 'SQL Compilations / Sec',
                             'stdout'    : 'SQL Compilations / Sec is {}/sec',
                             'label'     : 'sql_compilations',
-                            'query'     : OBJE_QUERY.format('SQL Compilations/sec'),
+                            'counter'   : 'SQL Compilations/sec',
                             'type'      : 'delta',
                             },
     
     'fullscans'         : { 'help'      : 'Full Scans / Sec',
                             'stdout'    : 'Full Scans / Sec is {}/sec',
                             'label'     : 'full_scans',
-                            'query'     : OBJE_QUERY.format('Full Scans/sec'),
+                            'counter'   : 'Full Scans/sec',
                             'type'      : 'delta',
                             },
     
     'pagelife'          : { 'help'      : 'Page Life Expectancy',
                             'stdout'    : 'Page Life Expectancy is {}/sec',
                             'label'     : 'page_life_expectancy',
-                            'query'     : OBJE_QUERY.format('Page life expectancy'),
+                            'counter'   : 'Page life expectancy',
                             'type'      : 'standard'
                             },
     
     #~ 'debug'             : { 'help'      : 'Used as a debugging tool.',
                             #~ 'stdout'    : 'Debugging: ',
                             #~ 'label'     : 'debug',
-                            #~ 'query'     : DIVI_QUERY.format('Average Wait Time', '_Total'),
+                            #~ 'counter'   : 'Average Wait Time (ms)',
                             #~ 'type'      : 'divide' 
                             #~ },
     
@@ -260,33 +354,82 @@ MODES = {
 
 }
 
-def return_nagios(options, stdout='', result='', unit='', label=''):
+#~ Modes that do not run a query and are skipped by --modes/--all
+BATCH_EXCLUDED = ('time2connect', 'test')
+
+def format_nagios(options, stdout='', result='', unit='', label='', note=None):
+    if result is None:
+        #~ Delta modes reseeding after their first run, a restart or a counter wrap, or an idle interval
+        try:
+            stdout = stdout.format('unknown') + ' ({})'.format(note or 'new baseline sample')
+        except TypeError as e:
+            pass
+        return 0, stdout, '{}=U;{};{};;'.format(label, options.warning or '', options.critical or '')
     if is_within_range(options.critical, result):
-        prefix = 'CRITICAL: '
         code = 2
     elif is_within_range(options.warning, result):
-        prefix = 'WARNING: '
         code = 1
     else:
-        prefix = 'OK: '
         code = 0
     strresult = str(result)
     try:
         stdout = stdout.format(strresult)
     except TypeError as e:
         pass
-    stdout = '{}{}| {}={}{};{};{};;'.format(prefix, stdout, label, strresult, unit, options.warning or '', options.critical or '')
-    raise NagiosReturn(stdout, code)
+    perfdata = '{}={}{};{};{};;'.format(label, strresult, unit, options.warning or '', options.critical or '')
+    return code, stdout, perfdata
 
-class NagiosReturn(Exception):
+def return_nagios(options, stdout='', result='', unit='', label='', note=None):
+    code, stdout, perfdata = format_nagios(options, stdout, result, unit, label, note)
+    raise NagiosReturn(nagios_output(code, stdout, TIMER.perfdata(perfdata)), code)
+
+class SysperfinfoSnapshot(object):
+    
+    def __init__(self, rows, fetched=None):
+        self.time = fetched
+        self.counters = {}
+        for object_name, counter_name, instance_name, value, cntr_type in rows:
+            key = (counter_name.strip().lower(), instance_name.strip().lower())
+            self.counters.setdefault(key, []).append((object_name.strip().lower(), value, cntr_type))
+    
+    @classmethod
+    def fetch(cls, connection, counters, cache=None):
+        names = sorted(set(counter.lower() for counter in counters if counter != START_TIME_COUNTER))
+        query = SNAPSHOT_QUERY.format(', '.join(['%s'] * len(names)))
+        if START_TIME_COUNTER in counters:
+            query += START_TIME_QUERY
+        rows, fetched = query_rows(connection, query + ';', tuple(names), cache)
+        return cls(rows, fetched)
+    
+    def row(self, counter, instance=None, object_name=None):
+        """Return the (value, cntr_type) of a counter."""
+        name = counter.lower()
+        if instance is None:
+            #~ Prefer the instance-less row, like sysperfinfo usually lists it first
+            keys = [(name, '')] + sorted(k for k in self.counters if k[0] == name)
+        else:
+            keys = [(name, instance.lower())]
+        for key in keys:
+            for row_object, value, cntr_type in self.counters.get(key, []):
+                if not object_name or row_object.endswith(':' + object_name.lower()):
+                    return value, cntr_type
+        if instance:
+            counter = '{} ({})'.format(counter, instance)
+        raise Exception('Counter {} not found in sysperfinfo.'.format(counter))
+    
+    def get(self, counter, instance=None, object_name=None):
+        return self.row(counter, instance, object_name)[0]
     
-    def __init__(self, message, code):
-        self.message = message
-        self.code = code
+    def has(self, counter, instance=None, object_name=None):
+        try:
+            self.row(counter, instance, object_name)
+        except Exception:
+            return False
+        return True
 
 class MSSQLQuery(object):
     
-    def __init__(self, query, options, label='', unit='', stdout='', host='', modifier=1, *args, **kwargs):
+    def __init__(self, options, query=None, label='', unit='', stdout='', host='', modifier=1, counter=None, instance=None, object_name=None, *args, **kwargs):
         self.query = query
         self.label = label
         self.unit = unit
@@ -294,82 +437,370 @@ class MSSQLQuery(object):
         self.options = options
         self.host = host
         self.modifier = modifier
+        self.counter = counter
+        self.instance = instance
+        self.object_name = object_name
+        self.sample_time = None
+        self.note = None
+    
+    def counters(self):
+        return [self.counter] if self.counter else []
     
     def run_on_connection(self, connection):
-        cur = connection.cursor()
-        cur.execute(self.query)
-        self.query_result = cur.fetchone()[0]
+        cache = snapshot_cache(DRIVER, self.options, self.host)
+        if self.counter:
+            #~ A cached snapshot holds every counter, so one entry answers all of the host's services
+            counters = all_counters(self.options) if cache else self.counters()
+            self.run_on_snapshot(SysperfinfoSnapshot.fetch(connection, counters, cache))
+        else:
+            rows, self.sample_time = query_rows(connection, self.query, cache=cache)
+            self.query_result = rows[0][0]
+    
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.time
+        self.query_result = snapshot.get(self.counter, self.instance, self.object_name)
+    
+    def state_key(self):
+        return self.query or '{}|{}|{}'.format(self.object_name or '', self.counter, self.instance)
+    
+    def evaluate(self):
+        return format_nagios(   self.options,
+                                self.stdout,
+                                self.result,
+                                self.unit,
+                                self.label,
+                                self.note )
     
     def finish(self):
         return_nagios(  self.options,
                         self.stdout,
                         self.result,
                         self.unit,
-                        self.label )
+                        self.label,
+                        self.note )
     
     def calculate_result(self):
         self.result = float(self.query_result) * self.modifier
     
+    def history_key(self):
+        return self.label
+    
+    def record(self):
+        """Append the result to the host's --history ring of this metric."""
+        record_history(DRIVER, self.options, self.host, self.history_key(), self.label, self.sample_time, self.result)
+    
     def do(self, connection):
-        self.run_on_connection(connection)
+        with TIMER.phase('query', self.label):
+            self.run_on_connection(connection)
         self.calculate_result()
+        self.record()
         self.finish()
 
 class MSSQLDivideQuery(MSSQLQuery):
     
-    def __init__(self, *args, **kwargs):
+    def __init__(self, base=None, *args, **kwargs):
         super(MSSQLDivideQuery, self).__init__(*args, **kwargs)
+        self.base = base or '{} base'.format(self.counter)
+    
+    def calculate_result(self):
+        value, base = float(self.query_result[0]), float(self.query_result[1])
+        if not getattr(self.options, 'since_startup', False):
+            self.result = self.interval_ratio(value, base)
+            if self.result is not None or self.note:
+                return
+            self.stdout += ' (since startup)'
+        if base != 0:
+            self.result = (value / base) * self.modifier
+        else:
+            self.result = value * self.modifier
+    
+    def interval_ratio(self, value, base):
+        """The ratio of what value and base gained since the previous run, or None without one.
+        
+        None with a note means the interval had no lookups; None without one means there is no
+        usable previous sample and the caller falls back to the ratio since startup.
+        """
+        now, last_run = state_store(DRIVER, self.host).exchange(self.state_key(), pack_values([value, base, self.start_time]), self.sample_time)
+        if not last_run:
+            return None
+        old_time, last_values = last_run[0], unpack_values(last_run[1])
+        #~ The server restarted or the counters went backwards, so this run starts a new series
+        if len(last_values) != 3 or last_values[2] != self.start_time or last_values[1] > base or last_values[0] > value:
+            return None
+        if old_time >= now or last_values[1] == base:
+            #~ No lookups since the previous run (or the same cached sample twice): there is no ratio to report
+            self.note = 'no activity since the previous run'
+            return None
+        return ((value - last_values[0]) / (base - last_values[1])) * self.modifier
+    
+    def counters(self):
+        return [self.counter, self.base, START_TIME_COUNTER]
+    
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.time
+        self.query_result = [   snapshot.get(self.counter, self.instance, self.object_name),
+                                snapshot.get(self.base, self.instance, self.object_name) ]
+        self.start_time = snapshot.get(START_TIME_COUNTER, '')
+
+class MSSQLCPUQuery(MSSQLQuery):
+    """SQL Server, other process and idle CPU from the scheduler monitor, newest record or aggregated over --window minutes."""
+    
+    def __init__(self, *args, **kwargs):
+        super(MSSQLCPUQuery, self).__init__(*args, **kwargs)
+        self.window = getattr(self.options, 'window', None)
+        self.window_stat = getattr(self.options, 'window_stat', None) or 'avg'
+        self.query = self.query.format(self.window or 1)
+        if self.window:
+            self.stdout = '{} CPU utilization over the last {} minutes is {{}}%'.format(
+                    'Average' if self.window_stat == 'avg' else 'Peak', self.window)
     
     def calculate_result(self):
-        if self.query_result[1] != 0:
-            self.result = (float(self.query_result[0]) / self.query_result[1]) * self.modifier
+        if not self.query_result:
+            raise Exception('No scheduler monitor records in sys.dm_os_ring_buffers.')
+        samples = [(float(sql), max(0.0, 100.0 - sql - idle), float(idle)) for sql, idle in self.query_result]
+        if self.window_stat == 'max':
+            #~ The busiest record, so the three values still add up to 100
+            sql, other, idle = max(samples)
         else:
-            self.result = float(self.query_result[0]) * self.modifier
+            sql, other, idle = [sum(values) / len(samples) for values in zip(*samples)]
+        self.result = sql * self.modifier
+        self.other = other
+        self.idle = idle
     
     def run_on_connection(self, connection):
-        cur = connection.cursor()
-        cur.execute(self.query)
-        self.query_result = [x[0] for x in cur.fetchall()]
+        rows, self.sample_time = query_rows(connection, self.query, cache=snapshot_cache(DRIVER, self.options, self.host))
+        self.query_result = rows
+    
+    def evaluate(self):
+        code, stdout, perfdata = super(MSSQLCPUQuery, self).evaluate()
+        stdout = '{} (other processes {:.1f}%, idle {:.1f}%)'.format(stdout, self.other, self.idle)
+        perfdata = '{} {}_other={:.1f}%;;;0;100 {}_idle={:.1f}%;;;0;100'.format(perfdata, self.label, self.other, self.label, self.idle)
+        return code, stdout, perfdata
+    
+    def finish(self):
+        code, stdout, perfdata = self.evaluate()
+        raise NagiosReturn(nagios_output(code, stdout, TIMER.perfdata(perfdata)), code)
 
 class MSSQLDeltaQuery(MSSQLQuery):
     
-    def make_pickle_name(self):
-        tmpdir = tempfile.gettempdir()
-        tmpname = hash(self.host + self.query)
-        self.picklename = '{}/mssql-{}.tmp'.format(tmpdir, tmpname)
+    def counters(self):
+        return [self.counter, START_TIME_COUNTER]
+    
+    def run_on_snapshot(self, snapshot):
+        super(MSSQLDeltaQuery, self).run_on_snapshot(snapshot)
+        self.start_time = snapshot.get(START_TIME_COUNTER, '')
     
     def calculate_result(self):
-        self.make_pickle_name()
+        new_val = float(self.query_result)
+        now, last_run = state_store(DRIVER, self.host).exchange(self.state_key(), pack_values([new_val, self.start_time]), self.sample_time)
+        self.result = None
         
-        try:
-            tmpfile = open(self.picklename)
-        except IOError:
-            tmpfile = open(self.picklename, 'w')
-            tmpfile.close()
-            tmpfile = open(self.picklename)
-        try:
-            try:
-                last_run = pickle.load(tmpfile)
-            except EOFError as ValueError:
-                last_run = { 'time' : None, 'value' : None }
-        finally:
-            tmpfile.close()
-        
-        if last_run['time']:
-            old_time = last_run['time']
-            new_time = time.time()
-            old_val  = last_run['query_result']
-            new_val  = self.query_result
-            self.result = ((new_val - old_val) / (new_time - old_time)) * self.modifier
+        if last_run:
+            old_time, last_values = last_run[0], unpack_values(last_run[1])
+            #~ Reseed silently after a server restart or when the counter went backwards
+            if len(last_values) == 2 and last_values[1] == self.start_time and last_values[0] <= new_val and old_time < now:
+                self.result = ((new_val - last_values[0]) / (now - old_time)) * self.modifier
+
+def pack_samples(start_time, samples):
+    """Pack { name : (value, ...) } as the names followed by one array of doubles, every tuple of the same length."""
+    import array
+    names = sorted(samples)
+    width = len(samples[names[0]]) if names else 0
+    values = array.array('d', [start_time] + [value for name in names for value in samples[name]])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return struct.pack('<II', len(names), width) + values.tobytes() + '\n'.join(names).encode('utf-8')
+
+def unpack_samples(blob):
+    """Return the (start time, { name : (value, ...) }) packed by pack_samples."""
+    import array
+    count, width = struct.unpack_from('<II', blob)
+    end = 8 + 8 * (1 + count * width)
+    values = array.array('d')
+    values.frombytes(blob[8:end])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    names = blob[end:].decode('utf-8').split('\n') if count else []
+    return values[0], dict((name, tuple(values[1 + width * i:1 + width * (i + 1)])) for i, name in enumerate(names))
+
+class MSSQLWaitStatsQuery(MSSQLQuery):
+    """Resource and signal wait ms/sec since the previous run, summed over the non-benign wait types, with the top types."""
+    
+    def run_on_connection(self, connection):
+        rows, self.sample_time = query_rows(connection, self.query, BENIGN_WAITS, snapshot_cache(DRIVER, self.options, self.host))
+        self.query_result = rows
+    
+    def state_key(self):
+        return 'waitstats'
+    
+    def calculate_result(self):
+        waits = {}
+        self.start_time = 0.0
+        for wait_type, wait_ms, signal_ms in self.query_result:
+            if wait_type == START_TIME_COUNTER:
+                self.start_time = float(wait_ms)
+            else:
+                waits[wait_type] = (float(wait_ms), float(signal_ms))
+        now, last_run = state_store(DRIVER, self.host).exchange(self.state_key(), pack_samples(self.start_time, waits), self.sample_time)
+        self.result = None
+        self.signal = None
+        self.top = []
+        if not last_run:
+            return
+        old_time, (old_start, last_waits) = last_run[0], unpack_samples(last_run[1])
+        if old_start != self.start_time or old_time >= now:
+            return
+        rates = []
+        for wait_type, (wait_ms, signal_ms) in waits.items():
+            old_wait, old_signal = last_waits.get(wait_type, (0.0, 0.0))
+            #~ DBCC SQLPERF ('sys.dm_os_wait_stats', CLEAR) starts every counter from zero again
+            if wait_ms < old_wait or signal_ms < old_signal:
+                return
+            rates.append(((wait_ms - old_wait) / (now - old_time), (signal_ms - old_signal) / (now - old_time), wait_type))
+        self.signal = sum(signal for wait, signal, wait_type in rates)
+        self.result = (sum(wait for wait, signal, wait_type in rates) - self.signal) * self.modifier
+        top = getattr(self.options, 'wait_top', None)
+        self.top = sorted([rate for rate in rates if rate[0] > 0], reverse=True)[:WAIT_TOP if top is None else top]
+    
+    def evaluate(self):
+        code, stdout, perfdata = super(MSSQLWaitStatsQuery, self).evaluate()
+        if self.result is None:
+            return code, stdout, perfdata
+        warning = getattr(self.options, 'signal_warning', None) or self.options.warning
+        critical = getattr(self.options, 'signal_critical', None) or self.options.critical
+        if is_within_range(critical, self.signal):
+            signal_code = 2
+        elif is_within_range(warning, self.signal):
+            signal_code = 1
         else:
-            self.result = None
-        
-        new_run = { 'time' : time.time(), 'query_result' : self.query_result }
-        
-        #~ Will throw IOError, leaving it to acquiesce
-        tmpfile = open(self.picklename, 'w')
-        pickle.dump(new_run, tmpfile)
-        tmpfile.close()
+            signal_code = 0
+        if SEVERITY[signal_code] > SEVERITY[code]:
+            code = signal_code
+        stdout = '{}, signal waits are {:.1f}ms/sec'.format(stdout, self.signal)
+        if self.top:
+            stdout = '{}, top: {}'.format(stdout, ', '.join('{} {:.1f}ms/sec'.format(wait_type, wait) for wait, signal, wait_type in self.top))
+        perfdata = [perfdata, 'signal_wait={:.3f};{};{};0;'.format(self.signal, warning or '', critical or '')]
+        perfdata += ['wait_{}={:.3f};;;0;'.format(wait_type.lower(), wait) for wait, signal, wait_type in self.top]
+        return code, stdout, ' '.join(perfdata)
+    
+    def finish(self):
+        code, stdout, perfdata = self.evaluate()
+        raise NagiosReturn(nagios_output(code, stdout, TIMER.perfdata(perfdata)), code)
+
+def io_latencies(stall_read, reads, stall_write, writes, min_ios):
+    """Read and write ms per I/O, None for a direction with fewer than min_ios I/Os."""
+    return (stall_read / reads if reads >= min_ios and reads else None,
+            stall_write / writes if writes >= min_ios and writes else None)
+
+class MSSQLFileStatsQuery(MSSQLQuery):
+    """Read and write latency and throughput of every database file since the previous run, from one sys.dm_io_virtual_file_stats query."""
+    
+    def __init__(self, *args, **kwargs):
+        super(MSSQLFileStatsQuery, self).__init__(*args, **kwargs)
+        self.by_volume = getattr(self.options, 'by_volume', False)
+        if self.by_volume:
+            self.query = self.query.format('v.volume_mount_point', VOLUME_APPLY, START_TIME_COUNTER)
+        else:
+            self.query = self.query.format('NULL', '', START_TIME_COUNTER)
+    
+    def run_on_connection(self, connection):
+        rows, self.sample_time = query_rows(connection, self.query, cache=snapshot_cache(DRIVER, self.options, self.host))
+        self.query_result = rows
+    
+    def state_key(self):
+        return 'filestats'
+    
+    def calculate_result(self):
+        files = {}
+        names = {}
+        self.start_time = 0.0
+        for database_id, file_id, database, path, volume, reads, bytes_read, stall_read, writes, bytes_written, stall_write in self.query_result:
+            if path is None and database == START_TIME_COUNTER:
+                self.start_time = float(reads)
+                continue
+            #~ database_id:file_id keeps the state small on instances with hundreds of files
+            key = '{}:{}'.format(database_id, file_id)
+            files[key] = tuple(float(value) for value in (reads, bytes_read, stall_read, writes, bytes_written, stall_write))
+            names[key] = (volume or '', '{} {}'.format(database, path))
+        now, last_run = state_store(DRIVER, self.host).exchange(self.state_key(), pack_samples(self.start_time, files), self.sample_time)
+        self.result = None
+        self.min_ios = None
+        if not last_run:
+            return
+        old_time, (old_start, last_files) = last_run[0], unpack_samples(last_run[1])
+        if old_start != self.start_time or old_time >= now:
+            return
+        self.min_ios = getattr(self.options, 'file_min_ios', None) or FILE_MIN_IOS
+        groups = {}
+        for key, values in files.items():
+            old_values = last_files.get(key)
+            if old_values is None or len(old_values) != len(values):
+                continue
+            deltas = [new - old for new, old in zip(values, old_values)]
+            #~ A database restored or re-created under the same ids starts its counters again
+            if any(delta < 0 for delta in deltas):
+                continue
+            volume, name = names[key]
+            group = groups.setdefault(volume if self.by_volume else name, [0.0] * 6)
+            for i, delta in enumerate(deltas):
+                group[i] += delta
+        seconds = now - old_time
+        self.totals = [sum(values) for values in zip(*groups.values())] or [0.0] * 6
+        self.groups = []
+        for name, (reads, bytes_read, stall_read, writes, bytes_written, stall_write) in groups.items():
+            read_latency, write_latency = io_latencies(stall_read, reads, stall_write, writes, self.min_ios)
+            self.groups.append((name, read_latency, write_latency, (bytes_read + bytes_written) / seconds, reads, writes))
+        self.seconds = seconds
+        self.worst = None
+        for name, read_latency, write_latency, throughput, reads, writes in self.groups:
+            for direction, latency, ios in (('read', read_latency, reads), ('write', write_latency, writes)):
+                if latency is not None and (self.worst is None or latency > self.worst[0]):
+                    self.worst = (latency, direction, name, ios)
+        if self.worst:
+            self.result = round(self.worst[0], 3) * self.modifier
+    
+    def evaluate(self):
+        code, stdout, perfdata = super(MSSQLFileStatsQuery, self).evaluate()
+        if self.min_ios is None:
+            return code, stdout, perfdata
+        if self.result is None:
+            stdout = 'No {} had {} reads or writes since the previous run'.format('volume' if self.by_volume else 'file', self.min_ios)
+        else:
+            latency, direction, name, ios = self.worst
+            stdout = '{} ({} on {} over {:.0f} {}s)'.format(stdout, direction, name, ios, direction)
+        reads, bytes_read, stall_read, writes, bytes_written, stall_write = self.totals
+        read_latency, write_latency = io_latencies(stall_read, reads, stall_write, writes, 1)
+        stdout = '{}, {:.1f} kB/s read, {:.1f} kB/s written'.format(stdout, bytes_read / self.seconds / 1024, bytes_written / self.seconds / 1024)
+        perfdata = [perfdata,
+                    'read_latency={}ms;;;0;'.format('U' if read_latency is None else round(read_latency, 3)),
+                    'write_latency={}ms;;;0;'.format('U' if write_latency is None else round(write_latency, 3)),
+                    'read_bytes={:.0f}B;;;0;'.format(bytes_read / self.seconds),
+                    'write_bytes={:.0f}B;;;0;'.format(bytes_written / self.seconds)]
+        if self.by_volume:
+            for name, read_latency, write_latency, throughput, reads, writes in sorted(self.groups):
+                label = counter_label(name) or 'volume'
+                latencies = [latency for latency in (read_latency, write_latency) if latency is not None]
+                perfdata.append('io_latency_{}={}ms;{};{};0;'.format(label, round(max(latencies), 3) if latencies else 'U',
+                                                                      self.options.warning or '', self.options.critical or ''))
+                perfdata.append('io_bytes_{}={:.0f}B;;;0;'.format(label, throughput))
+        return code, stdout, ' '.join(perfdata)
+    
+    def finish(self):
+        code, stdout, perfdata = self.evaluate()
+        raise NagiosReturn(nagios_output(code, stdout, TIMER.perfdata(perfdata)), code)
+
+def window_minutes(spec):
+    """Turn a period such as 300s, 5m or 1h (bare numbers are minutes) into the number of per-minute CPU records."""
+    import math
+    units = { 's' : 1.0 / 60, 'm' : 1, 'h' : 60 }
+    spec = spec.strip().lower()
+    scale = units.get(spec[-1:])
+    if scale:
+        spec = spec[:-1]
+    minutes = int(math.ceil(float(spec) * (scale or 1)))
+    if not 1 <= minutes <= CPU_RECORDS:
+        raise ValueError(spec)
+    return minutes
 
 def parse_args():
     
@@ -392,50 +823,134 @@ def parse_args():
     nagios = OptionGroup(parser, "Nagios Plugin Information")
     nagios.add_option('-w', '--warning', help='Specify warning range.', default=None)
     nagios.add_option('-c', '--critical', help='Specify critical range.', default=None)
+    nagios.add_option('--since-startup', action='store_true', help='Report hit ratios averaged since the server started instead of over the last interval.', default=False)
+    nagios.add_option('--timing', action='store_true', help='Append per-phase durations (import_ms, connect_ms, query_ms, state_ms) to the perfdata.', default=False)
     parser.add_option_group(nagios)
  
     mode = OptionGroup(parser, "Mode Options")
+    mode.add_option('--modes', help='Run a comma separated list of modes over one connection.', default=None)
+    mode.add_option('--all', action='store_true', help='Run every mode over one connection.', default=False)
+    mode.add_option('--counter', help='Check any sysperfinfo counter by name, evaluated according to its cntr_type.', default=None)
+    mode.add_option('--counter-instance', help='Instance name of --counter (default: the instance-less row, else the first one).', default=None)
+    mode.add_option('--counter-object', help='Object of --counter, e.g. "Buffer Manager", when the name is not unique.', default=None)
+    mode.add_option('--counter-base', help='Base counter of a ratio or average --counter (default: guessed from its name).', default=None)
+    mode.add_option('--window', help='Aggregate the cpu mode over this period, e.g. 5m, 300s or 1h (default: newest sample only).', default=None)
+    mode.add_option('--window-stat', type='choice', choices=['avg', 'max'], help='Aggregate --window with avg or max (default: avg).', default='avg')
+    mode.add_option('--wait-top', type='int', help='Wait types listed by the waitstats mode (default: {}).'.format(WAIT_TOP), default=WAIT_TOP)
+    mode.add_option('--signal-warning', help='Warning range of the waitstats signal wait ms/sec (default: -w).', default=None)
+    mode.add_option('--signal-critical', help='Critical range of the waitstats signal wait ms/sec (default: -c).', default=None)
+    mode.add_option('--by-volume', action='store_true', help='Evaluate the filestats mode per volume instead of per file.', default=False)
+    mode.add_option('--file-min-ios', type='int', help='Reads or writes a file needs in the interval for its filestats latency to count (default: {}).'.format(FILE_MIN_IOS), default=FILE_MIN_IOS)
+    parser.add_option_group(mode)
+    
+    collector = OptionGroup(parser, "Collector Options")
+    collector.add_option('--collector', help='Run the resident collector using the given configuration file.', default=None)
+    collector.add_option('--socket', help='Read results from the collector listening on this Unix socket.', default=None)
+    collector.add_option('--max-age', type='int', help='Maximum age in seconds of a collector result (default: 3 polling intervals).', default=None)
+    collector.add_option('--broker', help='Borrow a pooled connection from the collector listening on this Unix socket.', default=None)
+    collector.add_option('--exporter', help='Serve Prometheus metrics of --modes/--all (default: all) on this host:port, or of the hosts of --collector.', default=None)
+    collector.add_option('--exporter-interval', type='int', help='Seconds between the polls of --exporter without --collector (default: 60).', default=60)
+    parser.add_option_group(collector)
+    
+    history = OptionGroup(parser, "History Options")
+    history.add_option('--history', action='store_true', help='Append every result to a fixed-size ring of this host and metric in the temporary directory.', default=False)
+    history.add_option('--history-size', type='int', help='Samples kept by a new --history ring (default: {}, a week of one-minute checks).'.format(HISTORY_SLOTS), default=HISTORY_SLOTS)
+    history.add_option('--history-dump', action='store_true', help='Print the --history samples of -m for the host instead of checking it.', default=False)
+    parser.add_option_group(history)
+    
+    cache = OptionGroup(parser, "Cache Options")
+    cache.add_option('--cache-ttl', type='int', help='Share query results with the other checks of this host for this many seconds (default: 0, off).', default=0)
+    parser.add_option_group(cache)
+    
+    fleet = OptionGroup(parser, "Fleet Options")
+    fleet.add_option('--fleet', help='Check every server listed in this file (hostname, hostname:port or hostname\\instance per line).', default=None)
+    fleet.add_option('--concurrency', type='int', help='Number of servers checked at the same time (default: 20).', default=20)
+    fleet.add_option('--timeout', type='int', help='Seconds allowed for each server (default: 30).', default=30)
+    parser.add_option_group(fleet)
+    
+    passive = OptionGroup(parser, "Passive Result Options")
+    passive.add_option('--spool-dir', help='Write --modes/--fleet results as passive check results into this Nagios checkresults directory.', default=None)
+    passive.add_option('--command-file', help='Submit --modes/--fleet results as PROCESS_SERVICE_CHECK_RESULT commands to this Nagios command file.', default=None)
+    passive.add_option('--service-format', help='Service description of passive results, {host} and {mode} are replaced (default: {mode}).', default='{mode}')
+    parser.add_option_group(passive)
     options, _ = parser.parse_args()
- 
-    if not options.hostname:
+    
+    if options.collector:
+        return options
+    
+    if options.exporter and (options.mode or options.counter or options.fleet or options.socket):
+        parser.error('--exporter cannot be combined with -m, --counter, --fleet or --socket.')
+    if options.history_dump and (not options.mode or options.mode in BATCH_EXCLUDED):
+        parser.error('--history-dump needs a mode given with -m.')
+    if options.history and options.history_size < 1:
+        parser.error('History size must be at least 1.')
+    if options.exporter and options.exporter_interval < 1:
+        parser.error('Exporter interval must be at least 1.')
+    if options.fleet and not (options.mode or options.modes or options.all):
+        parser.error('Fleet mode needs -m, --modes or --all.')
+    if options.fleet and options.mode in BATCH_EXCLUDED:
+        parser.error('Fleet mode cannot run {}.'.format(options.mode))
+    if options.fleet and options.concurrency < 1:
+        parser.error('Concurrency must be at least 1.')
+    if options.spool_dir and options.command_file:
+        parser.error('Cannot specify both --spool-dir and --command-file.')
+    if (options.spool_dir or options.command_file) and not (options.fleet or options.modes or options.all):
+        parser.error('Passive results need --modes, --all or --fleet.')
+    
+    if not options.hostname and not options.fleet:
         parser.error('Hostname is a required option.')
-    if not options.user:
+    if not options.socket and not options.user:
         parser.error('User is a required option.')
-    if not options.password:
+    if not options.socket and not options.password:
         parser.error('Password is a required option.')
     
     if options.instance and options.port:
         parser.error('Cannot specify both instance and port.')
     
+    if options.window:
+        try:
+            options.window = window_minutes(options.window)
+        except ValueError:
+            parser.error('Invalid --window {}, expected e.g. 5m, 300s or 1h.'.format(options.window))
+    
+    if options.counter and (options.mode or options.modes or options.all or options.fleet or options.socket):
+        parser.error('--counter cannot be combined with -m, --modes, --all, --fleet or --socket.')
+    
+    if options.modes and options.all:
+        parser.error('Cannot specify both --modes and --all.')
+    if options.all:
+        options.modes = [m for m in MODES if m not in BATCH_EXCLUDED]
+    elif options.modes:
+        options.modes = [m.strip() for m in options.modes.split(',') if m.strip()]
+        for m in options.modes:
+            if m not in MODES or m in BATCH_EXCLUDED:
+                parser.error('Unknown batch mode: {}'.format(m))
+    
     return options
 
-def is_within_range(nagstring, value):
-    if not nagstring:
-        return False
-    import re
-    import operator
-    first_float = r'(?P<first>(-?[0-9]+(\.[0-9]+)?))'
-    second_float= r'(?P<second>(-?[0-9]+(\.[0-9]+)?))'
-    actions = [ (r'^{}$'.format(first_float),lambda y: (value > float(y.group('first'))) or (value < 0)),
-                (r'^{}:$'.format(first_float),lambda y: value < float(y.group('first'))),
-                (r'^~:{}$'.format(first_float),lambda y: value > float(y.group('first'))),
-                (r'^{}:{}$'.format(first_float,second_float), lambda y: (value < float(y.group('first'))) or (value > float(y.group('second')))),
-                (r'^@{}:{}$'.format(first_float,second_float), lambda y: not((value < float(y.group('first'))) or (value > float(y.group('second')))))]
-    for regstr,func in actions:
-        res = re.match(regstr,nagstring)
-        if res: 
-            return func(res)
-    raise Exception('Improper warning/critical format.')
-
-def connect_db(options):
+def server_address(options):
     host = options.hostname
     if options.instance:
         host += "\\" + options.instance
     elif options.port:
-        host += ":" + options.port
+        host += ":" + str(options.port)
+    return host
+
+def connect_db(options):
+    host = server_address(options)
+    if options.broker:
+        start = time.time()
+        connect = { 'host' : host, 'user' : options.user, 'password' : options.password, 'database' : 'master' }
+        with TIMER.phase('connect', 'broker'):
+            mssql = BrokerConnection(DRIVER, options.broker, connect)
+        return mssql, time.time() - start, host
+    #~ Imported before the clock starts so time2connect does not include loading the driver
+    with TIMER.phase('import'):
+        import pymssql
     start = time.time()
     try:
-        mssql = pymssql.connect(host = host, user = options.user, password = options.password, database='master')
+        with TIMER.phase('connect', host):
+            mssql = pymssql.connect(host = host, user = options.user, password = options.password, database='master')
     except:
         print('ERROR - Failed to connect to {}'.format(host))
         sys.exit(2)
@@ -444,11 +959,47 @@ def connect_db(options):
 
 def main():
     options = parse_args()
-    mssql, total, host = connect_db(options)
+    TIMER.report = options.timing
+    
+    if options.collector:
+        run_collector(DRIVER, options, MODES, [m for m in MODES if m not in BATCH_EXCLUDED], make_collector_host)
+        return
+    
+    if options.exporter:
+        run_exporter(options)
+        return
+    
+    if options.history_dump:
+        dump_history(options)
+    
+    if options.socket:
+        read_collector(options)
+    
+    if options.fleet:
+        started = time.time()
+        fleet_results = run_fleet(options)
+        if options.spool_dir or options.command_file:
+            raise NagiosReturn(spool_results(options, fleet_results, started), 0)
+        return_fleet(fleet_results)
     
-    if options.mode =='test':
+    if options.cache_ttl and (options.modes or options.counter or options.mode not in (None, 'time2connect', 'test')):
+        mssql, total, host = LazyConnection(options, connect_db), None, server_address(options)
+    else:
+        mssql, total, host = connect_db(options)
+    
+    if options.modes:
+        started = time.time()
+        results = execute_modes(mssql, options, options.modes, host)
+        if options.spool_dir or options.command_file:
+            raise NagiosReturn(spool_results(options, [(options.hostname, results)], started), 0)
+        return_batch(results)
+    
+    elif options.mode =='test':
         run_tests(mssql, options, host)
         
+    elif options.counter:
+        execute_counter(mssql, options, host)
+        
     elif not options.mode or options.mode == 'time2connect':
         return_nagios(  options,
                         stdout='Time to connect was {}s',
@@ -459,19 +1010,125 @@ def main():
     else:
         execute_query(mssql, options, host)
 
-def execute_query(mssql, options, host=''):
-    sql_query = MODES[options.mode]
-    sql_query['options'] = options
-    sql_query['host'] = host
-    query_type = sql_query.get('type')
+def make_query(options, mode, host=''):
+    sql_query = dict(MODES[mode], options=options, host=host)
+    return query_class(sql_query.get('type'))(**sql_query)
+
+def query_class(query_type):
     if query_type == 'delta':
-        mssql_query = MSSQLDeltaQuery(**sql_query)
+        return MSSQLDeltaQuery
     elif query_type == 'divide':
-        mssql_query = MSSQLDivideQuery(**sql_query)
+        return MSSQLDivideQuery
+    elif query_type == 'cpu':
+        return MSSQLCPUQuery
+    elif query_type == 'waits':
+        return MSSQLWaitStatsQuery
+    elif query_type == 'files':
+        return MSSQLFileStatsQuery
     else:
-        mssql_query = MSSQLQuery(**sql_query)
+        return MSSQLQuery
+
+def base_candidates(counter):
+    """Likely names of a counter's base, e.g. 'Avg. Latch Wait Time (ms)' -> 'Average Latch Wait Time Base'."""
+    name = counter.lower()
+    if name.endswith(' (ms)'):
+        name = name[:-len(' (ms)')]
+    if name.startswith('avg. '):
+        name = 'average ' + name[len('avg. '):]
+    return sorted(set([counter.lower() + ' base', name + ' base']))
+
+def counter_label(counter):
+    return '_'.join(''.join(c if c.isalnum() else ' ' for c in counter.lower()).split())
+
+def make_counter_query(options, snapshot, host=''):
+    """Build the query for --counter from the cntr_type sysperfinfo reports for it."""
+    counter, instance, object_name = options.counter, options.counter_instance, options.counter_object
+    cntr_type = snapshot.row(counter, instance, object_name)[1]
+    if cntr_type == BASE_COUNTER_TYPE:
+        raise Exception('Counter {} is the base of another counter, check that one instead.'.format(counter))
+    if cntr_type not in COUNTER_TYPES:
+        raise Exception('Counter {} has the unsupported cntr_type {}.'.format(counter, cntr_type))
+    query_type, unit, modifier = COUNTER_TYPES[cntr_type]
+    sql_query = {   'options'       : options,
+                    'host'          : host,
+                    'counter'       : counter,
+                    'instance'      : instance,
+                    'object_name'   : object_name,
+                    'label'         : counter_label(counter),
+                    'unit'          : '' if query_type == 'delta' else unit,
+                    'stdout'        : '{} is {{}}{}'.format(counter, unit),
+                    'modifier'      : modifier }
+    if query_type == 'divide':
+        bases = [options.counter_base] if options.counter_base else base_candidates(counter)
+        found = [base for base in bases if snapshot.has(base, instance, object_name)]
+        if not found:
+            raise Exception('No base counter ({}) found for {}, use --counter-base.'.format(', '.join(bases), counter))
+        sql_query['base'] = found[0]
+    return query_class(query_type)(**sql_query)
+
+def execute_counter(mssql, options, host=''):
+    counters = [options.counter, START_TIME_COUNTER] + ([options.counter_base] if options.counter_base else base_candidates(options.counter))
+    with TIMER.phase('query', 'sysperfinfo'):
+        snapshot = SysperfinfoSnapshot.fetch(mssql, counters, snapshot_cache(DRIVER, options, host))
+    mssql_query = make_counter_query(options, snapshot, host)
+    mssql_query.run_on_snapshot(snapshot)
+    mssql_query.calculate_result()
+    mssql_query.record()
+    mssql_query.finish()
+
+def all_counters(options):
+    return [counter for mode in MODES if MODES[mode].get('counter') for counter in make_query(options, mode).counters()]
+
+def dump_history(options):
+    """Print the --history samples of the mode for the host, oldest first, without connecting."""
+    host = server_address(options)
+    key = make_query(options, options.mode, host).history_key()
+    report_history(DRIVER, host, key, '{} for {}'.format(options.mode, host))
+
+def execute_query(mssql, options, host=''):
+    mssql_query = make_query(options, options.mode, host)
     mssql_query.do(mssql)
 
+def collect_modes(mssql, options, modes, host=''):
+    """Run modes over one connection, returning (mode, query, error) tuples."""
+    collected = []
+    queries = []
+    for mode in modes:
+        try:
+            queries.append((mode, make_query(options, mode, host)))
+        except Exception as e:
+            collected.append((mode, None, e))
+    counters = [c for mode, mssql_query in queries for c in mssql_query.counters()]
+    snapshot = None
+    if counters:
+        cache = snapshot_cache(DRIVER, options, host)
+        with TIMER.phase('query', 'sysperfinfo'):
+            snapshot = SysperfinfoSnapshot.fetch(mssql, all_counters(options) if cache else counters, cache)
+    for mode, mssql_query in queries:
+        try:
+            if mssql_query.counter:
+                mssql_query.run_on_snapshot(snapshot)
+            else:
+                with TIMER.phase('query', mode):
+                    mssql_query.run_on_connection(mssql)
+            mssql_query.calculate_result()
+            mssql_query.record()
+            collected.append((mode, mssql_query, None))
+        except driver_errors(DRIVER):
+            raise
+        except Exception as e:
+            collected.append((mode, None, e))
+    return collected
+
+def execute_modes(mssql, options, modes, host=''):
+    results = []
+    for mode, mssql_query, error in collect_modes(mssql, options, modes, host):
+        if error is not None:
+            results.append((mode, 3, '{} failed with: {}'.format(mode, error), ''))
+        else:
+            results.append((mode,) + mssql_query.evaluate())
+    return results
+
 def run_tests(mssql, options, host):
     failed = 0
     total  = 0
@@ -489,13 +1146,129 @@ def run_tests(mssql, options, host):
             print('{} failed with: {}'.format(mode, e))
     print('{}/{} tests failed.'.format(failed, total))
     
+def read_fleet(path):
+    """Return (address, Nagios host name) pairs, the name defaulting to the address."""
+    servers = []
+    with open(path) as fleet_file:
+        for line in fleet_file:
+            fields = line.split('#')[0].split()
+            if fields:
+                servers.append((fields[0], fields[1] if len(fields) > 1 else fields[0]))
+    return servers
+
+def check_host(options, address, modes):
+    """Run modes against one fleet server, returning (host, results)."""
+    import copy
+    import pymssql
+    host_options = copy.copy(options)
+    host_options.hostname, host_options.instance, host_options.port = address, None, None
+    if '\\' in address:
+        host_options.hostname, host_options.instance = address.split('\\', 1)
+    elif ':' in address:
+        host_options.hostname, host_options.port = address.rsplit(':', 1)
+    host = server_address(host_options)
+    try:
+        mssql = pymssql.connect(host = host, user = options.user, password = options.password, database='master',
+                                login_timeout = options.timeout, timeout = options.timeout)
+    except Exception as e:
+        return host, [(mode, 2, 'Failed to connect to {}'.format(host), '') for mode in modes]
+    try:
+        return host, execute_modes(mssql, host_options, modes, host)
+    except Exception as e:
+        return host, [(mode, 3, '{} failed with: {}'.format(mode, e), '') for mode in modes]
+    finally:
+        mssql.close()
+
+def run_fleet(options):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    addresses = read_fleet(options.fleet)
+    modes = options.modes or [options.mode]
+    
+    async def check_all():
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(options.concurrency)
+        executor = ThreadPoolExecutor(max_workers=options.concurrency)
+        
+        async def check_one(address, host_name):
+            async with semaphore:
+                try:
+                    host, results = await asyncio.wait_for(loop.run_in_executor(executor, check_host, options, address, modes), options.timeout)
+                except asyncio.TimeoutError:
+                    results = [(mode, 3, 'Timed out after {}s'.format(options.timeout), '') for mode in modes]
+                return host_name, results
+        
+        try:
+            return await asyncio.gather(*[check_one(address, host_name) for address, host_name in addresses])
+        finally:
+            executor.shutdown(wait=False)
+    
+    return asyncio.run(check_all())
+
+def return_fleet(fleet_results):
+    code = 0
+    problems = 0
+    lines = []
+    for host, results in fleet_results:
+        for mode, mode_code, stdout, perfdata in results:
+            if SEVERITY[mode_code] > SEVERITY[code]:
+                code = mode_code
+            if mode_code:
+                problems += 1
+            lines.append('{} {}: {}'.format(host, mode, nagios_output(mode_code, stdout, perfdata)))
+    summary = '{}{} services on {} servers checked, {} with problems'.format(STATUS_PREFIXES[code], len(lines), len(fleet_results), problems)
+    raise NagiosReturn('\n'.join([summary] + lines), code)
+
+def read_collector(options):
+    modes = options.modes or [options.mode or 'time2connect']
+    request = { 'host' : server_address(options), 'modes' : modes }
+    reply = collector_request(options.socket, request)
+    if reply.get('error'):
+        raise NagiosReturn('UNKNOWN: {}'.format(reply['error']), 3)
+    max_age = options.max_age or 3 * reply['interval']
+    results = []
+    for mode in modes:
+        collected = reply['results'].get(mode)
+        if not collected:
+            results.append((mode, 3, '{} is not collected for {}'.format(mode, request['host']), ''))
+        elif collected['error']:
+            results.append((mode, 3, '{} failed with: {}'.format(mode, collected['error']), ''))
+        elif time.time() - collected['time'] > max_age:
+            results.append((mode, 3, '{} result is {:.0f}s old'.format(mode, time.time() - collected['time']), ''))
+        else:
+            sql_query = MODES[mode]
+            results.append((mode,) + format_nagios( options,
+                                                    sql_query.get('stdout', 'Time to connect was {}s'),
+                                                    collected['result'],
+                                                    sql_query.get('unit', 's' if mode == 'time2connect' else ''),
+                                                    sql_query.get('label', 'time') ))
+    if options.modes:
+        return_batch(results)
+    mode, code, stdout, perfdata = results[0]
+    if code == 3:
+        raise NagiosReturn('UNKNOWN: {}'.format(stdout), code)
+    raise NagiosReturn('{}{}| {}'.format(STATUS_PREFIXES[code], stdout, perfdata), code)
+
+def collector_connect(options):
+    import pymssql
+    return pymssql.connect(host = server_address(options), user = options.user, password = options.password, database='master')
+
+def make_collector_host(options, modes, interval):
+    return CollectorHost(options, modes, interval, server_address(options), collector_connect, collect_modes)
+
+def run_exporter(options):
+    """Poll the modes of one server every --exporter-interval seconds and serve the results as /metrics."""
+    #~ Loaded up front so the first poll's time2connect does not include it
+    import pymssql
+    modes = options.modes or [m for m in MODES if m not in BATCH_EXCLUDED]
+    collector_host = make_collector_host(options, modes, options.exporter_interval)
+    serve_exporter(options.exporter, lambda: render_metrics('mssql', [collector_host], MODES), collector_host)
+
 if __name__ == '__main__':
+    TIMER.install_hooks()
     try:
         main()
-    except pymssql.OperationalError as e:
-        print('ERROR - {}'.format(e))
-        sys.exit(2)
-    except pymssql.InterfaceError as e:
+    except driver_errors(DRIVER) as e:
         print('ERROR - {}'.format(e))
         sys.exit(2)
     except IOError as e:
@@ -0,0 +1,1049 @@
+########################################################################
+# plugin_common - Runtime shared by the check_mssql_* and
+# check_mysql_health plugins
+#
+# Imported from the directory of the plugin that runs, so install it next
+# to the check scripts (mysql/plugin_common.py links to this file). It only
+# imports the standard library, the plugins pass in whatever talks to
+# their database.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+########################################################################
+
+import time
+import sys
+import os
+import struct
+
+STATUS_PREFIXES = ['OK: ', 'WARNING: ', 'CRITICAL: ', 'UNKNOWN: ']
+
+#~ Order used to pick the worst state when several results are combined
+SEVERITY = { 0 : 0, 1 : 1, 3 : 2, 2 : 3 }
+
+def nagios_output(code, stdout, perfdata=''):
+    if perfdata:
+        return '{}{}| {}'.format(STATUS_PREFIXES[code], stdout, perfdata)
+    return '{}{}'.format(STATUS_PREFIXES[code], stdout)
+
+def return_batch(results):
+    code = 0
+    messages = []
+    perfdata = []
+    for mode, mode_code, stdout, mode_perfdata in results:
+        if SEVERITY[mode_code] > SEVERITY[code]:
+            code = mode_code
+        if mode_code:
+            stdout = '{} ({})'.format(stdout, STATUS_PREFIXES[mode_code][:-2])
+        messages.append(stdout)
+        if mode_perfdata:
+            perfdata.append(mode_perfdata)
+    stdout = STATUS_PREFIXES[code] + ', '.join(messages)
+    perfdata = TIMER.perfdata(' '.join(perfdata))
+    if perfdata:
+        stdout += '| ' + perfdata
+    raise NagiosReturn(stdout, code)
+
+class TimedPhase(object):
+    
+    def __init__(self, timer, name, detail=None):
+        self.timer = timer
+        self.name = name
+        self.detail = detail
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, self.start, time.perf_counter(), self.detail)
+        return False
+
+class PhaseTimer(object):
+    """Time spent per phase of a check, reported by --timing and exported through CHECK_TRACE/CHECK_PROFILE."""
+    
+    def __init__(self):
+        self.report = False
+        self.totals = {}
+        self.order = []
+        self.events = None
+        self.started = time.perf_counter()
+    
+    def phase(self, name, detail=None):
+        return TimedPhase(self, name, detail)
+    
+    def add(self, name, start, end, detail=None):
+        if name not in self.totals:
+            self.order.append(name)
+            self.totals[name] = 0.0
+        self.totals[name] += end - start
+        #~ Only kept while a trace is requested, so the collector does not grow a list forever
+        if self.events is not None:
+            self.events.append((name, start, end, detail, self.thread_id()))
+    
+    def perfdata(self, perfdata=''):
+        """perfdata with import_ms, connect_ms, query_ms and state_ms appended when --timing is given."""
+        if not self.report or not self.totals:
+            return perfdata
+        timings = ' '.join('{}_ms={:.3f};;;;'.format(name, self.totals[name] * 1000) for name in self.order)
+        return '{} {}'.format(perfdata, timings) if perfdata else timings
+    
+    def install_hooks(self):
+        """Write a Chrome trace to $CHECK_TRACE and/or a cProfile dump to $CHECK_PROFILE when the check exits."""
+        trace_path = os.environ.get('CHECK_TRACE')
+        profile_path = os.environ.get('CHECK_PROFILE')
+        if not trace_path and not profile_path:
+            return
+        import atexit
+        import threading
+        self.thread_id = threading.get_ident
+        if trace_path:
+            self.events = []
+            atexit.register(self.write_trace, trace_path.replace('{pid}', str(os.getpid())))
+        if profile_path:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            atexit.register(self.write_profile, profiler, profile_path.replace('{pid}', str(os.getpid())))
+    
+    def write_trace(self, path):
+        import json
+        pid = os.getpid()
+        events = [{ 'name' : os.path.basename(sys.argv[0]), 'cat' : 'check', 'ph' : 'X', 'ts' : 0,
+                    'dur' : (time.perf_counter() - self.started) * 1e6, 'pid' : pid, 'tid' : self.thread_id() }]
+        for name, start, end, detail, thread in self.events:
+            event = {   'name'  : name,
+                        'cat'   : 'phase',
+                        'ph'    : 'X',
+                        'ts'    : (start - self.started) * 1e6,
+                        'dur'   : (end - start) * 1e6,
+                        'pid'   : pid,
+                        'tid'   : thread }
+            if detail:
+                event['args'] = { 'detail' : detail }
+            events.append(event)
+        with open(path, 'w') as trace_file:
+            json.dump({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, trace_file)
+    
+    def write_profile(self, profiler, path):
+        profiler.disable()
+        profiler.dump_stats(path)
+
+TIMER = PhaseTimer()
+
+class NagiosReturn(Exception):
+    
+    def __init__(self, message, code):
+        self.message = message
+        self.code = code
+
+class Threshold(object):
+    """A Nagios range such as 10, 10:, ~:10, 10:20 or @10:20, parsed once and then checked with plain comparisons."""
+    
+    def __init__(self, spec):
+        self.spec = spec
+        self.inside = spec.startswith('@')
+        bounds = spec[1:] if self.inside else spec
+        start, end = bounds.split(':', 1) if ':' in bounds else ('', bounds)
+        if not start and not end:
+            raise Exception('Improper warning/critical format.')
+        try:
+            self.start = float('-inf') if start == '~' else float(start or 0)
+            self.end = float(end) if end else float('inf')
+        except ValueError:
+            raise Exception('Improper warning/critical format.')
+        #~ A lone negative value such as -5 stays valid and alerts on every value, as it always has
+        if ':' in bounds and self.start > self.end:
+            raise Exception('Improper warning/critical format.')
+    
+    def alert(self, value):
+        """True when value lies outside the range, or inside it for @ ranges."""
+        if self.inside:
+            return self.start <= value <= self.end
+        return value < self.start or value > self.end
+
+#~ Parsed thresholds by spec, so batch and fleet runs parse each -w/-c once
+THRESHOLDS = {}
+
+def threshold(spec):
+    if not spec:
+        return None
+    if spec not in THRESHOLDS:
+        THRESHOLDS[spec] = Threshold(spec)
+    return THRESHOLDS[spec]
+
+def is_within_range(nagstring, value, invert = False):
+    parsed = threshold(nagstring)
+    if parsed is None:
+        return False
+    if invert:
+        return not parsed.alert(value)
+    return parsed.alert(value)
+
+class PassiveSpool(object):
+    """Passive check results written in one batch to the checkresults directory or command file."""
+    
+    def __init__(self, spool_dir=None, command_file=None):
+        self.spool_dir = spool_dir
+        self.command_file = command_file
+        self.results = []
+    
+    def add(self, host_name, service, code, output, start_time, finish_time):
+        #~ Both formats are line based, so multi-line output keeps its newlines escaped
+        output = output.replace('\\', '\\\\').replace('\n', '\\n')
+        self.results.append((host_name, service, code, output, start_time, finish_time))
+    
+    def flush(self):
+        if self.spool_dir:
+            self.write_checkresults()
+        else:
+            self.write_commands()
+        count = len(self.results)
+        self.results = []
+        return count
+    
+    def write_checkresults(self):
+        import random
+        import string
+        import tempfile
+        blocks = ['### Active Check Result File ###\nfile_time={}\n'.format(int(time.time()))]
+        for host_name, service, code, output, start_time, finish_time in self.results:
+            blocks.append(  '### Nagios Service Check Result ###\n'
+                            '# Time: {}\n'
+                            'host_name={}\n'
+                            'service_description={}\n'
+                            'check_type=1\n'
+                            'check_options=0\n'
+                            'scheduled_check=0\n'
+                            'reschedule_check=0\n'
+                            'latency=0.0\n'
+                            'start_time={:.6f}\n'
+                            'finish_time={:.6f}\n'
+                            'early_timeout=0\n'
+                            'exited_ok=1\n'
+                            'return_code={}\n'
+                            'output={}\n'.format(time.ctime(finish_time), host_name, service, start_time, finish_time, code, output))
+        
+        #~ Nagios only picks up cXXXXXX files once their .ok marker exists, so the
+        #~ file is written under a name it ignores and linked into place when complete
+        handle, tmpname = tempfile.mkstemp(prefix='.checkresult.', dir=self.spool_dir)
+        try:
+            with os.fdopen(handle, 'w') as tmpfile:
+                tmpfile.write('\n'.join(blocks))
+                tmpfile.flush()
+                os.fsync(tmpfile.fileno())
+            os.chmod(tmpname, 0o644)
+            while True:
+                name = os.path.join(self.spool_dir, 'c' + ''.join(random.choice(string.ascii_letters + string.digits) for i in range(6)))
+                try:
+                    os.link(tmpname, name)
+                    break
+                except OSError as e:
+                    if not os.path.exists(name):
+                        raise
+        finally:
+            os.unlink(tmpname)
+        os.close(os.open(name + '.ok', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+    
+    def write_commands(self):
+        import select
+        chunks = ['']
+        for host_name, service, code, output, start_time, finish_time in self.results:
+            line = '[{}] PROCESS_SERVICE_CHECK_RESULT;{};{};{};{}\n'.format(int(finish_time), host_name, service, code, output)
+            #~ Writes up to PIPE_BUF bytes are atomic, so lines are never interleaved with other writers
+            if chunks[-1] and len((chunks[-1] + line).encode('utf-8')) > select.PIPE_BUF:
+                chunks.append('')
+            chunks[-1] += line
+        handle = os.open(self.command_file, os.O_WRONLY | os.O_APPEND)
+        try:
+            for chunk in chunks:
+                if chunk:
+                    os.write(handle, chunk.encode('utf-8'))
+        finally:
+            os.close(handle)
+
+def spool_results(options, host_results, started):
+    """Submit the (Nagios host name, results) pairs of a run as passive results, returning the check output that reports it."""
+    finished = time.time()
+    spool = PassiveSpool(options.spool_dir, options.command_file)
+    problems = 0
+    for host_name, results in host_results:
+        for mode, code, stdout, perfdata in results:
+            if code:
+                problems += 1
+            service = options.service_format.format(host=host_name, mode=mode)
+            spool.add(host_name, service, code, nagios_output(code, stdout, perfdata), started, finished)
+    count = spool.flush()
+    return 'OK: {} passive results for {} hosts submitted, {} with problems'.format(count, len(host_results), problems)
+
+def json_default(value):
+    import decimal
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return str(value)
+
+def driver_errors(driver):
+    """The connection errors of the driver module named driver, or nothing when it was never imported."""
+    module = sys.modules.get(driver)
+    if module is None:
+        return ()
+    return (module.OperationalError, module.InterfaceError)
+
+def dict_cursor(connection, driver):
+    """A cursor returning rows as dicts; brokered connections get one without importing the driver."""
+    if isinstance(connection, LazyConnection):
+        connection = connection.connect()
+    if isinstance(connection, BrokerConnection):
+        return BrokerCursor(connection, True)
+    import importlib
+    return connection.cursor(importlib.import_module(driver).cursors.DictCursor)
+
+class BrokerCursor(object):
+    
+    def __init__(self, broker, as_dict=False):
+        self.broker = broker
+        self.as_dict = as_dict
+        self.rows = []
+    
+    def execute(self, query, params=None):
+        rows = self.broker.execute(query, params, self.as_dict)
+        self.rows = rows if self.as_dict else [tuple(row) for row in rows]
+    
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+    
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+    
+    def close(self):
+        pass
+
+class BrokerConnection(object):
+    """Connection lookalike that runs queries on a connection pooled by a --collector."""
+    
+    def __init__(self, driver, socket_path, connect):
+        import socket
+        self.driver = driver
+        self.connect = connect
+        self.client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.client.connect(socket_path)
+        self.reader = self.client.makefile('rb')
+    
+    def execute(self, query, params=None, as_dict=False):
+        import json
+        request = { 'op' : 'execute', 'connect' : self.connect, 'query' : query, 'params' : params, 'dict' : as_dict }
+        self.client.sendall((json.dumps(request, default=json_default) + '\n').encode('utf-8'))
+        reply = json.loads(self.reader.readline().decode('utf-8'))
+        if 'error' in reply:
+            import importlib
+            module = importlib.import_module(self.driver)
+            raise getattr(module, reply.get('type') or '', module.OperationalError)(reply['error'])
+        return reply['rows']
+    
+    def cursor(self, cursor_class=None):
+        return BrokerCursor(self, cursor_class is not None)
+    
+    def close(self):
+        self.reader.close()
+        self.client.close()
+
+class ConnectionPool(object):
+    """Warm connections of the driver kept per server, user and database and recycled by idle time and age."""
+    
+    def __init__(self, driver, max_idle=300, max_age=3600, check_after=30):
+        import threading
+        self.driver = driver
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.check_after = check_after
+        self.idle = {}
+        self.lock = threading.Lock()
+    
+    def key(self, connect):
+        import hashlib
+        password = hashlib.sha256(connect['password'].encode('utf-8')).hexdigest()
+        return (connect['host'], connect.get('port'), connect.get('unix_socket'), connect['user'], connect.get('database'), password)
+    
+    def borrow(self, connect):
+        key = self.key(connect)
+        while True:
+            with self.lock:
+                entries = self.idle.get(key)
+                entry = entries.pop() if entries else None
+            if entry is None:
+                break
+            now = time.time()
+            if now - entry['created'] > self.max_age:
+                self.discard(entry)
+                continue
+            if now - entry['used'] > self.check_after:
+                try:
+                    cur = entry['connection'].cursor()
+                    cur.execute('SELECT 1')
+                    cur.fetchall()
+                except Exception:
+                    self.discard(entry)
+                    continue
+            return key, entry
+        import importlib
+        now = time.time()
+        return key, { 'connection' : importlib.import_module(self.driver).connect(**connect), 'created' : now, 'used' : now }
+    
+    def release(self, key, entry):
+        entry['used'] = time.time()
+        with self.lock:
+            self.idle.setdefault(key, []).append(entry)
+    
+    def discard(self, entry):
+        try:
+            entry['connection'].close()
+        except Exception:
+            pass
+    
+    def execute(self, request):
+        key, entry = self.borrow(request['connect'])
+        try:
+            cur = dict_cursor(entry['connection'], self.driver) if request.get('dict') else entry['connection'].cursor()
+            cur.execute(request['query'], tuple(request['params']) if request.get('params') else None)
+            rows = cur.fetchall()
+        except driver_errors(self.driver):
+            self.discard(entry)
+            raise
+        except Exception:
+            self.release(key, entry)
+            raise
+        self.release(key, entry)
+        return rows
+    
+    def reap(self):
+        now = time.time()
+        expired = []
+        with self.lock:
+            for key, entries in list(self.idle.items()):
+                keep = []
+                for entry in entries:
+                    if now - entry['used'] > self.max_idle or now - entry['created'] > self.max_age:
+                        expired.append(entry)
+                    else:
+                        keep.append(entry)
+                if keep:
+                    self.idle[key] = keep
+                else:
+                    del self.idle[key]
+        for entry in expired:
+            self.discard(entry)
+    
+    def run(self):
+        while True:
+            time.sleep(min(self.max_idle, self.max_age, 60))
+            self.reap()
+    
+    def close(self):
+        with self.lock:
+            entries = [entry for key in self.idle for entry in self.idle[key]]
+            self.idle = {}
+        for entry in entries:
+            self.discard(entry)
+
+class LazyConnection(object):
+    """Logs in on first use, so checks answered from the snapshot cache never connect."""
+    
+    def __init__(self, options, connect_db):
+        self.options = options
+        self.connect_db = connect_db
+        self.connection = None
+    
+    def connect(self):
+        if self.connection is None:
+            self.connection = self.connect_db(self.options)[0]
+        return self.connection
+    
+    def cursor(self, *args, **kwargs):
+        return self.connect().cursor(*args, **kwargs)
+    
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+def private_dir(driver):
+    """The directory of this user's cache, state and history files of the driver's plugins, created with mode 0700.
+    
+    A directory that is a symlink, belongs to another user or is open to others is refused, since
+    whoever controls it could plant entries or swap a file for a link."""
+    import errno
+    import stat
+    import tempfile
+    path = '{}/{}-checks-{}'.format(tempfile.gettempdir(), driver[2:], os.geteuid())
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.geteuid() or info.st_mode & 0o077:
+        raise Exception('{} is not a private directory of this user.'.format(path))
+    return path
+
+STATE_TTL = 7 * 24 * 3600
+
+STATE_STORES = {}
+
+#~ Set by the --collector and --exporter daemons, see use_state_namespace()
+STATE_NAMESPACE = ''
+
+def pack_values(values):
+    return struct.pack('<{}d'.format(len(values)), *[float(v) for v in values])
+
+def unpack_values(blob):
+    return struct.unpack('<{}d'.format(len(blob) // 8), blob)
+
+class DeltaStateStore(object):
+    """Previous samples of the delta modes, kept in one SQLite database per driver, host and namespace."""
+    
+    def __init__(self, driver, host, ttl=STATE_TTL, namespace=''):
+        import sqlite3
+        import hashlib
+        import stat
+        name = hashlib.sha1(host.encode('utf-8')).hexdigest()[:16]
+        self.path = '{}/{}state-{}.db'.format(private_dir(driver), namespace + '-' if namespace else '', name)
+        if os.path.lexists(self.path):
+            info = os.lstat(self.path)
+            if not stat.S_ISREG(info.st_mode) or info.st_uid != os.geteuid():
+                raise Exception('{} is not a state database of this user.'.format(self.path))
+        self.ttl = ttl
+        self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS samples (key TEXT PRIMARY KEY, time REAL NOT NULL, value BLOB NOT NULL)')
+    
+    def exchange(self, key, value, now=None):
+        """Store a packed sample taken at now (default: the current time) under key, returning its time and the previous (time, value) or None.
+        
+        value may also be a function of that previous (time, value) or None returning the packed sample, for state built from the last one."""
+        with TIMER.phase('state', key):
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if now is None:
+                    now = time.time()
+                last_run = self.db.execute('SELECT time, value FROM samples WHERE key=?', (key,)).fetchone()
+                if last_run:
+                    last_run = (last_run[0], bytes(last_run[1]))
+                if callable(value):
+                    value = value(last_run)
+                self.db.execute('INSERT OR REPLACE INTO samples (key, time, value) VALUES (?, ?, ?)', (key, now, value))
+                self.db.execute('DELETE FROM samples WHERE time < ?', (now - self.ttl,))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return now, last_run
+
+def state_store(driver, host):
+    if (driver, host, STATE_NAMESPACE) not in STATE_STORES:
+        with TIMER.phase('state', 'open'):
+            STATE_STORES[driver, host, STATE_NAMESPACE] = DeltaStateStore(driver, host, namespace=STATE_NAMESPACE)
+    return STATE_STORES[driver, host, STATE_NAMESPACE]
+
+def use_state_namespace(namespace):
+    """Keep the delta samples of this process under namespace, apart from those of the checks.
+    
+    The polls of a daemon and the checks of the same host would otherwise take turns on one sample
+    and each compute its rates over the short interval since the other's run."""
+    global STATE_NAMESPACE
+    STATE_NAMESPACE = namespace
+
+CACHE_WAIT = 10
+
+class SnapshotCache(object):
+    """Query results shared for ttl seconds by the checks of one host, refreshed under flock by one of them while the others wait."""
+    
+    def __init__(self, driver, host, user, ttl, wait=CACHE_WAIT):
+        self.driver = driver
+        self.host = host
+        self.user = user
+        self.ttl = ttl
+        self.wait = wait
+    
+    def path(self, query, params):
+        import json
+        import hashlib
+        key = json.dumps([self.host, self.user, query, params], default=json_default)
+        return '{}/cache-{}.json'.format(private_dir(self.driver), hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+    
+    def load(self, path):
+        """Return (time, rows) of a fresh entry written by this user, or None."""
+        import json
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        except OSError:
+            return None
+        try:
+            with os.fdopen(fd) as cache_file:
+                if os.fstat(cache_file.fileno()).st_uid != os.geteuid():
+                    return None
+                entry = json.load(cache_file)
+            fetched, rows = float(entry['time']), entry['rows']
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+        if 0 <= time.time() - fetched <= self.ttl:
+            return fetched, rows
+        return None
+    
+    def store(self, path, fetched, rows):
+        import json
+        import tempfile
+        #~ A fresh name only this user can open, so nothing can be linked in its place
+        fd, tmpname = tempfile.mkstemp(prefix='.cache-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump({ 'time' : fetched, 'rows' : rows }, cache_file, default=json_default)
+            #~ Readers never take the lock, so the entry has to appear in one step
+            os.rename(tmpname, path)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+    
+    def rows(self, query, params, fetch):
+        """Return (rows, time fetched) for query, calling fetch() only when the entry has expired."""
+        import fcntl
+        path = self.path(query, params)
+        with TIMER.phase('cache', 'read'):
+            entry = self.load(path)
+        if entry:
+            return entry[1], entry[0]
+        with open(path + '.lock', 'a') as lock_file:
+            locked = False
+            with TIMER.phase('cache', 'wait'):
+                deadline = time.time() + self.wait
+                while not locked:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        locked = True
+                    except (IOError, OSError):
+                        if time.time() >= deadline:
+                            break
+                        time.sleep(0.05)
+            try:
+                #~ Another check may have refreshed the entry while this one waited
+                entry = self.load(path)
+                if entry:
+                    return entry[1], entry[0]
+                fetched = time.time()
+                rows = fetch()
+                if locked:
+                    self.store(path, fetched, rows)
+                return rows, fetched
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def snapshot_cache(driver, options, host):
+    ttl = getattr(options, 'cache_ttl', None)
+    if not ttl:
+        return None
+    return SnapshotCache(driver, host, options.user, ttl)
+
+def query_rows(connection, query, params=None, cache=None, dict_driver=None):
+    """Run query and return (rows, time fetched), through the snapshot cache when one is given.
+    
+    Rows are dicts when dict_driver names the driver to take the DictCursor from."""
+    def fetch():
+        cur = dict_cursor(connection, dict_driver) if dict_driver else connection.cursor()
+        cur.execute(query, params)
+        return list(cur.fetchall())
+    if cache is None:
+        fetched = time.time()
+        return fetch(), fetched
+    return cache.rows(query, params, fetch)
+
+HISTORY_SLOTS = 10080
+HISTORY_MAGIC = b'CHKHIST1'
+#~ magic, slots, record size and the number of records ever appended, followed by (timestamp, value) float64 pairs
+HISTORY_HEADER = struct.Struct('<8sIIQ')
+HISTORY_RECORD = struct.Struct('<dd')
+
+HISTORY_RINGS = {}
+
+class HistoryRing(object):
+    """Fixed-size ring of (timestamp, value) records in a memory-mapped file, so appends are O(1) and the file never grows."""
+    
+    def __init__(self, path, slots=HISTORY_SLOTS):
+        import fcntl
+        import mmap
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        if os.fstat(self.fd).st_uid != os.geteuid():
+            os.close(self.fd)
+            raise Exception('{} is not a history ring of this user.'.format(path))
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            created = os.fstat(self.fd).st_size == 0
+            if created:
+                os.ftruncate(self.fd, HISTORY_HEADER.size + HISTORY_RECORD.size * slots)
+            self.map = mmap.mmap(self.fd, 0)
+            if created:
+                HISTORY_HEADER.pack_into(self.map, 0, HISTORY_MAGIC, slots, HISTORY_RECORD.size, 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        #~ An existing ring keeps the size it was created with
+        magic, self.slots, record_size, total = HISTORY_HEADER.unpack_from(self.map, 0)
+        if magic != HISTORY_MAGIC or record_size != HISTORY_RECORD.size or len(self.map) != HISTORY_HEADER.size + record_size * self.slots:
+            raise Exception('{} is not a history ring.'.format(path))
+    
+    def total(self):
+        return HISTORY_HEADER.unpack_from(self.map, 0)[3]
+    
+    def append(self, timestamp, value):
+        import fcntl
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            total = self.total()
+            HISTORY_RECORD.pack_into(self.map, HISTORY_HEADER.size + HISTORY_RECORD.size * (total % self.slots), timestamp, value)
+            #~ The count goes last, so readers never see it ahead of its record
+            struct.pack_into('<Q', self.map, HISTORY_HEADER.size - 8, total + 1)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+    
+    def chunks(self):
+        """The records oldest first, as one or two memoryviews of the mapped file with alternating timestamps and values."""
+        total = self.total()
+        data = memoryview(self.map)[HISTORY_HEADER.size:]
+        if total <= self.slots:
+            parts = [data[:total * HISTORY_RECORD.size]]
+        else:
+            start = (total % self.slots) * HISTORY_RECORD.size
+            parts = [data[start:], data[:start]]
+        return [part.cast('d') for part in parts if len(part)]
+    
+    def samples(self):
+        """Yield (timestamp, value) oldest first without copying the ring."""
+        if sys.byteorder != 'little':
+            for part in self.chunks():
+                for record in HISTORY_RECORD.iter_unpack(part.cast('B')):
+                    yield record
+            return
+        for part in self.chunks():
+            for i in range(0, len(part), 2):
+                yield part[i], part[i + 1]
+
+def history_path(driver, host, key):
+    import hashlib
+    name = hashlib.sha1('{}|{}'.format(host, key).encode('utf-8')).hexdigest()[:16]
+    return '{}/history-{}.ring'.format(private_dir(driver), name)
+
+def history_ring(driver, host, key, slots=HISTORY_SLOTS):
+    path = history_path(driver, host, key)
+    if path not in HISTORY_RINGS:
+        with TIMER.phase('history', 'open'):
+            HISTORY_RINGS[path] = HistoryRing(path, slots)
+    return HISTORY_RINGS[path]
+
+def record_history(driver, options, host, key, label, timestamp, value):
+    """Append value to the --history ring of key on host, when --history is given."""
+    if not getattr(options, 'history', False) or value is None:
+        return
+    ring = history_ring(driver, host, key, getattr(options, 'history_size', None) or HISTORY_SLOTS)
+    with TIMER.phase('history', label):
+        ring.append(timestamp or time.time(), float(value))
+
+def report_history(driver, host, key, subject):
+    """Print the --history samples of key on host, oldest first; subject names them in the messages."""
+    if not os.path.exists(history_path(driver, host, key)):
+        raise NagiosReturn('UNKNOWN: No history of {}, run the check with --history first.'.format(subject), 3)
+    samples = list(history_ring(driver, host, key).samples())
+    if not samples:
+        raise NagiosReturn('UNKNOWN: The history of {} is empty.'.format(subject), 3)
+    values = [value for timestamp, value in samples]
+    summary = 'OK: {} samples of {} since {}, min {} avg {} max {}'.format(
+            len(samples), subject, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(samples[0][0])),
+            min(values), sum(values) / len(values), max(values))
+    raise NagiosReturn('\n'.join([summary] + ['{:.0f} {}'.format(timestamp, value) for timestamp, value in samples]), 0)
+
+def perfdata_samples(perfdata):
+    """Yield (label, value) for every entry of a perfdata string that has a value."""
+    for entry in perfdata.split():
+        label, _, data = entry.partition('=')
+        value = data.split(';')[0].rstrip('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ%/')
+        try:
+            yield label.strip("'"), float(value)
+        except ValueError:
+            continue
+
+def metric_name(prefix, label):
+    return '{}_{}'.format(prefix, '_'.join(''.join(c if c.isalnum() else ' ' for c in label.lower()).split()))
+
+def prometheus_labels(labels):
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in sorted(labels.items())]
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in escaped) + '}'
+
+def render_metrics(prefix, hosts, modes):
+    """The newest results of the collector hosts in the Prometheus text format, built from memory without querying.
+    
+    modes is the MODES table of the plugin, whose 'help' entries describe the metrics. The collector
+    hosts were checked against it when they were set up, see read_collector_config()."""
+    families = {}
+    seen = set()
+    
+    def add(name, help_text, labels, value):
+        sample = '{}{}'.format(name, prometheus_labels(labels))
+        if sample in seen:
+            return
+        seen.add(sample)
+        families.setdefault(name, (help_text, []))[1].append('{} {}'.format(sample, repr(float(value))))
+    
+    for collector_host in hosts:
+        #~ A copy, the host's thread replaces entries while a scrape is rendered
+        results = dict(collector_host.results)
+        host = { 'host' : collector_host.host }
+        connected = results.get('time2connect')
+        add(prefix + '_up', 'Whether the last poll reached the server.', host, connected is not None and connected['error'] is None)
+        if connected and connected['result'] is not None:
+            add(prefix + '_time2connect_seconds', 'Time the collector took to log in.', host, connected['result'])
+        for mode, collected in sorted(results.items()):
+            if mode == 'time2connect' or collected is None:
+                continue
+            add(prefix + '_poll_time_seconds', 'Unix time of the last poll of the mode.', dict(host, mode=mode), collected['time'])
+            add(prefix + '_poll_error', 'Whether the mode failed in the last poll.', dict(host, mode=mode), collected['error'] is not None)
+            for label, labels, value in collector_host.samples(mode, collected):
+                add(metric_name(prefix, label), modes[mode]['help'], dict(host, **labels), value)
+    lines = []
+    for name in sorted(families):
+        help_text, samples = families[name]
+        lines.append('# HELP {} {}'.format(name, help_text.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+def start_exporter(address, render):
+    """Serve render() as /metrics on address (host:port) from a background thread."""
+    import threading
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import socketserver
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        import SocketServer as socketserver
+    
+    class ExporterHandler(BaseHTTPRequestHandler):
+        
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    class ExporterServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+    
+    host, _, port = address.rpartition(':')
+    server = ExporterServer((host or '127.0.0.1', int(port)), ExporterHandler)
+    thread = threading.Thread(target=server.serve_forever, name='exporter')
+    thread.daemon = True
+    thread.start()
+    return server
+
+def serve_exporter(address, render, poller):
+    """Serve render() as /metrics on address while poller.run() polls, until SIGTERM."""
+    import signal
+    use_state_namespace('collector')
+    server = start_exporter(address, render)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        poller.run()
+    finally:
+        server.shutdown()
+        server.server_close()
+        poller.close()
+
+class CollectorHost(object):
+    """The modes of one server polled every interval seconds by a --collector or --exporter, the newest results kept in memory.
+    
+    connect(options) logs in, collect(connection, options, modes, host) runs the modes and returns (mode, query, error) tuples."""
+    
+    def __init__(self, options, modes, interval, host, connect, collect):
+        self.options = options
+        self.modes = modes
+        self.interval = interval
+        self.host = host
+        self.connect = connect
+        self.collect = collect
+        self.results = {}
+        self.connection = None
+    
+    def poll(self):
+        now = time.time()
+        try:
+            if self.connection is None:
+                self.connection = self.connect(self.options)
+            else:
+                #~ A kept connection is timed with a round trip, so time2connect stays current between logins
+                cur = self.connection.cursor()
+                cur.execute('SELECT 1')
+                cur.fetchall()
+            self.results['time2connect'] = { 'time' : now, 'result' : time.time() - now, 'error' : None }
+            for mode, query, error in self.collect(self.connection, self.options, self.modes, self.host):
+                self.results[mode] = {  'time'      : now,
+                                        'result'    : query.result if error is None else None,
+                                        'perfdata'  : self.perfdata(query) if error is None else '',
+                                        'error'     : str(error) if error is not None else None }
+        except Exception as e:
+            self.close()
+            for mode in self.modes + ['time2connect']:
+                self.results[mode] = { 'time' : now, 'result' : None, 'error' : str(e) }
+    
+    def perfdata(self, query):
+        """The mode's perfdata without thresholds, the source of the --exporter metrics."""
+        try:
+            return query.evaluate()[2]
+        except Exception:
+            return ''
+    
+    def samples(self, mode, collected):
+        """Yield (label, labels, value) of the metrics of one collected mode: every value of its perfdata."""
+        for label, value in perfdata_samples(collected.get('perfdata') or ''):
+            yield label, {}, value
+    
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+    
+    def run(self):
+        while True:
+            started = time.time()
+            self.poll()
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+def read_collector_config(driver, path, modes, default_modes, make_host):
+    """The socket path, the hosts built by make_host(options, modes, interval) and the connection pool of a --collector configuration.
+    
+    modes is the MODES table of the plugin, a host asking for a mode outside it is refused."""
+    try:
+        import configparser
+    except ImportError:
+        import ConfigParser as configparser
+    from optparse import Values
+    config = configparser.RawConfigParser()
+    if not config.read(path):
+        raise IOError('Cannot read collector configuration {}'.format(path))
+    socket_path = config.get('collector', 'socket')
+    interval = config.getint('collector', 'interval') if config.has_option('collector', 'interval') else 60
+    pool = ConnectionPool(  driver,
+                            config.getint('collector', 'max_idle') if config.has_option('collector', 'max_idle') else 300,
+                            config.getint('collector', 'max_age') if config.has_option('collector', 'max_age') else 3600 )
+    hosts = []
+    for section in config.sections():
+        if section == 'collector':
+            continue
+        settings = dict(config.items(section))
+        options = Values({  'hostname'      : settings.get('hostname', section),
+                            'user'          : settings['user'],
+                            'password'      : settings['password'],
+                            'instance'      : settings.get('instance'),
+                            'port'          : settings.get('port'),
+                            'socket_path'   : settings.get('socket_path'),
+                            'mode'          : None,
+                            'warning'       : None,
+                            'critical'      : None })
+        host_modes = settings.get('modes', 'all')
+        if host_modes == 'all':
+            host_modes = list(default_modes)
+        else:
+            host_modes = [m.strip() for m in host_modes.split(',') if m.strip()]
+        for mode in host_modes:
+            if mode not in modes or mode in ('time2connect', 'test'):
+                raise IOError('Unknown mode {} for {} in {}'.format(mode, section, path))
+        hosts.append(make_host(options, host_modes, int(settings.get('interval', interval))))
+    return socket_path, hosts, pool
+
+def run_collector(driver, options, modes, default_modes, make_host):
+    """Poll the hosts of the --collector configuration and answer checks and brokered queries on its socket.
+    
+    modes is the MODES table of the plugin, default_modes the modes of hosts without a modes setting."""
+    import json
+    import threading
+    import importlib
+    import signal
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+    
+    #~ Loaded up front so the first poll's time2connect does not include it
+    importlib.import_module(driver)
+    use_state_namespace('collector')
+    socket_path, hosts, pool = read_collector_config(driver, options.collector, modes, default_modes, make_host)
+    collected = dict((collector_host.host, collector_host) for collector_host in hosts)
+    
+    class CollectorHandler(socketserver.StreamRequestHandler):
+        
+        def reply(self, request):
+            if request.get('op') == 'execute':
+                try:
+                    return { 'rows' : pool.execute(request) }
+                except Exception as e:
+                    return { 'error' : str(e), 'type' : type(e).__name__ }
+            collector_host = collected.get(request['host'])
+            if collector_host is None:
+                return { 'error' : 'Host {} is not collected'.format(request['host']) }
+            return {    'interval'  : collector_host.interval,
+                        'results'   : dict((mode, collector_host.results.get(mode)) for mode in request['modes']) }
+        
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    reply = self.reply(json.loads(line.decode('utf-8')))
+                except Exception as e:
+                    reply = { 'error' : 'Bad collector request: {}'.format(e) }
+                self.wfile.write((json.dumps(reply, default=json_default) + '\n').encode('utf-8'))
+    
+    class CollectorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+    
+    for target, name in [(h.run, h.host) for h in hosts] + [(pool.run, 'pool')]:
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+    
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = CollectorServer(socket_path, CollectorHandler)
+    os.chmod(socket_path, 0o660)
+    exporter = start_exporter(options.exporter, lambda: render_metrics(driver[2:], hosts, modes)) if options.exporter else None
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        if exporter is not None:
+            exporter.shutdown()
+            exporter.server_close()
+        server.server_close()
+        os.unlink(socket_path)
+        pool.close()
+        for collector_host in hosts:
+            collector_host.close()
+
+def collector_request(socket_path, request):
+    """Send one request to the --collector listening on socket_path and return its reply."""
+    import json
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        return json.loads(client.makefile('rb').readline().decode('utf-8'))
+    finally:
+        client.close()
@@ -25,23 +25,32 @@
 # License    : GPLv2 (LICENSE.md / https://www.gnu.org/licenses/old-licenses/gpl-2.0.html)
 ########################################################################
 
-import pymysql
 import time
 import sys
-import tempfile
-import traceback
-try:
-    import cPickle as pickle
-except:
-    import pickle
+import struct
 from optparse import OptionParser, OptionGroup
+from plugin_common import (STATUS_PREFIXES, SEVERITY, nagios_output, return_batch, TIMER, NagiosReturn,
+                           is_within_range, spool_results, driver_errors, BrokerConnection, LazyConnection,
+                           pack_values, unpack_values, state_store, snapshot_cache, query_rows, HISTORY_SLOTS,
+                           record_history, report_history, render_metrics, serve_exporter, CollectorHost,
+                           run_collector, collector_request)
+
+#~ Driver module, imported by name only once the check talks to a server
+DRIVER = 'pymysql'
 
 BASE_QUERY = "SELECT cntr_value FROM sysperfinfo WHERE counter_name='{}' AND instance_name='';"
 INST_QUERY = "SELECT cntr_value FROM sysperfinfo WHERE counter_name='{}' AND instance_name='{}';"
 OBJE_QUERY = "SELECT cntr_value FROM sysperfinfo WHERE counter_name='{}';"
 SLAVE_QUERY = "SHOW SLAVE STATUS"
+REPLICA_QUERY = "SHOW REPLICA STATUS"
 DIVI_QUERY = "SELECT cntr_value FROM sysperfinfo WHERE counter_name LIKE '{}%' AND instance_name='{}';"
 CON_QUERY = "SHOW /*!50000 global */ STATUS LIKE 'Threads_connected'"
+STATUS_QUERY = "SHOW GLOBAL STATUS"
+VARIABLES_QUERY = "SHOW GLOBAL VARIABLES"
+DIGEST_QUERY = "SELECT DIGEST, SCHEMA_NAME, LEFT(DIGEST_TEXT, 80), COUNT_STAR, SUM_TIMER_WAIT, SUM_ROWS_EXAMINED "\
+    "FROM performance_schema.events_statements_summary_by_digest "\
+    "WHERE DIGEST IS NOT NULL "\
+    "ORDER BY SUM_TIMER_WAIT DESC LIMIT %s"
 MEM_QUERY = "SELECT 100*(1.0-(available_physical_memory_kb/(total_physical_memory_kb*1.0))) FROM sys.dm_os_sys_memory;" 
 CPU_QUERY = "SELECT "\
     "record.value('(./Record/SchedulerMonitorEvent/SystemHealth/ProcessUtilization)[1]', 'int') AS [CPU] "\
@@ -73,19 +82,101 @@ MODES = {
                             'query'     : CPU_QUERY
                             },
 
-    'slave'		: { 'help'      : 'Page Life Expectancy',
-                            'query'     : SLAVE_QUERY,
-			    'stdout'	: '{} file {} {}/{}',
+    'qps'               : { 'help'      : 'Queries per second',
+                            'stdout'    : 'Queries per second is {}',
+                            'label'     : 'qps',
+                            'type'      : 'status',
+                            'metric'    : ('rate', ['Questions']),
+                            },
+
+    'comrates'          : { 'help'      : 'SELECT, INSERT, UPDATE, DELETE, COMMIT and ROLLBACK statements per second',
+                            'stdout'    : 'Statements per second is {}',
+                            'label'     : 'statements',
+                            'type'      : 'status',
+                            'metric'    : ('rate', ['Com_select', 'Com_insert', 'Com_update', 'Com_delete', 'Com_commit', 'Com_rollback']),
+                            },
+
+    'bufferpoolhit'     : { 'help'      : 'InnoDB buffer pool hit ratio over the last interval',
+                            'stdout'    : 'InnoDB buffer pool hit ratio is {}%',
+                            'label'     : 'buffer_pool_hit_ratio',
+                            'unit'      : '%',
+                            'type'      : 'status',
+                            'metric'    : ('hitratio', ['Innodb_buffer_pool_reads', 'Innodb_buffer_pool_read_requests']),
+                            },
+
+    'threadsrunning'    : { 'help'      : 'Threads running',
+                            'stdout'    : 'Threads running is {}',
+                            'label'     : 'threads_running',
+                            'type'      : 'status',
+                            'metric'    : ('value', ['Threads_running']),
+                            },
+
+    'abortedconnects'   : { 'help'      : 'Aborted connection attempts per second',
+                            'stdout'    : 'Aborted connects per second is {}',
+                            'label'     : 'aborted_connects',
+                            'type'      : 'status',
+                            'metric'    : ('rate', ['Aborted_connects']),
+                            },
+
+    'tmpdiskratio'      : { 'help'      : 'Percentage of temporary tables created on disk over the last interval',
+                            'stdout'    : 'Temporary tables created on disk is {}%',
+                            'label'     : 'tmp_disk_tables',
+                            'unit'      : '%',
+                            'type'      : 'status',
+                            'metric'    : ('ratio', ['Created_tmp_disk_tables', 'Created_tmp_tables']),
+                            },
+
+    'bytesin'           : { 'help'      : 'Bytes received per second',
+                            'stdout'    : 'Bytes received per second is {}',
+                            'label'     : 'bytes_in',
+                            'unit'      : 'B',
+                            'type'      : 'status',
+                            'metric'    : ('rate', ['Bytes_received']),
+                            },
+
+    'bytesout'          : { 'help'      : 'Bytes sent per second',
+                            'stdout'    : 'Bytes sent per second is {}',
+                            'label'     : 'bytes_out',
+                            'unit'      : 'B',
+                            'type'      : 'status',
+                            'metric'    : ('rate', ['Bytes_sent']),
+                            },
+
+    'connectionusage'   : { 'help'      : 'Connections in use as a percentage of max_connections',
+                            'stdout'    : 'Connection usage is {}%',
+                            'label'     : 'connection_usage',
+                            'unit'      : '%',
+                            'type'      : 'status',
+                            'metric'    : ('usage', ['Threads_connected', 'max_connections']),
+                            },
+
+    'slave'             : { 'help'      : 'Replication IO and SQL threads of every channel',
+                            'query'     : REPLICA_QUERY,
+                            'stdout'    : 'file {} {}/{}',
+                            'label'     : 'stopped_channels',
                             'type'      : 'slave',
-			    'modifier'  : '100'
                             },
     
-    'slavelag'		: { 'help'      : 'Page Life Expectancy',
-			    'stdout'	: 'SLAVE is {} seconds behind',
-			    'label'	: 'lag',
-                            'query'     : SLAVE_QUERY,
+    'slavelag'          : { 'help'      : 'Replication lag of every channel',
+                            'stdout'    : 'SLAVE is {} seconds behind',
+                            'label'     : 'lag',
+                            'query'     : REPLICA_QUERY,
                             'type'      : 'lag',
                             },
+    
+    'gtidgap'           : { 'help'      : 'GTID transactions retrieved but not yet executed by every channel',
+                            'stdout'    : 'GTID gap is {} transactions',
+                            'label'     : 'gtid_gap',
+                            'query'     : REPLICA_QUERY,
+                            'type'      : 'gtidgap',
+                            },
+    
+    'digestregression'  : { 'help'      : 'Statement digests whose latency or rows examined per call grew since the previous run',
+                            'stdout'    : 'Worst statement digest regression is {} times the previous average',
+                            'label'     : 'digest_regression',
+                            'query'     : DIGEST_QUERY,
+                            'type'      : 'digest',
+                            },
    
     #~ 'debug'             : { 'help'      : 'Used as a debugging tool.',
                             #~ 'stdout'    : 'Debugging: ',
@@ -100,42 +191,40 @@ MODES = {
 
 }
 
-def return_nagios(options, stdout='', result='', unit='', label=''):
+#~ Statement digests read and kept by the digestregression mode, and calls they need in an interval
+DIGEST_LIMIT = 100
+DIGEST_MIN_CALLS = 10
 
-    if type(result) is not tuple:
-        if is_within_range(options.critical, result):
-            prefix = 'CRITICAL: '
-            code = 2
-        elif is_within_range(options.warning, result):
-            prefix = 'WARNING: '
-            code = 1
-        else:
-            prefix = 'OK: '
-            code = 0
-        strresult = str(result)
+#~ Modes run by --hosts when neither -m nor --modes is given
+REPLICA_MODES = ['connections', 'slavelag', 'slave']
+
+def format_nagios(options, stdout='', result='', unit='', label=''):
+
+    if result is None:
+        #~ Delta modes reseeding after their first run, a restart or a counter wrap
         try:
-            stdout = stdout.format(strresult)
+            stdout = stdout.format('unknown') + ' (new baseline sample)'
         except TypeError as e:
             pass
-        stdout = '{}{}| {}={}{};{};{};;'.format(prefix, stdout, label, strresult, unit, options.warning or '', options.critical or '')
-        raise NagiosReturn(stdout, code)
+        return 0, stdout, '{}=U;{};{};;'.format(label, options.warning or '', options.critical or '')
+    if is_within_range(options.critical, result):
+        code = 2
+    elif is_within_range(options.warning, result):
+        code = 1
     else:
-        if result[0] and result [1] == 'Yes':
-            status = 'OK:'
-            code = 0
-        else: 
-            status = 'CRITICAL:'
-            code = 0
-        stdout = stdout.format(status, result[2], result[3], result[4])
-        raise NagiosReturn(stdout, code)
-
-class NagiosReturn(Exception):
+        code = 0
+    strresult = str(result)
+    try:
+        stdout = stdout.format(strresult)
+    except TypeError as e:
+        pass
+    perfdata = '{}={}{};{};{};;'.format(label, strresult, unit, options.warning or '', options.critical or '')
+    return code, stdout, perfdata
 
-    
-    def __init__(self, message, code):
+def return_nagios(options, stdout='', result='', unit='', label=''):
 
-        self.message = message
-        self.code = code
+    code, stdout, perfdata = format_nagios(options, stdout, result, unit, label)
+    raise NagiosReturn(nagios_output(code, stdout, TIMER.perfdata(perfdata)), code)
 
 class MYSQLQuery(object):
 
@@ -150,12 +239,28 @@ class MYSQLQuery(object):
         self.options = options
         self.host = host
         self.modifier = modifier
+        self.sample_time = None
     
+    def fetch_rows(self, connection, as_dict=True):
+
+        rows, self.sample_time = query_rows(connection, self.query, cache=snapshot_cache(DRIVER, self.options, self.host), dict_driver=DRIVER if as_dict else None)
+        return rows
+
     def run_on_connection(self, connection):
 
-        cur = connection.cursor(pymysql.cursors.DictCursor)
-        cur.execute(self.query)
-        self.query_result = cur.fetchone()['Value']
+        self.query_result = self.fetch_rows(connection)[0]['Value']
+
+    def evaluate(self):
+
+        return format_nagios(   self.options,
+                                self.stdout,
+                                self.result,
+                                self.unit,
+                                self.label )
+
+    def state_key(self):
+
+        return self.query
 
     def finish(self):
 
@@ -168,11 +273,22 @@ class MYSQLQuery(object):
     def calculate_result(self):
 
         self.result = float(self.query_result) * self.modifier
+
+    def history_value(self):
+
+        return self.result
+
+    def record(self):
+        """Append the result to the host's --history ring of this mode."""
+
+        record_history(DRIVER, self.options, self.host, self.label, self.label, self.sample_time, self.history_value())
     
     def do(self, connection):
 
-        self.run_on_connection(connection)
+        with TIMER.phase('query', self.label):
+            self.run_on_connection(connection)
         self.calculate_result()
+        self.record()
         self.finish()
 
 class MYSQLDivideQuery(MYSQLQuery):
@@ -191,79 +307,394 @@ class MYSQLDivideQuery(MYSQLQuery):
     
     def run_on_connection(self, connection):
 
-        cur = connection.cursor()
-        cur.execute(self.query)
-        self.query_result = [x[0] for x in cur.fetchall()]
+        self.query_result = [x[0] for x in self.fetch_rows(connection, False)]
 
 class MYSQLDeltaQuery(MYSQLQuery):
 
     
-    def make_pickle_name(self):
-
-        tmpdir = tempfile.gettempdir()
-        tmpname = hash(self.host + self.query)
-        self.picklename = '{}/mysql-{}.tmp'.format(tmpdir, tmpname)
-    
     def calculate_result(self):
 
-        self.make_pickle_name()
+        new_val = float(self.query_result)
+        now, last_run = state_store(DRIVER, self.host).exchange(self.state_key(), pack_values([new_val]), self.sample_time)
+        self.result = None
         
-        try:
-            tmpfile = open(self.picklename)
-        except IOError:
-            tmpfile = open(self.picklename, 'w')
-            tmpfile.close()
-            tmpfile = open(self.picklename)
-        try:
-            try:
-                last_run = pickle.load(tmpfile)
-            except EOFError as ValueError:
-                last_run = { 'time' : None, 'value' : None }
-        finally:
-            tmpfile.close()
-        
-        if last_run['time']:
-            old_time = last_run['time']
-            new_time = time.time()
-            old_val  = last_run['query_result']
-            new_val  = self.query_result
-            self.result = ((new_val - old_val) / (new_time - old_time)) * self.modifier
-        else:
-            self.result = None
-        
-        new_run = { 'time' : time.time(), 'query_result' : self.query_result }
-        
-        #~ Will throw IOError, leaving it to acquiesce
-        tmpfile = open(self.picklename, 'w')
-        pickle.dump(new_run, tmpfile)
-        tmpfile.close()
+        if last_run:
+            old_time, old_val = last_run[0], unpack_values(last_run[1])[0]
+            #~ Status counters restart from zero with the server, so reseed silently when they go backwards
+            if old_val <= new_val and old_time < now:
+                self.result = ((new_val - old_val) / (now - old_time)) * self.modifier
+
+class StatusSnapshot(object):
+    """SHOW GLOBAL STATUS, and SHOW GLOBAL VARIABLES when asked for, read once and shared by the status modes."""
+
+    def __init__(self, status, variables=None, fetched=None):
 
-class MYSQLSlaveQuery(MYSQLQuery) :
+        self.status = dict((row['Variable_name'].lower(), row['Value']) for row in status)
+        self.variables = dict((row['Variable_name'].lower(), row['Value']) for row in variables or [])
+        self.time = fetched
 
+    @classmethod
+    def fetch(cls, connection, cache=None, variables=False):
+
+        status, fetched = query_rows(connection, STATUS_QUERY, cache=cache, dict_driver=DRIVER)
+        if variables:
+            variables = query_rows(connection, VARIABLES_QUERY, cache=cache, dict_driver=DRIVER)[0]
+        return cls(status, variables or None, fetched)
+
+    def get(self, name):
+
+        for values in (self.status, self.variables):
+            if name.lower() in values:
+                return float(values[name.lower()])
+        raise Exception('Status variable {} not found.'.format(name))
+
+class MYSQLStatusQuery(MYSQLQuery):
+    """A metric computed from the status snapshot, rates and ratios over the interval since the previous run."""
+
+    def __init__(self, metric, *args, **kwargs):
+
+        kwargs.setdefault('query', STATUS_QUERY)
+        super(MYSQLStatusQuery, self).__init__(*args, **kwargs)
+        self.kind, self.names = metric
+        self.variables = self.kind == 'usage'
+        self.rates = []
 
     def run_on_connection(self, connection):
 
-        cur = connection.cursor(pymysql.cursors.DictCursor)
-        cur.execute(self.query)
+        self.run_on_snapshot(StatusSnapshot.fetch(connection, snapshot_cache(DRIVER, self.options, self.host), self.variables))
+
+    def run_on_snapshot(self, snapshot):
 
-        self.query_result = cur.fetchone()
+        self.sample_time = snapshot.time
+        self.query_result = [snapshot.get(name) for name in self.names]
+        self.uptime = snapshot.get('Uptime')
+
+    def state_key(self):
+
+        return 'status|{}'.format(self.label)
 
     def calculate_result(self):
 
-        self.result =  self.query_result['Slave_IO_Running'],self.query_result['Slave_SQL_Running'],self.query_result['Relay_Master_Log_File'], self.query_result['Read_Master_Log_Pos'], self.query_result['Exec_Master_Log_Pos']
+        values = self.query_result
+        if self.kind == 'value':
+            self.result = values[0] * self.modifier
+            return
+        if self.kind == 'usage':
+            self.result = (100.0 * values[0] / values[1] if values[1] else 0.0) * self.modifier
+            return
+
+        now, last_run = state_store(DRIVER, self.host).exchange(self.state_key(), pack_values([self.uptime] + values), self.sample_time)
+        self.result = None
+        if not last_run:
+            return
+        old_time, last_values = last_run[0], unpack_values(last_run[1])
+        #~ A smaller Uptime means the server restarted and the counters began again from zero
+        if len(last_values) != len(values) + 1 or last_values[0] > self.uptime or old_time >= now:
+            return
+        deltas = [new - old for new, old in zip(values, last_values[1:])]
+        if any(delta < 0 for delta in deltas):
+            return
+        if self.kind == 'rate':
+            self.rates = [delta / (now - old_time) for delta in deltas]
+            self.result = sum(self.rates) * self.modifier
+        elif self.kind == 'ratio':
+            self.result = (100.0 * deltas[0] / deltas[1] if deltas[1] else 0.0) * self.modifier
+        elif self.kind == 'hitratio':
+            #~ Reads that missed the buffer pool against all read requests, no requests means nothing missed
+            self.result = (100.0 - 100.0 * deltas[0] / deltas[1] if deltas[1] else 100.0) * self.modifier
+
+    def evaluate(self):
+
+        code, stdout, perfdata = super(MYSQLStatusQuery, self).evaluate()
+        if len(self.rates) > 1:
+            perfdata = ' '.join([perfdata] + ['{}={};;;;'.format(name.lower(), rate) for name, rate in zip(self.names, self.rates)])
+        return code, stdout, perfdata
+
+    def finish(self):
+
+        code, stdout, perfdata = self.evaluate()
+        raise NagiosReturn(nagios_output(code, stdout, TIMER.perfdata(perfdata)), code)
+
+def gtid_intervals(gtid_set):
+    """Parse a GTID set such as 'uuid:1-5:7,uuid2:1-3' into { 'uuid' : [(1, 5), (7, 7)], 'uuid2' : [(1, 3)] }."""
+
+    intervals = {}
+    for part in (gtid_set or '').replace('\n', '').split(','):
+        fields = part.strip().lower().split(':')
+        key = fields[0]
+        for field in fields[1:]:
+            if not field[:1].isdigit():
+                #~ Tagged GTIDs (MySQL 8.3) put the tag between the UUID and its intervals
+                key = '{}:{}'.format(fields[0], field)
+                continue
+            start, _, end = field.partition('-')
+            intervals.setdefault(key, []).append((int(start), int(end or start)))
+    return intervals
+
+def gtid_gap(retrieved, executed):
+    """Number of transactions in the retrieved GTID set that are not in the executed one."""
+
+    executed = gtid_intervals(executed)
+    missing = 0
+    for key, intervals in gtid_intervals(retrieved).items():
+        for start, end in intervals:
+            missing += end - start + 1
+            #~ The executed intervals of one source never overlap each other
+            for done_start, done_end in executed.get(key, []):
+                missing -= max(0, min(end, done_end) - max(start, done_start) + 1)
+    return missing
+
+def replica_field(row, name):
+    """A column of SHOW REPLICA STATUS, also found under its SHOW SLAVE STATUS name."""
+
+    if name in row:
+        return row[name]
+    return row.get(name.replace('Replica', 'Slave').replace('Source', 'Master'))
+
+def replica_channels(connection, cache=None):
+    """Every replication channel as a dict, and the time they were read."""
+
+    try:
+        rows, fetched = query_rows(connection, REPLICA_QUERY, cache=cache, dict_driver=DRIVER)
+    except driver_errors(DRIVER):
+        raise
+    except Exception:
+        #~ SHOW REPLICA STATUS is new in MySQL 8.0.22 and MariaDB 10.5.1
+        rows, fetched = query_rows(connection, SLAVE_QUERY, cache=cache, dict_driver=DRIVER)
+    channels = []
+    for row in rows:
+        lag = replica_field(row, 'Seconds_Behind_Source')
+        channels.append({   'channel'   : row.get('Channel_Name') or row.get('Channel_name') or '',
+                            'io'        : replica_field(row, 'Replica_IO_Running'),
+                            'sql'       : replica_field(row, 'Replica_SQL_Running'),
+                            'lag'       : None if lag is None else float(lag),
+                            'file'      : replica_field(row, 'Relay_Source_Log_File'),
+                            'read'      : replica_field(row, 'Read_Source_Log_Pos'),
+                            'exec'      : replica_field(row, 'Exec_Source_Log_Pos'),
+                            'gap'       : gtid_gap(row.get('Retrieved_Gtid_Set'), row.get('Executed_Gtid_Set')),
+                            'error'     : row.get('Last_IO_Error') or row.get('Last_SQL_Error') or '' })
+    return channels, fetched
+
+def digest_key(schema, digest):
+
+    import hashlib
+    return hashlib.sha1('{}|{}'.format(schema or '', digest).encode('utf-8')).digest()[:16]
 
-class MYSQLSlaveLagQuery(MYSQLQuery) :
+def pack_digests(digests):
+    """Pack { key : (calls, latency, rows examined) } into 40 bytes per digest."""
 
+    return b''.join(struct.pack('<16s3d', key, *values) for key, values in digests.items())
+
+def unpack_digests(blob):
+
+    digests = {}
+    for offset in range(0, len(blob) - len(blob) % 40, 40):
+        key, calls, latency, examined = struct.unpack_from('<16s3d', blob, offset)
+        digests[key] = (calls, latency, examined)
+    return digests
+
+class MYSQLDigestQuery(MYSQLQuery):
+    """Average latency and rows examined per call of the top statement digests, against their averages up to the previous run."""
 
     def run_on_connection(self, connection):
 
-        cur = connection.cursor(pymysql.cursors.DictCursor)
-        cur.execute(self.query)
-        self.query_result = cur.fetchone()
+        limit = getattr(self.options, 'digest_limit', None) or DIGEST_LIMIT
+        self.query_result, self.sample_time = query_rows(connection, self.query, (limit,), snapshot_cache(DRIVER, self.options, self.host))
+
+    def state_key(self):
+
+        return 'digest|top'
+
+    def calculate_result(self):
+
+        min_calls = getattr(self.options, 'digest_min_calls', None) or DIGEST_MIN_CALLS
+        texts = {}
+        current = {}
+        for digest, schema, text, calls, latency, examined in self.query_result:
+            key = digest_key(schema, digest)
+            texts[key] = '{}: {}'.format(schema, text) if schema else text
+            current[key] = (float(calls), float(latency), float(examined))
+        self.result = None
+        self.compared = 0
+        self.worst = None
+        self.min_calls = None
+
+        def merge(last_run):
+
+            #~ Only the digests read this time are stored, which keeps the state at the query's LIMIT
+            if last_run:
+                self.min_calls = min_calls
+                current.update(self.compare(texts, current, unpack_digests(last_run[1]), min_calls))
+            return pack_digests(current)
+
+        state_store(DRIVER, self.host).exchange(self.state_key(), merge, self.sample_time)
+        if self.compared:
+            self.result = round(self.worst[0], 2) * self.modifier if self.worst else 0.0
+
+    def compare(self, texts, current, previous, min_calls):
+        """Compare the digests against their previous sample, returning the older samples to keep for digests with too few new calls."""
+
+        pending = {}
+        for key, (calls, latency, examined) in current.items():
+            if key not in previous:
+                continue
+            old_calls, old_latency, old_examined = previous[key]
+            new_calls = calls - old_calls
+            #~ Lower counters mean the server restarted or the digest table was truncated
+            if old_calls <= 0 or latency < old_latency or examined < old_examined:
+                continue
+            if new_calls < min_calls:
+                #~ Keep the older sample, so rarely called digests are compared once they add up to enough calls
+                pending[key] = previous[key]
+                continue
+            self.compared += 1
+            #~ SUM_TIMER_WAIT is in picoseconds
+            for metric, scale, total, old_total in (('latency', 1e-9, latency, old_latency), ('rows examined', 1, examined, old_examined)):
+                if not old_total:
+                    continue
+                before, after = old_total / old_calls * scale, (total - old_total) / new_calls * scale
+                ratio = after / before
+                if self.worst is None or ratio > self.worst[0]:
+                    self.worst = (ratio, metric, before, after, new_calls, texts[key])
+        return pending
+
+    def evaluate(self):
+
+        code, stdout, perfdata = super(MYSQLDigestQuery, self).evaluate()
+        if self.result is None and self.min_calls:
+            stdout = 'No statement digest was called {} times since the previous run'.format(self.min_calls)
+        elif self.worst:
+            ratio, metric, before, after, calls, text = self.worst
+            unit = ' ms' if metric == 'latency' else ''
+            stdout = '{} ({} {:.3f}{} -> {:.3f}{} per call over {:.0f} calls of {})'.format(stdout, metric, before, unit, after, unit, calls, text)
+        return code, stdout, '{} digests_compared={};;;0;'.format(perfdata, self.compared)
+
+    def finish(self):
+
+        code, stdout, perfdata = self.evaluate()
+        raise NagiosReturn(nagios_output(code, stdout, TIMER.perfdata(perfdata)), code)
+
+class MYSQLReplicaQuery(MYSQLQuery):
+    """Base of the replication modes, which evaluate every channel and report the worst one.
+
+    Subclasses that check a number set field to the channel value the summary and history use."""
+
+    def run_on_connection(self, connection):
+
+        self.run_on_channels(*replica_channels(connection, snapshot_cache(DRIVER, self.options, self.host)))
+
+    def run_on_channels(self, channels, fetched=None):
+
+        self.sample_time = fetched
+        self.query_result = channels
 
     def calculate_result(self):
 
-        self.result = float(self.query_result['Seconds_Behind_Master']) * self.modifier
+        self.result = self.query_result
+
+    def evaluate_channel(self, channel, label):
+        """Return (code, stdout, perfdata) of one channel, by default whether its IO and SQL threads run."""
+
+        stdout = self.stdout.format(channel['file'], channel['read'], channel['exec'])
+        if channel['io'] == 'Yes' and channel['sql'] == 'Yes':
+            return 0, stdout, ''
+        #~ The IO thread reconnecting to the source is a warning as long as the SQL thread keeps applying
+        code = 1 if channel['io'] == 'Connecting' and channel['sql'] == 'Yes' else 2
+        stdout = '{}, IO thread {}, SQL thread {}'.format(stdout, channel['io'], channel['sql'])
+        if channel['error']:
+            stdout = '{}: {}'.format(stdout, channel['error'])
+        return code, stdout, ''
+
+    def summary_perfdata(self, evaluated):
+
+        values = [channel[self.field] for channel, code, stdout, perfdata in evaluated if channel[self.field] is not None]
+        if not values:
+            return '{}=U;{};{};;'.format(self.label, self.options.warning or '', self.options.critical or '')
+        return '{}={}{};{};{};;'.format(self.label, max(values) * self.modifier, self.unit, self.options.warning or '', self.options.critical or '')
+
+    def summary_stdout(self, evaluated):
+
+        channel, code, stdout, perfdata = max(evaluated, key=lambda item: item[0][self.field] or 0)
+        return ", worst channel '{}': {}".format(channel['channel'], stdout)
+
+    def evaluate(self):
+
+        if not self.result:
+            return 3, 'Replication is not configured on this server', ''
+        if len(self.result) == 1:
+            return self.evaluate_channel(self.result[0], self.label)
+        evaluated = [(channel,) + self.evaluate_channel(channel, '{}_{}'.format(self.label, channel['channel'] or 'default'))
+                     for channel in self.result]
+        code = 0
+        problems = []
+        for channel, channel_code, stdout, perfdata in evaluated:
+            if SEVERITY[channel_code] > SEVERITY[code]:
+                code = channel_code
+            if channel_code:
+                problems.append("channel '{}': {} ({})".format(channel['channel'], stdout, STATUS_PREFIXES[channel_code][:-2]))
+        if problems:
+            stdout = '{} of {} channels: {}'.format(len(problems), len(evaluated), ', '.join(problems))
+        else:
+            stdout = 'all {} channels OK{}'.format(len(evaluated), self.summary_stdout(evaluated))
+        perfdata = [self.summary_perfdata(evaluated)] + [channel_perfdata for channel, c, s, channel_perfdata in evaluated if channel_perfdata]
+        return code, stdout, ' '.join(perfdata)
+
+    def finish(self):
+
+        code, stdout, perfdata = self.evaluate()
+        raise NagiosReturn(nagios_output(code, stdout, TIMER.perfdata(perfdata)), code)
+
+    def history_value(self):
+
+        values = [channel[self.field] for channel in self.result or [] if channel[self.field] is not None]
+        return max(values) * self.modifier if values else None
+
+    def worst_lag(self):
+
+        lags = [channel['lag'] for channel in self.result or [] if channel['lag'] is not None]
+        return max(lags) if lags else None
+
+    def stopped(self):
+
+        return any(channel['io'] != 'Yes' or channel['sql'] != 'Yes' for channel in self.result or [])
+
+class MYSQLSlaveQuery(MYSQLReplicaQuery):
+    """The slave mode: the channels with a stopped thread, counted instead of a worst value."""
+
+    def summary_perfdata(self, evaluated):
+
+        stopped = len([channel for channel, code, stdout, perfdata in evaluated if code])
+        return '{}={};;;0;{}'.format(self.label, stopped, len(evaluated))
+
+    def summary_stdout(self, evaluated):
+
+        return ', IO and SQL threads running'
+
+    def history_value(self):
+
+        if not self.result:
+            return None
+        return len([channel for channel in self.result if channel['io'] != 'Yes' or channel['sql'] != 'Yes'])
+
+class MYSQLSlaveLagQuery(MYSQLReplicaQuery):
+
+    field = 'lag'
+
+    def evaluate_channel(self, channel, label):
+
+        if channel['lag'] is None:
+            #~ Seconds_Behind_Source is NULL while either replication thread is stopped
+            stdout = 'SLAVE lag is unknown, IO thread {}, SQL thread {}'.format(channel['io'], channel['sql'])
+            return 3, stdout, '{}=U;{};{};;'.format(label, self.options.warning or '', self.options.critical or '')
+        return format_nagios(self.options, self.stdout, channel['lag'] * self.modifier, self.unit, label)
+
+class MYSQLGtidGapQuery(MYSQLReplicaQuery):
+
+    field = 'gap'
+
+    def evaluate_channel(self, channel, label):
+
+        return format_nagios(self.options, self.stdout, channel['gap'] * self.modifier, self.unit, label)
 
 def parse_args():
     
@@ -279,6 +710,7 @@ def parse_args():
     connection = OptionGroup(parser, "Optional Connection Information")
     connection.add_option('-I', '--instance', help='Specify instance', default=None)
     connection.add_option('-p', '--port', help='Specify port.', default=None)
+    connection.add_option('--socket-path', help='Connect through the Unix socket of a local server instead of TCP.', default=None)
     connection.add_option('-m', '--mode', help='specify mode', default=None)
    
     parser.add_option_group(connection)
@@ -286,54 +718,133 @@ def parse_args():
     nagios = OptionGroup(parser, "Nagios Plugin Information")
     nagios.add_option('-w', '--warning', help='Specify warning range.', default=None)
     nagios.add_option('-c', '--critical', help='Specify critical range.', default=None)
+    nagios.add_option('--timing', action='store_true', help='Append per-phase durations (import_ms, connect_ms, query_ms, state_ms) to the perfdata.', default=False)
     parser.add_option_group(nagios)
  
     mode = OptionGroup(parser, "Mode Options")
+
+    collector = OptionGroup(parser, "Collector Options")
+    collector.add_option('--collector', help='Run the resident collector using the given configuration file.', default=None)
+    collector.add_option('--socket', help='Read results from the collector listening on this Unix socket.', default=None)
+    collector.add_option('--max-age', type='int', help='Maximum age in seconds of a collector result (default: 3 polling intervals).', default=None)
+    collector.add_option('--broker', help='Borrow a pooled connection from the collector listening on this Unix socket.', default=None)
+    collector.add_option('--exporter', help='Serve Prometheus metrics of --modes (default: all) on this host:port, or of the hosts of --collector.', default=None)
+    collector.add_option('--exporter-interval', type='int', help='Seconds between the polls of --exporter without --collector (default: 60).', default=60)
+    parser.add_option_group(collector)
+
+    digest = OptionGroup(parser, "Digest Options")
+    digest.add_option('--digest-limit', type='int', help='Statement digests with the most total latency read and kept by digestregression (default: {}).'.format(DIGEST_LIMIT), default=DIGEST_LIMIT)
+    digest.add_option('--digest-min-calls', type='int', help='Calls a digest needs since the previous run to be compared (default: {}).'.format(DIGEST_MIN_CALLS), default=DIGEST_MIN_CALLS)
+    parser.add_option_group(digest)
+
+    history = OptionGroup(parser, "History Options")
+    history.add_option('--history', action='store_true', help='Append every result to a fixed-size ring of this host and mode in the temporary directory.', default=False)
+    history.add_option('--history-size', type='int', help='Samples kept by a new --history ring (default: {}, a week of one-minute checks).'.format(HISTORY_SLOTS), default=HISTORY_SLOTS)
+    history.add_option('--history-dump', action='store_true', help='Print the --history samples of -m for the host instead of checking it.', default=False)
+    parser.add_option_group(history)
+
+    cache = OptionGroup(parser, "Cache Options")
+    cache.add_option('--cache-ttl', type='int', help='Share query results with the other checks of this host for this many seconds (default: 0, off).', default=0)
+    parser.add_option_group(cache)
+
+    fleet = OptionGroup(parser, "Multi-host Options")
+    fleet.add_option('--hosts', help='Check every server listed in this file (hostname or hostname:port per line, optionally followed by its Nagios host name).', default=None)
+    fleet.add_option('--modes', help='Comma separated modes run together over one connection, also by --hosts (default for --hosts: {}) or read from --socket.'.format(','.join(REPLICA_MODES)), default=None)
+    fleet.add_option('--workers', type='int', help='Number of worker processes for --hosts (default: 8).', default=8)
+    fleet.add_option('--deadline', type='int', help='Seconds allowed for each server (default: 30).', default=30)
+    parser.add_option_group(fleet)
+
+    passive = OptionGroup(parser, "Passive Result Options")
+    passive.add_option('--spool-dir', help='Write --hosts results as passive check results into this Nagios checkresults directory.', default=None)
+    passive.add_option('--command-file', help='Submit --hosts results as PROCESS_SERVICE_CHECK_RESULT commands to this Nagios command file.', default=None)
+    passive.add_option('--service-format', help='Service description of passive results, {host} and {mode} are replaced (default: {mode}).', default='{mode}')
+    parser.add_option_group(passive)
     options, _ = parser.parse_args()
+
+    if options.collector:
+        return options
+
+    if options.modes:
+        options.modes = [m.strip() for m in options.modes.split(',') if m.strip()]
+    elif options.hosts:
+        options.modes = [options.mode] if options.mode else REPLICA_MODES
+    for m in options.modes or []:
+        if m not in MODES or m in ('time2connect', 'test'):
+            parser.error('Unknown mode: {}'.format(m))
+    if options.hosts:
+        if options.workers < 1:
+            parser.error('Workers must be at least 1.')
+        if options.deadline < 1:
+            parser.error('Deadline must be at least 1.')
+        if options.socket_path:
+            parser.error('Cannot specify --socket-path with --hosts.')
+    if options.spool_dir and options.command_file:
+        parser.error('Cannot specify both --spool-dir and --command-file.')
+    if (options.spool_dir or options.command_file) and not options.hosts:
+        parser.error('Passive results need --hosts.')
+    if options.exporter and (options.mode or options.hosts or options.socket):
+        parser.error('--exporter cannot be combined with -m, --hosts or --socket.')
+    if options.exporter and options.exporter_interval < 1:
+        parser.error('Exporter interval must be at least 1.')
+    if options.history_dump and (options.mode in (None, 'time2connect', 'test') or options.modes or options.hosts or options.socket or options.exporter):
+        parser.error('--history-dump needs a mode given with -m.')
+    if options.history and options.history_size < 1:
+        parser.error('History size must be at least 1.')
  
-    if not options.hostname:
+    if not options.hostname and not options.hosts:
         parser.error('Hostname is a required option.')
-    if not options.user:
+    if not options.socket and not options.user:
         parser.error('User is a required option.')
-    if not options.password:
+    if not options.socket and not options.password:
         parser.error('Password is a required option.')
     
     if options.instance and options.port:
         parser.error('Cannot specify both instance and port.')
+    if options.socket_path and (options.instance or options.port):
+        parser.error('Cannot specify --socket-path with instance or port.')
     
     return options
 
-def is_within_range(nagstring, value):
-
-    if not nagstring:
-        return False
-    import re
-    import operator
-    first_float = r'(?P<first>(-?[0-9]+(\.[0-9]+)?))'
-    second_float= r'(?P<second>(-?[0-9]+(\.[0-9]+)?))'
-    actions = [ (r'^{}$'.format(first_float),lambda y: (value > float(y.group('first'))) or (value < 0)),
-                (r'^{}:$'.format(first_float),lambda y: value < float(y.group('first'))),
-                (r'^~:{}$'.format(first_float),lambda y: value > float(y.group('first'))),
-                (r'^{}:{}$'.format(first_float,second_float), lambda y: (value < float(y.group('first'))) or (value > float(y.group('second')))),
-                (r'^@{}:{}$'.format(first_float,second_float), lambda y: not((value < float(y.group('first'))) or (value > float(y.group('second')))))]
-    for regstr,func in actions:
-        res = re.match(regstr,nagstring)
-        if res: 
-            return func(res)
-    raise Exception('Improper warning/critical format.')
-
-def connect_db(options):
+def server_address(options):
 
     host = options.hostname
     if options.instance:
         host += "\\" + options.instance
     elif options.port:
-        host += ":" + options.port
+        host += ":" + str(options.port)
+    elif options.socket_path:
+        host += ":" + options.socket_path
+    return host
+
+def connect_args(options):
+
+    args = { 'host' : options.hostname, 'user' : options.user, 'password' : options.password }
+    if options.instance:
+        #~ Passed on as host\instance, as the plugin always has
+        args['host'] = server_address(options)
+    elif options.port:
+        args['port'] = int(options.port)
+    elif options.socket_path:
+        args['unix_socket'] = options.socket_path
+    return args
+
+def connect_db(options):
+
+    host = server_address(options)
+    if options.broker:
+        start = time.time()
+        with TIMER.phase('connect', 'broker'):
+            mysql = BrokerConnection(DRIVER, options.broker, connect_args(options))
+        return mysql, time.time() - start, host
+    #~ Imported before the clock starts so time2connect does not include loading the driver
+    with TIMER.phase('import'):
+        import pymysql
     start = time.time()
     try:
-        mysql = pymysql.connect(host = host, user = options.user, password = options.password)
+        with TIMER.phase('connect', host):
+            mysql = pymysql.connect(**connect_args(options))
     except:
-        print('Failed to connect to {}'.forma(host))
+        print('Failed to connect to {}'.format(host))
         sys.exit(2)
 
     total = time.time() - start
@@ -342,8 +853,37 @@ def connect_db(options):
 def main():
 
     options = parse_args()
-    mysql, total, host = connect_db(options) 
-    if options.mode =='test':
+    TIMER.report = options.timing
+
+    if options.collector:
+        run_collector(DRIVER, options, MODES, [m for m in MODES if m not in ('time2connect', 'test')], make_collector_host)
+        return
+
+    if options.exporter:
+        run_exporter(options)
+        return
+
+    if options.history_dump:
+        dump_history(options)
+
+    if options.socket:
+        read_collector(options)
+
+    if options.hosts:
+        started = time.time()
+        host_results = run_hosts(options)
+        if options.spool_dir or options.command_file:
+            raise NagiosReturn(spool_results(options, [(host, results) for host, results, facts in host_results], started), 0)
+        return_hosts(host_results)
+
+    if options.cache_ttl and (options.modes or options.mode not in (None, 'time2connect', 'test')):
+        mysql, total, host = LazyConnection(options, connect_db), None, server_address(options)
+    else:
+        mysql, total, host = connect_db(options) 
+    if options.modes:
+        return_batch(execute_modes(mysql, options, options.modes, host))
+
+    elif options.mode =='test':
         run_tests(mysql, options, host)
         
     elif not options.mode or options.mode == 'time2connect':
@@ -356,24 +896,86 @@ def main():
     else:
         execute_query(mysql, options, host)
 
-def execute_query(mysql, options, host=''):
+def make_query(options, mode, host=''):
 
-    sql_query = MODES[options.mode]
-    sql_query['options'] = options
-    sql_query['host'] = host
+    sql_query = dict(MODES[mode], options=options, host=host)
+    sql_query.setdefault('type', 'standard')
     query_type = sql_query.get('type')
     if query_type == 'delta':
-        mysql_query = MYSQLDeltaQuery(**sql_query)
+        return MYSQLDeltaQuery(**sql_query)
     elif query_type == 'divide':
-        mysql_query = MYSQLDivideQuery(**sql_query)
+        return MYSQLDivideQuery(**sql_query)
     elif query_type == 'lag':
-        mysql_query = MYSQLSlaveLagQuery(**sql_query) 
+        return MYSQLSlaveLagQuery(**sql_query) 
     elif query_type == 'slave': 
-        mysql_query = MYSQLSlaveQuery(**sql_query)
+        return MYSQLSlaveQuery(**sql_query)
+    elif query_type == 'gtidgap':
+        return MYSQLGtidGapQuery(**sql_query)
+    elif query_type == 'digest':
+        return MYSQLDigestQuery(**sql_query)
+    elif query_type == 'status':
+        return MYSQLStatusQuery(**sql_query)
     else:
-        mysql_query = MYSQLQuery(**sql_query)
+        return MYSQLQuery(**sql_query)
+
+def dump_history(options):
+    """Print the --history samples of the mode for the host, oldest first, without connecting."""
+
+    host = server_address(options)
+    key = make_query(options, options.mode, host).label
+    report_history(DRIVER, host, key, '{} for {}'.format(options.mode, host))
+
+def execute_query(mysql, options, host=''):
+
+    mysql_query = make_query(options, options.mode, host)
     mysql_query.do(mysql)
 
+def collect_modes(mysql, options, modes, host=''):
+
+    collected = []
+    queries = []
+    for mode in modes:
+        try:
+            queries.append((mode, make_query(options, mode, host)))
+        except Exception as e:
+            collected.append((mode, None, e))
+    status = [mysql_query for mode, mysql_query in queries if isinstance(mysql_query, MYSQLStatusQuery)]
+    snapshot = None
+    if status:
+        with TIMER.phase('query', 'status'):
+            snapshot = StatusSnapshot.fetch(mysql, snapshot_cache(DRIVER, options, host), any(q.variables for q in status))
+    channels = None
+    if any(isinstance(mysql_query, MYSQLReplicaQuery) for mode, mysql_query in queries):
+        with TIMER.phase('query', 'replication'):
+            channels = replica_channels(mysql, snapshot_cache(DRIVER, options, host))
+    for mode, mysql_query in queries:
+        try:
+            if isinstance(mysql_query, MYSQLStatusQuery):
+                mysql_query.run_on_snapshot(snapshot)
+            elif isinstance(mysql_query, MYSQLReplicaQuery):
+                mysql_query.run_on_channels(*channels)
+            else:
+                with TIMER.phase('query', mode):
+                    mysql_query.run_on_connection(mysql)
+            mysql_query.calculate_result()
+            mysql_query.record()
+            collected.append((mode, mysql_query, None))
+        except driver_errors(DRIVER):
+            raise
+        except Exception as e:
+            collected.append((mode, None, e))
+    return collected
+
+def execute_modes(mysql, options, modes, host=''):
+
+    results = []
+    for mode, mysql_query, error in collect_modes(mysql, options, modes, host):
+        if error is not None:
+            results.append((mode, 3, '{} failed with: {}'.format(mode, error), ''))
+        else:
+            results.append((mode,) + mysql_query.evaluate())
+    return results
+
 def run_tests(mysql, options, host):
 
     failed = 0
@@ -392,14 +994,158 @@ def run_tests(mysql, options, host):
             print('{} failed with: {}'.format(mode, e))
     print('{}/{} tests failed.'.format(failed, total))
     
+def read_hosts(path):
+    """Return (address, Nagios host name) pairs, the name defaulting to the address."""
+
+    servers = []
+    with open(path) as hosts_file:
+        for line in hosts_file:
+            fields = line.split('#')[0].split()
+            if fields:
+                servers.append((fields[0], fields[1] if len(fields) > 1 else fields[0]))
+    return servers
+
+class DeadlineExceeded(Exception):
+
+    pass
+
+def check_replica(options, address, modes):
+    """Run modes against one server inside a worker process, returning (host, results, facts)."""
+
+    import copy
+    import signal
+    import pymysql
+
+    def deadline_exceeded(signum, frame):
+        raise DeadlineExceeded('Deadline of {}s exceeded'.format(options.deadline))
+
+    host_options = copy.copy(options)
+    host_options.hostname, host_options.port, host_options.instance, host_options.socket_path = address, None, None, None
+    if ':' in address:
+        host_options.hostname, host_options.port = address.rsplit(':', 1)
+    host = server_address(host_options)
+    facts = { 'lag' : None, 'stopped' : False, 'unreachable' : False }
+    signal.signal(signal.SIGALRM, deadline_exceeded)
+    signal.alarm(options.deadline)
+    try:
+        try:
+            mysql = pymysql.connect(connect_timeout=options.deadline, read_timeout=options.deadline, **connect_args(host_options))
+        except Exception as e:
+            facts['unreachable'] = True
+            return host, [(mode, 2, 'Failed to connect to {}: {}'.format(host, e), '') for mode in modes], facts
+        try:
+            results = []
+            for mode, mysql_query, error in collect_modes(mysql, host_options, modes, host):
+                if error is not None:
+                    results.append((mode, 3, '{} failed with: {}'.format(mode, error), ''))
+                    continue
+                results.append((mode,) + mysql_query.evaluate())
+                if isinstance(mysql_query, MYSQLReplicaQuery):
+                    facts['lag'] = mysql_query.worst_lag()
+                    facts['stopped'] = mysql_query.stopped()
+            return host, results, facts
+        finally:
+            mysql.close()
+    except DeadlineExceeded as e:
+        return host, [(mode, 3, str(e), '') for mode in modes], facts
+    except Exception as e:
+        return host, [(mode, 3, '{} failed with: {}'.format(mode, e), '') for mode in modes], facts
+    finally:
+        signal.alarm(0)
+
+def run_hosts(options):
+
+    from concurrent.futures import ProcessPoolExecutor
+    addresses = read_hosts(options.hosts)
+    with ProcessPoolExecutor(max_workers=min(options.workers, len(addresses) or 1)) as pool:
+        futures = [(host_name, pool.submit(check_replica, options, address, options.modes)) for address, host_name in addresses]
+        return [(host_name,) + future.result()[1:] for host_name, future in futures]
+
+def return_hosts(host_results):
+
+    code = 0
+    lines = []
+    worst_lag = None
+    stopped = 0
+    unreachable = 0
+    for host, results, facts in host_results:
+        for mode, mode_code, stdout, perfdata in results:
+            if SEVERITY[mode_code] > SEVERITY[code]:
+                code = mode_code
+            lines.append('{} {}: {}'.format(host, mode, nagios_output(mode_code, stdout, perfdata)))
+        if facts['lag'] is not None and (worst_lag is None or facts['lag'] > worst_lag[1]):
+            worst_lag = (host, facts['lag'])
+        stopped += facts['stopped']
+        unreachable += facts['unreachable']
+    summary = '{}{} servers checked'.format(STATUS_PREFIXES[code], len(host_results))
+    if worst_lag:
+        summary += ', worst lag {}s on {}'.format(worst_lag[1], worst_lag[0])
+    summary += ', {} with stopped replication threads, {} unreachable'.format(stopped, unreachable)
+    perfdata = 'stopped_replicas={};;;0;{} unreachable={};;;0;{}'.format(stopped, len(host_results), unreachable, len(host_results))
+    if worst_lag:
+        perfdata = 'worst_lag={}s;;;; {}'.format(worst_lag[1], perfdata)
+    raise NagiosReturn('\n'.join(['{}| {}'.format(summary, perfdata)] + lines), code)
+
+def read_collector(options):
+
+    modes = options.modes or [options.mode or 'time2connect']
+    request = { 'host' : server_address(options), 'modes' : modes }
+    reply = collector_request(options.socket, request)
+    if reply.get('error'):
+        raise NagiosReturn('UNKNOWN: {}'.format(reply['error']), 3)
+    max_age = options.max_age or 3 * reply['interval']
+    results = []
+    for mode in modes:
+        collected = reply['results'].get(mode)
+        if not collected:
+            results.append((mode, 3, '{} is not collected for {}'.format(mode, request['host']), ''))
+        elif collected['error']:
+            results.append((mode, 3, '{} failed with: {}'.format(mode, collected['error']), ''))
+        elif time.time() - collected['time'] > max_age:
+            results.append((mode, 3, '{} result is {:.0f}s old'.format(mode, time.time() - collected['time']), ''))
+        else:
+            result = collected['result']
+            if MODES[mode].get('query') == REPLICA_QUERY:
+                #~ Replication results are the channels, evaluated here against this check's thresholds
+                mysql_query = make_query(options, mode, request['host'])
+                mysql_query.result = result
+                results.append((mode,) + mysql_query.evaluate())
+                continue
+            sql_query = MODES[mode]
+            results.append((mode,) + format_nagios( options,
+                                                    sql_query.get('stdout', 'Time to connect was {}s'),
+                                                    result,
+                                                    sql_query.get('unit', 's' if mode == 'time2connect' else ''),
+                                                    sql_query.get('label', 'time') ))
+    if options.modes:
+        return_batch(results)
+    mode, code, stdout, perfdata = results[0]
+    raise NagiosReturn(nagios_output(code, stdout, perfdata), code)
+
+def collector_connect(options):
+
+    import pymysql
+    return pymysql.connect(**connect_args(options))
+
+def make_collector_host(options, modes, interval):
+
+    return CollectorHost(options, modes, interval, server_address(options), collector_connect, collect_modes)
+
+def run_exporter(options):
+    """Poll the modes of one server every --exporter-interval seconds and serve the results as /metrics."""
+
+    #~ Loaded up front so the first poll's time2connect does not include it
+    import pymysql
+    modes = options.modes or [m for m in MODES if m not in ('time2connect', 'test')]
+    collector_host = make_collector_host(options, modes, options.exporter_interval)
+    serve_exporter(options.exporter, lambda: render_metrics('mysql', [collector_host], MODES), collector_host)
+
 if __name__ == '__main__':
 
-       try:
+    TIMER.install_hooks()
+    try:
         main()
-    except pymysql.OperationalError as e:
-        print('ERROR - {}'.format(e))
-        sys.exit(2)
-    except pymysql.InterfaceError as e:
+    except driver_errors(DRIVER) as e:
         print('ERROR - {}'.format(e))
         sys.exit(2)
     except IOError as e:
@@ -0,0 +1 @@
+../mssql/plugin_common.py
\ No newline at end of file
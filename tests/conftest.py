@@ -0,0 +1,45 @@
+import io
+import os
+import sys
+import runpy
+import tempfile
+import contextlib
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'bench'), os.path.join(ROOT, 'mssql')]
+
+import fake_dbapi
+
+@pytest.fixture
+def fake_server(tmp_path, monkeypatch):
+    """The fake drivers and clock of fake_dbapi, with state, cache and history files under tmp_path."""
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    server = fake_dbapi.install()
+    yield server
+    fake_dbapi.uninstall()
+
+def load_script(path):
+    """The globals of a check script, imported without running main()."""
+    sys.modules.pop('plugin_common', None)
+    return runpy.run_path(os.path.join(ROOT, path), run_name=os.path.basename(path)[:-3])
+
+@pytest.fixture
+def run_check(monkeypatch):
+    """Run a check script as __main__, like one Nagios check, and return (exit code, output)."""
+    def run(path, *args):
+        path = os.path.join(ROOT, path)
+        monkeypatch.setattr(sys, 'argv', [path] + list(args))
+        monkeypatch.setattr(sys, 'path', [os.path.dirname(path)] + sys.path[1:])
+        #~ The shared runtime keeps its caches in module globals, a new check must not see the last one's
+        sys.modules.pop('plugin_common', None)
+        output = io.StringIO()
+        exit_code = None
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                runpy.run_path(path, run_name='__main__')
+            except SystemExit as e:
+                exit_code = e.code
+        return exit_code, output.getvalue().strip()
+    return run
@@ -0,0 +1,36 @@
+import os
+import stat
+
+import pytest
+
+import fake_dbapi
+
+MYSQL = 'mysql/check_mysql_health.py'
+LOGIN = ['-H', 'bench', '-U', 'nagios', '-P', 'secret']
+
+def test_second_check_is_answered_from_the_cache(fake_server, run_check):
+    run_check(MYSQL, *LOGIN + ['-m', 'connections', '--cache-ttl', '3600'])
+    fake_dbapi.reset_stats()
+    code, output = run_check(MYSQL, *LOGIN + ['-m', 'connections', '--cache-ttl', '3600'])
+    assert code == 0
+    assert 'Number of users connected is 17.0' in output
+    assert fake_dbapi.STATS['connects'] == 0
+
+def test_cache_lives_in_a_private_directory(fake_server, run_check, tmp_path):
+    run_check(MYSQL, *LOGIN + ['-m', 'connections', '--cache-ttl', '3600'])
+    private = tmp_path / 'mysql-checks-{}'.format(os.geteuid())
+    assert stat.S_IMODE(os.stat(str(private)).st_mode) == 0o700
+    assert [name for name in os.listdir(str(private)) if name.startswith('cache-') and name.endswith('.json')]
+
+@pytest.mark.parametrize('unsafe', ['symlink', 'open to others'])
+def test_unsafe_directory_is_refused(fake_server, tmp_path, unsafe):
+    from plugin_common import private_dir
+    path = str(tmp_path / 'mysql-checks-{}'.format(os.geteuid()))
+    if unsafe == 'symlink':
+        os.mkdir(str(tmp_path / 'elsewhere'), 0o700)
+        os.symlink(str(tmp_path / 'elsewhere'), path)
+    else:
+        os.mkdir(path)
+        os.chmod(path, 0o777)
+    with pytest.raises(Exception, match='is not a private directory of this user'):
+        private_dir('pymysql')
@@ -0,0 +1,107 @@
+import sys
+import json
+import time
+import threading
+import socketserver
+
+import pytest
+
+from plugin_common import CollectorHost
+
+SCRIPTS = ['mssql/check_mssql_server.py', 'mysql/check_mysql_health.py']
+LOGIN = ['-H', 'bench', '-U', 'nagios', '-P', 'secret']
+
+@pytest.fixture
+def collector(tmp_path):
+    """A stand-in --collector socket that answers every request with the results in collector.results."""
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            self.server.requests.append(request)
+            reply = { 'interval' : 60, 'results' : dict((mode, self.server.results.get(mode)) for mode in request['modes']) }
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+    server = socketserver.UnixStreamServer(str(tmp_path / 'collector.sock'), Handler)
+    server.path = str(tmp_path / 'collector.sock')
+    server.results = {}
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, kwargs={ 'poll_interval' : 0.01 })
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def collected(age, result=17.0, error=None):
+    return { 'time' : time.time() - age, 'result' : result, 'error' : error }
+
+@pytest.mark.parametrize('script', SCRIPTS)
+def test_fresh_result(fake_server, run_check, collector, script):
+    collector.results['connections'] = collected(10)
+    code, output = run_check(script, *LOGIN + ['-m', 'connections', '--socket', collector.path, '-w', '20', '-c', '30'])
+    assert code == 0
+    assert 'Number of users connected is 17.0' in output
+    assert collector.requests == [{ 'host' : 'bench', 'modes' : ['connections'] }]
+
+@pytest.mark.parametrize('script', SCRIPTS)
+def test_result_older_than_max_age(fake_server, run_check, collector, script):
+    collector.results['connections'] = collected(90)
+    code, output = run_check(script, *LOGIN + ['-m', 'connections', '--socket', collector.path, '--max-age', '60'])
+    assert code == 3
+    assert output.startswith('UNKNOWN: connections result is 90s old')
+
+@pytest.mark.parametrize('script', SCRIPTS)
+@pytest.mark.parametrize('age, code', [(170, 0), (190, 3)])
+def test_default_max_age_is_three_intervals(fake_server, run_check, collector, script, age, code):
+    collector.results['connections'] = collected(age)
+    assert run_check(script, *LOGIN + ['-m', 'connections', '--socket', collector.path])[0] == code
+
+@pytest.mark.parametrize('script', SCRIPTS)
+def test_failed_and_missing_results(fake_server, run_check, collector, script):
+    collector.results['connections'] = collected(10, None, 'Login failed')
+    code, output = run_check(script, *LOGIN + ['-m', 'connections', '--socket', collector.path])
+    assert (code, output) == (3, 'UNKNOWN: connections failed with: Login failed')
+    code, output = run_check(script, *LOGIN + ['-m', 'slave' if 'mysql' in script else 'pagelife', '--socket', collector.path])
+    assert code == 3
+    assert 'is not collected for bench' in output
+
+def test_socket_path_is_part_of_the_address(fake_server, run_check, collector):
+    collector.results['connections'] = collected(10)
+    run_check('mysql/check_mysql_health.py', *LOGIN + ['-m', 'connections', '--socket', collector.path, '--socket-path', '/run/mysqld/mysqld.sock'])
+    assert collector.requests[0]['host'] == 'bench:/run/mysqld/mysqld.sock'
+
+def test_poll_refreshes_time2connect(fake_server):
+    logins = []
+    def connect(options):
+        logins.append(options)
+        return sys.modules['pymssql'].connect()
+    collector_host = CollectorHost(None, [], 60, 'bench', connect, lambda connection, options, modes, host: [])
+    collector_host.poll()
+    first = collector_host.results['time2connect']
+    #~ The next poll comes one fake read later and reuses the connection
+    fake_server.tick()
+    collector_host.poll()
+    second = collector_host.results['time2connect']
+    assert len(logins) == 1
+    assert second['error'] is None
+    assert second['time'] - first['time'] == pytest.approx(60, abs=1)
+
+def test_mysql_modes_are_read_together(fake_server, run_check, collector):
+    collector.results['connections'] = collected(10)
+    #~ Replication modes are collected as their channels
+    channel = { 'channel' : '', 'io' : 'Yes', 'sql' : 'Yes', 'lag' : 400.0, 'file' : 'mysql-bin.000042', 'read' : 1, 'exec' : 1,
+                'gap' : 0, 'error' : '' }
+    collector.results['slavelag'] = collected(10, [channel])
+    code, output = run_check('mysql/check_mysql_health.py', *LOGIN + ['--modes', 'connections,slavelag', '--socket', collector.path,
+                                                                    '-w', '300', '-c', '600'])
+    assert collector.requests == [{ 'host' : 'bench', 'modes' : ['connections', 'slavelag'] }]
+    assert code == 1
+    assert output.startswith('WARNING: Number of users connected is 17.0, SLAVE is 400.0 seconds behind (WARNING)|')
+
+@pytest.mark.parametrize('args, message', [
+    (['--hosts', 'replicas.txt', '--deadline', '0'], 'Deadline must be at least 1.'),
+    (['--hosts', 'replicas.txt', '--socket-path', '/run/mysqld/mysqld.sock'], 'Cannot specify --socket-path with --hosts.'),
+    (['--modes', 'qps,nosuchmode'], 'Unknown mode: nosuchmode') ])
+def test_mysql_option_checks(fake_server, run_check, args, message):
+    code, output = run_check('mysql/check_mysql_health.py', *['-U', 'nagios', '-P', 'secret'] + args)
+    assert code == 2
+    assert output.endswith('error: ' + message)
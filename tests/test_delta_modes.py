@@ -0,0 +1,102 @@
+import re
+
+import pytest
+
+import fake_dbapi
+
+SERVER = 'mssql/check_mssql_server.py'
+LOGIN = ['-H', 'bench', '-U', 'nagios', '-P', 'secret']
+
+def perfdata(output):
+    """The perfdata values of a check output by label, None for U."""
+    values = {}
+    for label, value in re.findall(r'([\w.]+)=([-\d.eE]+|U)', output.split('|', 1)[1]):
+        values[label] = None if value == 'U' else float(value)
+    return values
+
+def rate(growth):
+    """What a counter growing by growth on every read of the fake server reports per second."""
+    return pytest.approx(growth / float(fake_dbapi.READ_INTERVAL), rel=0.01)
+
+def test_rate_needs_a_baseline(fake_server, run_check):
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    assert code == 0
+    assert 'new baseline sample' in output
+    assert perfdata(output)['page_lookups'] is None
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    assert code == 0
+    assert perfdata(output)['page_lookups'] == rate(25000)
+
+def test_restart_starts_a_new_baseline(fake_server, run_check, monkeypatch):
+    run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    assert perfdata(output)['page_lookups'] == rate(25000)
+    monkeypatch.setattr(fake_dbapi, 'SQLSERVER_START_TIME', fake_dbapi.SQLSERVER_START_TIME + 3600)
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    assert code == 0
+    assert 'new baseline sample' in output
+    assert perfdata(output)['page_lookups'] is None
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    assert perfdata(output)['page_lookups'] == rate(25000)
+
+def test_counter_going_backwards_starts_a_new_baseline(fake_server, run_check, monkeypatch):
+    run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    #~ The counter starts again from zero without a new start time, as when it wraps
+    cleared = [row[:3] + (0,) + row[4:] if row[1] == 'Page lookups/sec' else row for row in fake_dbapi.SYSPERFINFO]
+    monkeypatch.setattr(fake_dbapi, 'SYSPERFINFO', cleared)
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    assert code == 0
+    assert 'new baseline sample' in output
+    assert perfdata(output)['page_lookups'] is None
+
+def test_restart_resets_the_waitstats_baseline(fake_server, run_check, monkeypatch):
+    run_check(SERVER, *LOGIN + ['-m', 'waitstats'])
+    monkeypatch.setattr(fake_dbapi, 'SQLSERVER_START_TIME', fake_dbapi.SQLSERVER_START_TIME + 3600)
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'waitstats'])
+    assert code == 0
+    assert 'new baseline sample' in output
+
+def test_waitstats_delta(fake_server, run_check):
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'waitstats'])
+    assert 'new baseline sample' in output
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'waitstats'])
+    assert code == 0
+    values = perfdata(output)
+    #~ The benign sleep waits are left out, resource waits are the wait time without the signal wait
+    counted = [row for row in fake_dbapi.WAIT_STATS if not row[0].endswith('SLEEP') and row[0] != 'SLEEP_TASK']
+    assert values['resource_wait'] == rate(sum(row[3] - row[4] for row in counted))
+    assert values['signal_wait'] == rate(sum(row[4] for row in counted))
+    assert values['wait_pageiolatch_sh'] == rate(9000)
+    assert 'wait_lazywriter_sleep' not in values
+    assert 'top: PAGEIOLATCH_SH' in output
+
+def test_filestats_delta(fake_server, run_check):
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'filestats'])
+    assert 'new baseline sample' in output
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'filestats'])
+    assert code == 0
+    values = perfdata(output)
+    #~ tempdb.mdf stalls 4200 ms over 280 writes per read, the worst latency of all files
+    assert values['io_latency'] == pytest.approx(15.0)
+    assert 'write on tempdb' in output
+    assert values['read_bytes'] == rate(sum(row[6][1] for row in fake_dbapi.VIRTUAL_FILE_STATS))
+    assert values['write_bytes'] == rate(sum(row[6][4] for row in fake_dbapi.VIRTUAL_FILE_STATS))
+
+def test_hit_ratio_over_the_interval(fake_server, run_check):
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'bufferhitratio'])
+    assert '(since startup)' in output
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'bufferhitratio'])
+    assert '(since startup)' not in output
+    #~ 95 hits for every 100 lookups per read
+    assert perfdata(output)['buffer_cache_hit_ratio'] == pytest.approx(95.0)
+
+def test_hit_ratio_of_an_idle_interval(fake_server, run_check, monkeypatch):
+    run_check(SERVER, *LOGIN + ['-m', 'bufferhitratio'])
+    #~ The clock moves on, but the buffer manager counters stay where the last read left them
+    idle = [row[:3] + (row[3] + row[5] * fake_server.reads, row[4], 0) if row[0] == 'SQLServer:Buffer Manager' else row
+            for row in fake_dbapi.SYSPERFINFO]
+    monkeypatch.setattr(fake_dbapi, 'SYSPERFINFO', idle)
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'bufferhitratio'])
+    assert code == 0
+    assert 'no activity since the previous run' in output
+    assert perfdata(output)['buffer_cache_hit_ratio'] is None
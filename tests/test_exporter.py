@@ -0,0 +1,54 @@
+import sys
+
+import pytest
+
+from conftest import load_script
+
+SERVER = 'mssql/check_mssql_server.py'
+DATABASE = 'mssql/check_mssql_database.py'
+LOGIN = ['-H', 'bench', '-U', 'nagios', '-P', 'secret']
+
+def exporter_options(script, monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', [script['__file__']] + LOGIN + ['--exporter', '127.0.0.1:0'] + list(args))
+    return script['parse_args']()
+
+def test_perfdata_values_become_gauges(fake_server, monkeypatch):
+    script = load_script(SERVER)
+    collector_host = script['make_collector_host'](exporter_options(script, monkeypatch), ['connections', 'cpu'], 60)
+    collector_host.poll()
+    metrics = script['render_metrics']('mssql', [collector_host], script['MODES']).splitlines()
+    assert 'mssql_up{host="bench"} 1.0' in metrics
+    assert 'mssql_connections{host="bench"} 42.0' in metrics
+    #~ Extra perfdata values of a mode are exported too, under the mode's help text
+    assert '# HELP mssql_cpu_idle {}'.format(script['MODES']['cpu']['help']) in metrics
+    assert 'mssql_poll_error{host="bench",mode="cpu"} 0.0' in metrics
+
+def test_polls_keep_their_own_delta_samples(fake_server, run_check, monkeypatch):
+    script = load_script(SERVER)
+    collector_host = script['make_collector_host'](exporter_options(script, monkeypatch), ['pagelooks'], 60)
+    sys.modules['plugin_common'].use_state_namespace('collector')
+    collector_host.poll()
+    collector_host.poll()
+    assert 'mssql_page_lookups{host="bench"}' in script['render_metrics']('mssql', [collector_host], script['MODES'])
+    #~ The exporter's samples are not the check's baseline
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'pagelooks'])
+    assert code == 0
+    assert 'new baseline sample' in output
+
+def test_collector_refuses_unknown_modes(fake_server, tmp_path):
+    script = load_script(SERVER)
+    config = tmp_path / 'collector.ini'
+    config.write_text('[collector]\nsocket = {}\n\n[bench]\nuser = nagios\npassword = secret\nmodes = connections,pagelook\n'.format(
+        tmp_path / 'collector.sock'))
+    with pytest.raises(IOError, match='Unknown mode pagelook for bench'):
+        sys.modules['plugin_common'].read_collector_config('pymssql', str(config), script['MODES'], [], script['make_collector_host'])
+
+def test_database_exporter(fake_server, monkeypatch):
+    script = load_script(DATABASE)
+    exporter = script['DatabaseExporter'](exporter_options(script, monkeypatch, '--database-pattern', 'app_*'), ['datasize'])
+    exporter.poll()
+    metrics = script['render_metrics']('mssql_database', [exporter], script['MODES']).splitlines()
+    assert 'mssql_database_up{host="bench"} 1.0' in metrics
+    assert 'mssql_database_datasize{database="app_orders",host="bench"} 15360.0' in metrics
+    assert 'mssql_database_datasize{database="app_users",host="bench"} 17920.0' in metrics
+    assert not [line for line in metrics if 'database="master"' in line]
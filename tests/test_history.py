@@ -0,0 +1,36 @@
+import os
+
+import fake_dbapi
+
+SERVER = 'mssql/check_mssql_server.py'
+MYSQL = 'mysql/check_mysql_health.py'
+LOGIN = ['-H', 'bench', '-U', 'nagios', '-P', 'secret']
+
+def test_dump_lists_the_recorded_results(fake_server, run_check):
+    for i in range(3):
+        run_check(SERVER, *LOGIN + ['-m', 'connections', '--history'])
+    fake_dbapi.reset_stats()
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'connections', '--history-dump'])
+    assert code == 0
+    assert output.startswith('OK: 3 samples of connections for bench')
+    assert output.splitlines()[1].endswith(' 42.0')
+    #~ The dump reads the ring only
+    assert fake_dbapi.STATS['connects'] == 0
+
+def test_ring_keeps_the_newest_samples(fake_server, run_check):
+    for i in range(5):
+        run_check(MYSQL, *LOGIN + ['-m', 'connections', '--history', '--history-size', '2'])
+    code, output = run_check(MYSQL, *LOGIN + ['-m', 'connections', '--history-dump'])
+    assert code == 0
+    assert output.startswith('OK: 2 samples of connections for bench')
+    assert len(output.splitlines()) == 3
+
+def test_ring_lives_in_the_private_directory(fake_server, run_check, tmp_path):
+    run_check(MYSQL, *LOGIN + ['-m', 'connections', '--history'])
+    private = tmp_path / 'mysql-checks-{}'.format(os.geteuid())
+    assert [name for name in os.listdir(str(private)) if name.startswith('history-') and name.endswith('.ring')]
+
+def test_dump_without_history(fake_server, run_check):
+    code, output = run_check(SERVER, *LOGIN + ['-m', 'connections', '--history-dump'])
+    assert code == 3
+    assert 'No history of connections for bench, run the check with --history first.' in output
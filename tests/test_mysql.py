@@ -0,0 +1,67 @@
+import re
+
+import pytest
+
+import fake_dbapi
+from conftest import load_script
+
+MYSQL = 'mysql/check_mysql_health.py'
+LOGIN = ['-H', 'bench', '-U', 'nagios', '-P', 'secret']
+UUID_A = '3e11fa47-71ca-11e1-9e33-c80aa9429562'
+UUID_B = '8a94f357-aab4-11df-86ab-c80aa9429563'
+
+@pytest.fixture(scope='module')
+def script():
+    return load_script(MYSQL)
+
+def test_gtid_intervals(script):
+    intervals = script['gtid_intervals']('{}:1-5:7,\n{}:1-3'.format(UUID_A.upper(), UUID_B))
+    assert intervals == { UUID_A : [(1, 5), (7, 7)], UUID_B : [(1, 3)] }
+
+def test_gtid_intervals_with_tags(script):
+    intervals = script['gtid_intervals']('{}:1-5:batch:1-2'.format(UUID_A))
+    assert intervals == { UUID_A : [(1, 5)], UUID_A + ':batch' : [(1, 2)] }
+
+@pytest.mark.parametrize('retrieved, executed, gap', [
+    ('',                                        '',                                         0),
+    ('{a}:1-5120',                              '{a}:1-5117,{b}:1-880',                     3),
+    ('{a}:1-10',                                '{a}:1-10',                                 0),
+    ('{a}:1-10',                                '',                                         10),
+    ('{a}:1-10',                                '{a}:1-3:6-8',                              4),
+    ('{a}:1-10:20-29',                          '{a}:1-25',                                 4),
+    ('{a}:5-9',                                 '{a}:1-4:10-12',                            5),
+    ('{a}:1-10,{b}:1-884',                      '{a}:1-10,{b}:1-880',                       4),
+    ('{a}:1-10',                                '{b}:1-10',                                 10),
+])
+def test_gtid_gap(script, retrieved, executed, gap):
+    assert script['gtid_gap'](retrieved.format(a=UUID_A, b=UUID_B), executed.format(a=UUID_A, b=UUID_B)) == gap
+
+def test_gtidgap_mode(fake_server, run_check):
+    code, output = run_check(MYSQL, *LOGIN + ['-m', 'gtidgap', '-w', '10', '-c', '100'])
+    assert code == 0
+    assert 'gtid_gap_default=3;' in output
+    assert 'gtid_gap_analytics=4;' in output
+
+def test_rate_restart(fake_server, run_check, monkeypatch):
+    run_check(MYSQL, *LOGIN + ['-m', 'qps'])
+    code, output = run_check(MYSQL, *LOGIN + ['-m', 'qps'])
+    assert float(re.search(r'qps=([\d.]+)', output).group(1)) == pytest.approx(6500 / float(fake_dbapi.READ_INTERVAL), rel=0.01)
+    #~ After a restart Uptime and the status counters begin again from zero
+    restarted = [(name, 0, growth) for name, value, growth in fake_dbapi.MYSQL_STATUS]
+    monkeypatch.setattr(fake_dbapi, 'MYSQL_STATUS', restarted)
+    code, output = run_check(MYSQL, *LOGIN + ['-m', 'qps'])
+    assert code == 0
+    assert 'new baseline sample' in output
+    assert 'qps=U;' in output
+
+def test_digest_with_few_calls_keeps_its_older_sample(fake_server, run_check):
+    #~ The orders digest gets 200 calls per read, so it is compared over two reads
+    args = LOGIN + ['-m', 'digestregression', '--digest-min-calls', '300', '-w', '2', '-c', '4']
+    run_check(MYSQL, *args)
+    code, output = run_check(MYSQL, *args)
+    assert code == 0
+    assert 'digests_compared=2;' in output
+    code, output = run_check(MYSQL, *args)
+    assert code == 2
+    assert 'digests_compared=3;' in output
+    assert 'over 400 calls of shop: SELECT * FROM `orders`' in output
@@ -0,0 +1,59 @@
+import os
+import re
+import stat
+
+from plugin_common import PassiveSpool
+
+SERVER = 'mssql/check_mssql_server.py'
+LOGIN = ['-H', 'bench', '-U', 'nagios', '-P', 'secret']
+
+def spool_files(directory):
+    return sorted(os.listdir(str(directory)))
+
+def test_checkresult_file_naming(tmp_path):
+    spool = PassiveSpool(spool_dir=str(tmp_path))
+    spool.add('db1', 'memory', 1, 'WARNING: Server using 91% of memory', 1700000000.5, 1700000001.25)
+    assert spool.flush() == 1
+    files = spool_files(tmp_path)
+    #~ One cXXXXXX file with its .ok marker, and no temporary file left behind
+    assert len(files) == 2
+    assert re.match(r'^c[A-Za-z0-9]{6}$', files[0])
+    assert files[1] == files[0] + '.ok'
+    assert stat.S_IMODE(os.stat(str(tmp_path / files[0])).st_mode) == 0o644
+    content = (tmp_path / files[0]).read_text()
+    assert content.startswith('### Active Check Result File ###\nfile_time=')
+    assert 'host_name=db1\nservice_description=memory\n' in content
+    assert 'start_time=1700000000.500000\nfinish_time=1700000001.250000\n' in content
+    assert 'return_code=1\noutput=WARNING: Server using 91% of memory\n' in content
+
+def test_every_flush_gets_its_own_file(tmp_path):
+    spool = PassiveSpool(spool_dir=str(tmp_path))
+    for i in range(5):
+        spool.add('db1', 'connections', 0, 'OK: {} users'.format(i), 1700000000, 1700000001)
+        spool.flush()
+    files = spool_files(tmp_path)
+    assert len(files) == 10
+    assert len([name for name in files if name.endswith('.ok')]) == 5
+    assert not [name for name in files if name.startswith('.')]
+
+def test_multiline_output_is_escaped(tmp_path):
+    command_file = tmp_path / 'nagios.cmd'
+    command_file.write_text('')
+    spool = PassiveSpool(command_file=str(command_file))
+    spool.add('db1', 'slave', 2, 'CRITICAL: channel down\nLast error: C:\\dump', 1700000000, 1700000001.9)
+    spool.add('db2', 'slave', 0, 'OK: all channels OK', 1700000000, 1700000002)
+    assert spool.flush() == 2
+    assert command_file.read_text().splitlines() == [
+        '[1700000001] PROCESS_SERVICE_CHECK_RESULT;db1;slave;2;CRITICAL: channel down\\nLast error: C:\\\\dump',
+        '[1700000002] PROCESS_SERVICE_CHECK_RESULT;db2;slave;0;OK: all channels OK' ]
+
+def test_modes_to_spool_dir(fake_server, run_check, tmp_path):
+    spool_dir = tmp_path / 'checkresults'
+    spool_dir.mkdir()
+    code, output = run_check(SERVER, *LOGIN + ['--modes', 'connections,memory', '--spool-dir', str(spool_dir),
+                                               '--service-format', 'mssql {mode}'])
+    assert (code, output) == (0, 'OK: 2 passive results for 1 hosts submitted, 0 with problems')
+    name = [name for name in spool_files(spool_dir) if not name.endswith('.ok')][0]
+    content = (spool_dir / name).read_text()
+    assert 'service_description=mssql connections\n' in content
+    assert 'service_description=mssql memory\n' in content
@@ -0,0 +1,49 @@
+import pytest
+
+from plugin_common import Threshold, threshold, is_within_range
+
+@pytest.mark.parametrize('spec, start, end, inside', [
+    ('10',      0,              10,             False),
+    ('10:',     10,             float('inf'),   False),
+    ('~:10',    float('-inf'),  10,             False),
+    ('10:20',   10,             20,             False),
+    ('@10:20',  10,             20,             True),
+    ('1.5:2.5', 1.5,            2.5,            False),
+])
+def test_parse(spec, start, end, inside):
+    parsed = Threshold(spec)
+    assert (parsed.start, parsed.end, parsed.inside) == (start, end, inside)
+
+@pytest.mark.parametrize('spec', ['abc', '20:10', '1:x', '10:20:30', ':', '@:'])
+def test_improper_format(spec):
+    with pytest.raises(Exception, match='Improper warning/critical format'):
+        Threshold(spec)
+
+@pytest.mark.parametrize('spec, value, alert', [
+    ('10',      -1,     True),
+    ('10',      0,      False),
+    ('10',      10,     False),
+    ('10',      10.1,   True),
+    ('10:',     9,      True),
+    ('10:',     1e12,   False),
+    ('~:10',    -1e12,  False),
+    ('~:10',    11,     True),
+    ('10:20',   15,     False),
+    ('10:20',   21,     True),
+    ('@10:20',  15,     True),
+    ('@10:20',  9,      False),
+    ('-5',      -10,    True),
+    ('-5',      0,      True),
+    ('-5',      10,     True),
+])
+def test_alert(spec, value, alert):
+    assert is_within_range(spec, value) is alert
+    assert is_within_range(spec, value, invert=True) is not alert
+
+def test_no_threshold():
+    assert threshold('') is None
+    assert threshold(None) is None
+    assert is_within_range(None, 1e12) is False
+
+def test_parsed_once():
+    assert threshold('5:50') is threshold('5:50')